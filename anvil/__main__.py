@@ -25,8 +25,11 @@ import traceback as tb
 sys.path.insert(0, os.path.join(os.path.abspath(os.pardir)))
 sys.path.insert(0, os.path.abspath(os.getcwd()))
 
+from anvil import action
 from anvil import actions
+from anvil import bundle
 from anvil import colorizer
+from anvil import daemon
 from anvil import distro
 from anvil import env
 from anvil import exceptions as excp
@@ -53,9 +56,9 @@ def run(args):
 
     # Keep the old args around so we have the full set to write out
     saved_args = dict(args)
-    action = args.pop("action", '').strip().lower()
-    if action not in actions.names():
-        raise excp.OptionException("Invalid action name %r specified!" % (action))
+    action_name = args.pop("action", '').strip().lower()
+    if action_name not in actions.names() and action_name != daemon.SERVE_ACTION:
+        raise excp.OptionException("Invalid action name %r specified!" % (action_name))
 
     persona_fn = args.pop('persona_fn')
     if not persona_fn:
@@ -87,28 +90,53 @@ def run(args):
     # Ensure the anvil dirs are there if others are about to use it...
     ensure_anvil_dirs(root_dir)
 
+    # Either become the daemon for the root directory or have the daemon
+    # (which already has everything below loaded) run the action
+    use_daemon = args.pop('use_daemon', False)
+    if action_name == daemon.SERVE_ACTION:
+        daemon.Daemon(root_dir).serve()
+        return
+    if use_daemon:
+        LOG.info("Sending action %s to the daemon serving %s.",
+                 colorizer.quote(action_name), colorizer.quote(root_dir))
+        result = daemon.Client(root_dir).run(action_name, persona_fn, args)
+        pretty_time = utils.format_time(result['elapsed'])
+        LOG.info("It took %s seconds or %s minutes to complete action %s.",
+                 colorizer.quote(pretty_time['seconds']), colorizer.quote(pretty_time['minutes']), colorizer.quote(action_name))
+        return
+
+    # Load the distro + persona + component options (reusing what a previous
+    # run loaded when none of the files they come from have changed)
+    config_bundle = bundle.load(root_dir, settings.DISTRO_DIR, persona_fn,
+                                settings.COMPONENT_CONF_DIR,
+                                base_names=action.BASE_YAML_INTERP)
+
     # Load the distro
-    dist = distro.load(settings.DISTRO_DIR)
+    dist = distro.load(settings.DISTRO_DIR, definitions=config_bundle.distros)
 
     # Load + verify the person
     try:
-        persona_obj = persona.load(persona_fn)
+        persona_obj = persona.load(persona_fn, definition=config_bundle.persona)
         persona_obj.verify(dist)
     except Exception as e:
         raise excp.OptionException("Error loading persona file: %s due to %s" % (persona_fn, e))
 
+    # Now that it is known to work, store it for next run
+    config_bundle.save()
+
     # Get the object we will be running with...
-    runner_cls = actions.class_for(action)
+    runner_cls = actions.class_for(action_name)
     runner = runner_cls(distro=dist,
                         root_dir=root_dir,
-                        name=action,
+                        name=action_name,
                         cli_opts=args)
+    runner.interpolator.update(config_bundle.options)
 
     # Now that the settings are known to work, store them for next run
     store_current_settings(saved_args)
 
     LOG.info("Starting action %s on %s for distro: %s",
-             colorizer.quote(action), colorizer.quote(utils.iso8601()),
+             colorizer.quote(action_name), colorizer.quote(utils.iso8601()),
              colorizer.quote(dist.name))
     LOG.info("Using persona: %s", colorizer.quote(persona_fn))
     LOG.info("In root directory: %s", colorizer.quote(root_dir))
@@ -119,7 +147,7 @@ def run(args):
 
     pretty_time = utils.format_time(end_time - start_time)
     LOG.info("It took %s seconds or %s minutes to complete action %s.",
-             colorizer.quote(pretty_time['seconds']), colorizer.quote(pretty_time['minutes']), colorizer.quote(action))
+             colorizer.quote(pretty_time['seconds']), colorizer.quote(pretty_time['minutes']), colorizer.quote(action_name))
 
 
 def load_previous_settings():
@@ -152,7 +180,7 @@ def store_current_settings(c_settings):
     try:
         # Remove certain keys that just shouldn't be saved
         to_save = dict(c_settings)
-        for k in ['action', 'verbose', 'dryrun']:
+        for k in ['action', 'verbose', 'dryrun', 'use_daemon']:
             if k in c_settings:
                 to_save.pop(k, None)
         with sh.Rooted(True):
@@ -66,29 +66,35 @@ class Action(object):
         self.store_passwords = cli_opts.pop('store_passwords', True)
         # Stored for components to get any options
         self.cli_opts = cli_opts
+        # The persona the components were last constructed for (and those
+        # components) so that running again (ie from the daemon) reuses them
+        self._constructed = (None, None)
 
     def _establish_passwords(self, component_order, instances):
+        self.passwords.clear()
+        wanted = []
+        for c in component_order:
+            wanted_passwords = instances[c].get_option('wanted_passwords')
+            if wanted_passwords:
+                wanted.extend(wanted_passwords.items())
+        if not wanted:
+            # Nothing to read, so don't bother opening the keyring
+            return
         kr = pw.KeyringProxy(self.keyring_path,
                              self.keyring_encrypted,
                              self.prompt_for_passwords,
                              True)
         LOG.info("Reading passwords using a %s", kr)
         to_save = {}
-        self.passwords.clear()
         already_gotten = set()
-        for c in component_order:
-            instance = instances[c]
-            wanted_passwords = instance.get_option('wanted_passwords')
-            if not wanted_passwords:
+        for (name, prompt) in wanted:
+            if name in already_gotten:
                 continue
-            for (name, prompt) in wanted_passwords.items():
-                if name in already_gotten:
-                    continue
-                (from_keyring, pw_provided) = kr.read(name, prompt)
-                if not from_keyring and self.store_passwords:
-                    to_save[name] = pw_provided
-                self.passwords[name] = pw_provided
-                already_gotten.add(name)
+            (from_keyring, pw_provided) = kr.read(name, prompt)
+            if not from_keyring and self.store_passwords:
+                to_save[name] = pw_provided
+            self.passwords[name] = pw_provided
+            already_gotten.add(name)
         if to_save:
             LOG.info("Saving %s passwords using a %s", len(to_save), kr)
             for (name, pw_provided) in to_save.items():
@@ -226,6 +232,13 @@ class Action(object):
             instances[c] = importer.construct_entry_point(d_component.entry_point, **instance_params)
         return instances
 
+    def _get_instances(self, persona):
+        (constructed_for, instances) = self._constructed
+        if constructed_for is not persona:
+            instances = self._construct_instances(persona)
+            self._constructed = (persona, instances)
+        return instances
+
     def _verify_components(self, component_order, instances):
         LOG.info("Verifying that the components are ready to rock-n-roll.")
         for c in component_order:
@@ -332,7 +345,7 @@ class Action(object):
         return component_results
 
     def run(self, persona):
-        instances = self._construct_instances(persona)
+        instances = self._get_instances(persona)
         component_order = self._order_components(persona.wanted_components)
         LOG.info("Processing components for action %s.", colorizer.quote(self.name))
         utils.log_iterable(component_order,
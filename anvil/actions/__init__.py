@@ -14,25 +14,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-from anvil.actions import install
-from anvil.actions import package
-from anvil.actions import start
-from anvil.actions import status
-from anvil.actions import stop
-from anvil.actions import test
-from anvil.actions import uninstall
-
+from anvil import importer
 
+# Action runners are only imported when used (some of them import a lot)
 _NAMES_TO_RUNNER = {
-    'install': install.InstallAction,
-    'package': package.PackageAction,
-    'start': start.StartAction,
-    'status': status.StatusAction,
-    'stop': stop.StopAction,
-    'test': test.TestAction,
-    'uninstall': uninstall.UninstallAction,
+    'install': 'anvil.actions.install:InstallAction',
+    'package': 'anvil.actions.package:PackageAction',
+    'scrub': 'anvil.actions.scrub:ScrubAction',
+    'start': 'anvil.actions.start:StartAction',
+    'status': 'anvil.actions.status:StatusAction',
+    'stop': 'anvil.actions.stop:StopAction',
+    'test': 'anvil.actions.test:TestAction',
+    'uninstall': 'anvil.actions.uninstall:UninstallAction',
 }
-_RUNNER_TO_NAMES = dict((v, k) for k, v in _NAMES_TO_RUNNER.items())
 
 
 def names():
@@ -47,6 +41,7 @@ def class_for(action):
     Given an action name, look up the factory for that action runner.
     """
     try:
-        return _NAMES_TO_RUNNER[action]
+        entry_point = _NAMES_TO_RUNNER[action]
     except KeyError:
         raise RuntimeError('Unrecognized action %s' % action)
+    return importer.import_entry_point(entry_point)
@@ -16,13 +16,22 @@
 
 from StringIO import StringIO
 
+import threading
+
 from anvil import action
 from anvil import colorizer
+from anvil import components
+from anvil import exceptions as excp
 from anvil import log
+from anvil import phase
 from anvil import shell as sh
 from anvil import utils
 
 from anvil.action import PhaseFunctors
+from anvil.packaging import pip
+from anvil.packaging.helpers import pip_helper
+from anvil.packaging.helpers import solver
+from anvil.utils import OrderedDict
 
 LOG = log.getLogger(__name__)
 
@@ -31,6 +40,7 @@ class InstallAction(action.Action):
     def __init__(self, name, distro, root_dir, cli_opts):
         action.Action.__init__(self, name, distro, root_dir, cli_opts)
         self.only_configure = cli_opts.get('only_configure')
+        self.download_workers = cli_opts.get('download_workers', 1)
 
     @property
     def lookup_name(self):
@@ -60,12 +70,157 @@ class InstallAction(action.Action):
                                header="Wrote to %s %s exports" % (path, len(entries)),
                                logger=LOG)
 
+    def _presolve(self, component_order, instances):
+        # Figure out what every component needs before any of them start
+        # installing so that all the conflicts are found (and shown) at once
+        # instead of one at a time (possibly after a long install). The
+        # versions selected are then what every component installs.
+        dep_solver = solver.Solver()
+        for c in component_order:
+            if isinstance(instances[c], components.PkgInstallComponent):
+                # Gather what they list themselves (not a previous solution)
+                instances[c].solution = None
+
+        def gather(instance):
+            if not isinstance(instance, components.PkgInstallComponent):
+                return
+            for p in instance.packages:
+                dep_solver.add_package(instance.name, p)
+            if isinstance(instance, components.PythonInstallComponent):
+                for p in instance.pips:
+                    dep_solver.add_pip(instance.name, p)
+                for details in instance.pip_requires:
+                    dep_solver.add_requirement(instance.name, details)
+
+        LOG.info("Solving what all components need to have installed.")
+        # Ran as an unrecorded phase so that each component only
+        # sees the components activated before it (as the install does).
+        self._run_phase(
+            PhaseFunctors(
+                start=None,
+                run=gather,
+                end=None,
+            ),
+            component_order,
+            instances,
+            None,
+            )
+        solution = dep_solver.solve(pip_helper.Helper(self.distro).get_installed)
+        if solution.warnings:
+            utils.log_iterable(solution.warnings, logger=LOG, color='yellow',
+                               header="Found %s potential dependency problems" % (len(solution.warnings)))
+        if solution.conflicts:
+            utils.log_iterable(solution.conflicts, logger=LOG, color='red',
+                               header="Found %s dependency conflicts" % (len(solution.conflicts)))
+            raise excp.DependencyException("Unable to find a consistent set of dependencies"
+                                           " to install, %s conflicts were found" % (len(solution.conflicts)))
+        for c in component_order:
+            if isinstance(instances[c], components.PkgInstallComponent):
+                instances[c].solution = solution
+        return solution
+
+    def _build_wheels(self, component_order, instances):
+        # Gather the pips of every component that is still to be installed
+        # so that all of their wheels can be built (in parallel) up front.
+        installed = phase.PhaseRecorder(self._get_phase_filename("install"))
+        wheelhouses = OrderedDict()
+
+        def gather(instance):
+            if instance.name in installed:
+                return
+            if not isinstance(instance, components.PythonInstallComponent):
+                return
+            wheelhouse = instance.wheelhouse
+            if not wheelhouse:
+                return
+            if wheelhouse.wheel_dir not in wheelhouses:
+                wheelhouses[wheelhouse.wheel_dir] = (wheelhouse, [])
+            wheelhouses[wheelhouse.wheel_dir][1].extend([pip.extract_requirement(p) for p in instance.pips])
+
+        # Ran as an unrecorded phase so that each component only
+        # sees the components activated before it (as the install does).
+        self._run_phase(
+            PhaseFunctors(
+                start=None,
+                run=gather,
+                end=None,
+            ),
+            component_order,
+            instances,
+            None,
+            )
+        for (wheelhouse, reqs) in wheelhouses.values():
+            failures = wheelhouse.build(reqs)
+            if failures:
+                utils.log_iterable([str(req) for req in failures], logger=LOG,
+                                   header="Will retry building %s wheels during install" % (len(failures)))
+
+    def _prefetch(self, component_order, instances):
+        # Downloads (clones) are network latency bound so do the ones that
+        # have not already happened at the same time (using a bounded number
+        # of workers); the download phase will then record the results of
+        # these (in order) as if it had downloaded them itself.
+        recorder = phase.PhaseRecorder(self._get_phase_filename("download"))
+        fetchable = []
+        for c in component_order:
+            instance = instances[c]
+            if c in recorder or not isinstance(instance, components.PkgInstallComponent):
+                continue
+            fetchable.append(instance)
+        if len(fetchable) <= 1 or self.download_workers <= 1:
+            return {}
+
+        utils.log_iterable([i.name for i in fetchable], logger=LOG,
+                           header="Downloading %s components using %s workers" % (len(fetchable),
+                                                                                   self.download_workers))
+        finished = []
+        finished_lock = threading.Lock()
+
+        def fetch(instance):
+            try:
+                return instance.download()
+            finally:
+                with finished_lock:
+                    finished.append(instance.name)
+                    LOG.info("Finished downloading %s (%s/%s).", colorizer.quote(instance.name),
+                             len(finished), len(fetchable))
+
+        fetched = {}
+        failures = []
+        for (instance, result, exc_info) in utils.run_in_parallel(fetch, fetchable, self.download_workers):
+            fetched[instance.name] = (result, exc_info)
+            if exc_info:
+                failures.append("%s: %s" % (instance.name, exc_info[1]))
+        if failures:
+            utils.log_iterable(failures, logger=LOG, color='red',
+                               header="Failed downloading %s of %s components" % (len(failures),
+                                                                                   len(fetchable)))
+        return fetched
+
     def _run(self, persona, component_order, instances):
         removals = []
+
+        # Components that keep their checkouts updated download (update)
+        # on every install and not just the first time.
+        download_recorder = phase.PhaseRecorder(self._get_phase_filename("download"))
+        for c in component_order:
+            if c in download_recorder and instances[c].get_bool_option('git_update'):
+                download_recorder.unmark(c)
+
+        fetched = self._prefetch(component_order, instances)
+
+        def download(instance):
+            if instance.name not in fetched:
+                return instance.download()
+            (result, exc_info) = fetched[instance.name]
+            if exc_info:
+                raise excp.DownloadException("Downloading %s failed: %s" % (instance.name, exc_info[1]))
+            return result
+
         self._run_phase(
             PhaseFunctors(
                 start=lambda i: LOG.info('Downloading %s.', colorizer.quote(i.name)),
-                run=lambda i: i.download(),
+                run=download,
                 end=lambda i, result: LOG.info("Performed %s downloads.", len(result))
             ),
             component_order,
@@ -73,6 +228,13 @@ class InstallAction(action.Action):
             "download",
             *removals
             )
+
+        # Sources that changed may need their patches (re)applied
+        patch_recorder = phase.PhaseRecorder(self._get_phase_filename("download-patch"))
+        for c in component_order:
+            if getattr(instances[c], 'source_changed', None) and c in patch_recorder:
+                patch_recorder.unmark(c)
+
         self._run_phase(
             PhaseFunctors(
                 start=lambda i: LOG.info('Post-download patching %s.', colorizer.quote(i.name)),
@@ -85,6 +247,13 @@ class InstallAction(action.Action):
             *removals
             )
 
+        # Configs made from sources that changed may need remaking (those
+        # made from what did not change are skipped when configuring)
+        configure_recorder = phase.PhaseRecorder(self._get_phase_filename("configure"))
+        for c in component_order:
+            if getattr(instances[c], 'source_changed', None) and c in configure_recorder:
+                configure_recorder.unmark(c)
+
         removals += ['uninstall', 'unconfigure']
         self._run_phase(
             PhaseFunctors(
@@ -105,6 +274,8 @@ class InstallAction(action.Action):
             LOG.info("Exiting early, only asked to download and configure!")
             return
 
+        self._presolve(component_order, instances)
+
         removals += ['pre-uninstall', 'post-uninstall']
         self._run_phase(
             PhaseFunctors(
@@ -118,6 +289,8 @@ class InstallAction(action.Action):
             *removals
             )
 
+        self._build_wheels(component_order, instances)
+
         def install_start(instance):
             subsystems = set(list(instance.subsystems))
             if subsystems:
@@ -0,0 +1,41 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from anvil import action
+from anvil import colorizer
+from anvil import log
+
+from anvil.action import PhaseFunctors
+
+LOG = log.getLogger(__name__)
+
+
+class ScrubAction(action.Action):
+    @property
+    def lookup_name(self):
+        return 'running'
+
+    def _run(self, persona, component_order, instances):
+        self._run_phase(
+            PhaseFunctors(
+                start=lambda i: LOG.info('Scrubbing the cached data of %s.', colorizer.quote(i.name)),
+                run=lambda i: i.scrub(),
+                end=lambda i, result: LOG.info("Removed %s corrupt cached items.", colorizer.quote(result)),
+            ),
+            component_order,
+            instances,
+            None,
+            )
@@ -53,6 +53,25 @@ class StartAction(action.Action):
             "start",
             *removals
             )
+
+        def restart_finish(instance, result):
+            if result:
+                LOG.info("Restarted %s applications of %s with changed configs.",
+                         colorizer.quote(result), colorizer.quote(instance.name))
+
+        # Programs already running (so not started again) whose config
+        # files changed since they were started get restarted, this is not
+        # recorded since it needs doing again whenever configs change.
+        self._run_phase(
+            PhaseFunctors(
+                start=None,
+                run=lambda i: i.restart_changed(),
+                end=restart_finish,
+            ),
+            component_order,
+            instances,
+            None,
+            )
         self._run_phase(
             PhaseFunctors(
                 start=lambda i: LOG.info('Post-starting %s.', colorizer.quote(i.name)),
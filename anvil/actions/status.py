@@ -91,6 +91,13 @@ class StatusAction(action.Action):
                 if self.show_amount > 0 and s.details:
                     details_printer(s, 4, self.show_amount)
 
+        started = [s.name for s in result if s.status == STATUS_STARTED]
+        changed = [name for name in component.changed_programs() if name in started]
+        if changed:
+            utils.log_iterable(changed, logger=LOG,
+                               header="Config files of %s programs of %s changed since they were started (starting again restarts them)"
+                                      % (len(changed), colorizer.quote(component.name)))
+
     def _run(self, persona, component_order, instances):
         self._run_phase(
             PhaseFunctors(
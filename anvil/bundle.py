@@ -0,0 +1,190 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import cPickle as pickle
+import glob
+import hashlib
+import os
+import sys
+import tempfile
+
+from anvil import cfg
+from anvil import distro
+from anvil import exceptions as excp
+from anvil import log as logging
+from anvil import persona
+from anvil import shell as sh
+from anvil import version
+
+LOG = logging.getLogger(__name__)
+
+# Change this when what is stored in a bundle changes
+BUNDLE_VERSION = 1
+BUNDLE_NAME = 'config-bundle.pickle'
+
+
+def _hash_file(fn):
+    with open(fn, 'rb') as fh:
+        return hashlib.sha1(fh.read()).hexdigest()
+
+
+def _stat_file(fn):
+    st = os.stat(fn)
+    return (st.st_mtime, st.st_size)
+
+
+def _source_files(distro_dir, persona_fn, component_dir):
+    fns = set([persona_fn])
+    fns.update(glob.glob(sh.joinpths(distro_dir, '*.yaml')))
+    fns.update(glob.glob(sh.joinpths(component_dir, '*.yaml')))
+    return sorted([os.path.abspath(fn) for fn in fns])
+
+
+def _make_manifest(fns):
+    manifest = {}
+    for fn in fns:
+        (mtime, size) = _stat_file(fn)
+        manifest[fn] = (mtime, size, _hash_file(fn))
+    return manifest
+
+
+def _is_unchanged(manifest, fns):
+    if sorted(manifest.keys()) != fns:
+        return False
+    for fn in fns:
+        (mtime, size, digest) = manifest[fn]
+        try:
+            (c_mtime, c_size) = _stat_file(fn)
+        except OSError:
+            return False
+        if c_size != size:
+            return False
+        # Only files that were touched need to have their contents checked
+        if c_mtime != mtime and _hash_file(fn) != digest:
+            return False
+    return True
+
+
+class Bundle(object):
+    """
+    The distro definitions, persona definition and interpolated component
+    options (all that is loaded from yaml before an action can start) that
+    are saved (after being validated) so that later runs can reuse them
+    instead of loading and interpolating all those yaml files again.
+    """
+
+    def __init__(self, path, key, manifest, distros, persona, options, loaded=False):
+        self.path = path
+        self.key = key
+        self.manifest = manifest
+        self.distros = distros
+        self.persona = persona
+        self.options = options
+        self.loaded = loaded
+
+    def save(self):
+        if self.loaded:
+            return
+        contents = {
+            'key': self.key,
+            'manifest': self.manifest,
+            'distros': self.distros,
+            'persona': self.persona,
+            'options': self.options,
+        }
+        try:
+            # Written to the side and then moved (so that partially written
+            # bundles are never loaded); don't use sh here so that this is
+            # always written (even if dry-run)
+            (fd, tmp_fn) = tempfile.mkstemp(dir=os.path.dirname(self.path), suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fh:
+                pickle.dump(contents, fh, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp_fn, self.path)
+            self.loaded = True
+        except (IOError, OSError, pickle.PicklingError) as e:
+            LOG.debug("Failed saving the configuration bundle to %r: %s", self.path, e)
+
+
+def _make_key(persona_fn, interpolator):
+    return {
+        'version': BUNDLE_VERSION,
+        'anvil': version.version_string(),
+        'python': sys.version,
+        'persona_fn': os.path.abspath(persona_fn),
+        # Values interpolated from these may change even when
+        # the yaml files have not (ie when this hosts ip changes)
+        'auto': interpolator.auto_values(),
+    }
+
+
+def _load_saved(path, key, fns):
+    try:
+        # Don't use sh here so that we always
+        # read this (even if dry-run)
+        with open(path, 'rb') as fh:
+            contents = pickle.load(fh)
+    except (IOError, EOFError, pickle.UnpicklingError, AttributeError, ValueError, TypeError):
+        return None
+    if not isinstance(contents, dict) or contents.get('key') != key:
+        return None
+    if not _is_unchanged(contents.get('manifest') or {}, fns):
+        return None
+    return Bundle(path, key, contents['manifest'], contents['distros'],
+                  contents['persona'], contents['options'], loaded=True)
+
+
+def is_current(config_bundle, distro_dir, persona_fn, component_dir):
+    """
+    Returns whether the given bundle would still be loaded (its key and the
+    files it was made from are unchanged) for the given source files.
+    """
+    key = _make_key(persona_fn, cfg.YamlInterpolator(component_dir))
+    if key != config_bundle.key:
+        return False
+    fns = _source_files(distro_dir, persona_fn, component_dir)
+    return _is_unchanged(config_bundle.manifest, fns)
+
+
+def load(root_dir, distro_dir, persona_fn, component_dir, base_names=()):
+    """
+    Returns the bundle for the given distro directory, persona and component
+    directory, which is loaded from the root directory if its source files
+    have not changed since it was saved (otherwise its source files are
+    loaded again, the caller should validate and then save it).
+
+    The component options of the base names (and of the components the
+    persona wants) are interpolated and stored in the bundle.
+    """
+    path = sh.joinpths(root_dir, BUNDLE_NAME)
+    interpolator = cfg.YamlInterpolator(component_dir)
+    key = _make_key(persona_fn, interpolator)
+    fns = _source_files(distro_dir, persona_fn, component_dir)
+    bundle = _load_saved(path, key, fns)
+    if bundle is not None:
+        LOG.debug("Loaded the configuration bundle from %r", path)
+        return bundle
+    LOG.debug("Making the configuration bundle from %s files", len(fns))
+    manifest = _make_manifest(fns)
+    distros = distro.read_definitions(distro_dir)
+    try:
+        persona_def = persona.read_definition(persona_fn)
+        names = list(base_names) + list(persona_def.get('components') or [])
+    except Exception as e:
+        raise excp.OptionException("Error loading persona file: %s due to %s" % (persona_fn, e))
+    options = {}
+    for name in names:
+        options[name] = interpolator.extract(name)
+    return Bundle(path, key, manifest, distros, persona_def, options)
@@ -25,11 +25,13 @@ import iniparse
 
 from StringIO import StringIO
 
+from anvil import exceptions as excp
 from anvil import log as logging
 from anvil import shell as sh
 from anvil import utils
 
 INTERP_PAT = r"\s*\$\(([\w\d-]+):([\w\d-]+)\)\s*"
+INTERP_RE = re.compile(INTERP_PAT)
 
 LOG = logging.getLogger(__name__)
 
@@ -135,6 +137,18 @@ class RewritableConfigParser(ConfigHelperMixin, iniparse.RawConfigParser, String
 
 
 class YamlInterpolator(object):
+    """
+    Interpolates the $(who:key) references in the yaml files found in a
+    base directory, where 'who' is the name of a yaml file (or 'auto' for
+    values found automatically, like this hosts ip) and 'key' is one of
+    that files top level keys.
+
+    Each referenced key is resolved (and its value interpolated) only once,
+    the references found while doing that form a dependency graph (which
+    keys depend on which other keys) which is used to detect cycles (which
+    can never be resolved) and can be examined via the dependencies method.
+    """
+
     def __init__(self, base):
         self.included = {}
         self.interpolated = {}
@@ -146,59 +160,47 @@ class YamlInterpolator(object):
             'home': sh.gethomedir,
             'hostname': sh.hostname,
         }
-
-    def _interpolate_iterable(self, what):
+        # Auto values are only found once (they do not change during a run)
+        self._auto_values = {}
+        # Fully interpolated values of each (who, key) reference
+        self._resolved = {}
+        # What (who, key) references each (who, key) makes
+        self._edges = {}
+        # The (who, key) references being resolved (in order)
+        self._resolving = []
+
+    def _interpolate_iterable(self, what, node):
         if isinstance(what, (set)):
             n_what = set()
             for v in what:
-                n_what.add(self._interpolate(v))
+                n_what.add(self._interpolate(v, node))
             return n_what
         else:
             n_what = []
             for v in what:
-                n_what.append(self._interpolate(v))
+                n_what.append(self._interpolate(v, node))
             if isinstance(what, (tuple)):
                 n_what = tuple(n_what)
             return n_what
 
-    def _interpolate_dictionary(self, what):
+    def _interpolate_dictionary(self, what, node):
         n_what = {}
         for (k, v) in what.iteritems():
-            n_what[k] = self._interpolate(v)
-        return n_what
-
-    def _include_dictionary(self, what):
-        n_what = {}
-        for (k, value) in what.iteritems():
-            n_what[k] = self._do_include(value)
+            n_what[k] = self._interpolate(v, node)
         return n_what
 
-    def _include_iterable(self, what):
-        if isinstance(what, (set)):
-            n_what = set()
-            for v in what:
-                n_what.add(self._do_include(v))
-            return n_what
-        else:
-            n_what = []
-            for v in what:
-                n_what.append(self._do_include(v))
-            if isinstance(what, (tuple)):
-                n_what = tuple(n_what)
-            return n_what
-
-    def _interpolate(self, value):
+    def _interpolate(self, value, node):
         new_value = value
         if value and isinstance(value, (basestring, str)):
-            new_value = self._interpolate_string(value)
+            new_value = self._interpolate_string(value, node)
         elif isinstance(value, (dict)):
-            new_value = self._interpolate_dictionary(value)
+            new_value = self._interpolate_dictionary(value, node)
         elif isinstance(value, (list, set, tuple)):
-            new_value = self._interpolate_iterable(value)
+            new_value = self._interpolate_iterable(value, node)
         return new_value
 
-    def _interpolate_string(self, what):
-        if not re.search(INTERP_PAT, what):
+    def _interpolate_string(self, what, node):
+        if '$(' not in what:
             # Leave it alone if the sub won't do
             # anything to begin with
             return what
@@ -209,51 +211,20 @@ class YamlInterpolator(object):
             (is_special, special_value) = self._process_special(who, key)
             if is_special:
                 return special_value
-            if who not in self.interpolated:
-                self.interpolated[who] = self.included[who]
-                self.interpolated[who] = self._interpolate(self.included[who])
-            return str(self.interpolated[who][key])
+            self._edges[node].add((who, key))
+            return str(self._resolve(who, key))
 
-        return re.sub(INTERP_PAT, replacer, what)
+        return INTERP_RE.sub(replacer, what)
 
     def _process_special(self, who, key):
         if who and who.lower() in ['auto']:
             if key not in self.auto_specials:
                 raise KeyError("Unknown auto key %r" % (key))
-            functor = self.auto_specials[key]
-            return (True, functor())
+            if key not in self._auto_values:
+                self._auto_values[key] = self.auto_specials[key]()
+            return (True, self._auto_values[key])
         return (False, None)
 
-    def _include_string(self, what):
-        if not re.search(INTERP_PAT, what):
-            # Leave it alone if the sub won't do
-            # anything to begin with
-            return what
-
-        def replacer(match):
-            who = match.group(1).strip()
-            key = match.group(2).strip()
-            (is_special, special_value) = self._process_special(who, key)
-            if is_special:
-                return special_value
-            # Process there includes and then
-            # fetch the value that should have been
-            # populated
-            self._process_includes(who)
-            return str(self.included[who][key])
-
-        return re.sub(INTERP_PAT, replacer, what)
-
-    def _do_include(self, value):
-        new_value = value
-        if value and isinstance(value, (basestring, str)):
-            new_value = self._include_string(value)
-        elif isinstance(value, (dict)):
-            new_value = self._include_dictionary(value)
-        elif isinstance(value, (list, set, tuple)):
-            new_value = self._include_iterable(value)
-        return new_value
-
     def _process_includes(self, root):
         if root in self.included:
             return
@@ -261,15 +232,64 @@ class YamlInterpolator(object):
         if not sh.isfile(pth):
             self.included[root] = {}
             return
-        self.included[root] = utils.load_yaml(pth)
-        self.included[root] = self._do_include(self.included[root])
+        self.included[root] = utils.load_yaml(pth) or {}
+
+    def _resolve(self, who, key):
+        node = (who, key)
+        if node in self._resolved:
+            return self._resolved[node]
+        if node in self._resolving:
+            cycle = self._resolving[self._resolving.index(node):] + [node]
+            raise excp.ConfigException("Unable to interpolate cyclic references: %s"
+                                       % (" -> ".join(["$(%s:%s)" % (w, k) for (w, k) in cycle])))
+        self._process_includes(who)
+        value = self.included[who][key]
+        self._resolving.append(node)
+        self._edges.setdefault(node, set())
+        try:
+            self._resolved[node] = self._interpolate(value, node)
+        finally:
+            self._resolving.pop()
+        return self._resolved[node]
+
+    def auto_values(self):
+        """Returns all the auto values (finding them if not already found)."""
+        values = {}
+        for key in sorted(self.auto_specials):
+            (_is_special, values[key]) = self._process_special('auto', key)
+        return values
+
+    def update(self, interpolated):
+        """Adds yamls that were already interpolated (by a previous run)."""
+        self.interpolated.update(interpolated)
+
+    def dependencies(self, who, key=None):
+        """
+        Returns the (who, key) references the given key of the given yaml
+        depends on (directly or indirectly); when no key is given the
+        references of all of that yamls (already extracted) keys are returned.
+        """
+        if key is None:
+            todo = [node for node in self._edges if node[0] == who]
+        else:
+            todo = [(who, key)]
+        found = set()
+        while todo:
+            node = todo.pop()
+            for dep in self._edges.get(node, []):
+                if dep not in found:
+                    found.add(dep)
+                    todo.append(dep)
+        return found
 
     def extract(self, root):
         if root in self.interpolated:
             return self.interpolated[root]
         self._process_includes(root)
-        self.interpolated[root] = self.included[root]
-        self.interpolated[root] = self._interpolate(self.interpolated[root])
+        interpolated = {}
+        for key in self.included[root]:
+            interpolated[key] = self._resolve(root, key)
+        self.interpolated[root] = interpolated
         return self.interpolated[root]
 
 
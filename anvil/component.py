@@ -16,6 +16,7 @@
 
 from anvil import exceptions as excp
 from anvil import log as logging
+from anvil import shell as sh
 from anvil import type_utils as tu
 from anvil import utils
 
@@ -76,6 +77,14 @@ class Component(object):
     def env_exports(self):
         return {}
 
+    @property
+    def mirror_stats_fn(self):
+        # Where how mirrors did (when downloading from them) is remembered
+        stats_fn = self.get_option('mirror_stats_file')
+        if not stats_fn:
+            stats_fn = sh.joinpths(self.get_option('root_dir'), 'mirrors.yaml')
+        return stats_fn
+
     def verify(self):
         pass
 
@@ -31,6 +31,8 @@
 #    under the License.
 
 import functools
+import hashlib
+import json
 import os
 import re
 import weakref
@@ -47,15 +49,19 @@ from anvil import packager
 from anvil import patcher
 from anvil import shell as sh
 from anvil import trace as tr
+from anvil import type_utils as tu
 from anvil import utils
 
 from anvil.packaging import pip
-from anvil.packaging import yum
 
 from anvil.packaging.helpers import pip_helper
+from anvil.packaging.helpers import wheelhouse as wh
 
 LOG = logging.getLogger(__name__)
 
+# Only needed (and slow to import) when installing using yum
+yum = importer.lazy_import('anvil.packaging.yum')
+
 ####
 #### Utils...
 ####
@@ -63,6 +69,32 @@ LOG = logging.getLogger(__name__)
 # Cache of accessed packagers
 _PACKAGERS = {}
 
+# What each config file was made from (and what was made) is remembered
+# in here so that configuring again can skip the ones that did not change
+CONFIG_DIGESTS_FN = 'config-digests.yaml'
+
+# The config files that changed (and the programs that use them) since
+# those programs were last started
+CONFIG_CHANGES_FN = 'config-changes.yaml'
+
+
+def _load_config_state(trace_dir, name):
+    fn = sh.joinpths(trace_dir, name)
+    if not sh.isfile(fn):
+        return {}
+    try:
+        state = utils.load_yaml_text(sh.load_file(fn))
+    except utils.yaml.YAMLError as e:
+        LOG.warn("Ignoring unreadable config state in %s: %s", colorizer.quote(fn), e)
+        return {}
+    if not isinstance(state, dict):
+        return {}
+    return state
+
+
+def _save_config_state(trace_dir, name, state):
+    sh.write_file(sh.joinpths(trace_dir, name), utils.prettify_yaml(state), quiet=True)
+
 
 def make_packager(package, default_class, **kwargs):
     packager_name = package.get('packager_name') or ''
@@ -78,6 +110,83 @@ def make_packager(package, default_class, **kwargs):
     return p
 
 
+class PipResolver(object):
+    """Indexes the pips and pip->package mappings of a set of components.
+
+    All the entries are parsed (once) and indexed by requirement key so
+    that finding who can satisfy a pip requirement is a lookup instead of a
+    scan over every component (which is left for the caller to filter by
+    which components are visible to it).
+    """
+
+    def __init__(self, instances):
+        self.instances = instances
+        self._pips_to_packages = None
+        self._pips = None
+        self._auto_matched = {}
+
+    def _build(self):
+        pips_to_packages = {}
+        pips = {}
+        for (name, c) in self.instances.items():
+            if not isinstance(c, (PythonInstallComponent)):
+                continue
+            for pip_info in c.pips_to_packages:
+                there_pip = pip.extract_requirement(pip_info)
+                pips_to_packages.setdefault(there_pip.key, []).append((name, there_pip, pip_info))
+            for pip_info in c._base_pips():  # pylint: disable=W0212
+                there_pip = pip.extract_requirement(pip_info)
+                pips.setdefault(there_pip.key, []).append((name, there_pip, pip_info))
+        self._pips_to_packages = pips_to_packages
+        self._pips = pips
+
+    def pips_to_packages(self, key):
+        if self._pips_to_packages is None:
+            self._build()
+        return self._pips_to_packages.get(key, [])
+
+    def pips(self, key):
+        if self._pips is None:
+            self._build()
+        return self._pips.get(key, [])
+
+    def auto_match(self, pip_req, matcher):
+        # The distro package that matches a pip does not depend on which
+        # component is asking so only ask the (slow) matcher once...
+        cache_key = str(pip_req)
+        if cache_key not in self._auto_matched:
+            self._auto_matched[cache_key] = matcher(pip_req)
+        return self._auto_matched[cache_key]
+
+
+# Cache of pip resolvers (one per set of component instances)
+_RESOLVERS = {}
+
+
+def get_pip_resolver(instances):
+    # The resolver keeps a reference to the instances it was made for so
+    # the id of those instances can not be reused while it is cached.
+    resolver = _RESOLVERS.get(id(instances))
+    if resolver is None or resolver.instances is not instances:
+        resolver = PipResolver(instances)
+        _RESOLVERS[id(instances)] = resolver
+    return resolver
+
+
+def group_by_packager(pkgs, default_class, **kwargs):
+    # Split the packages into consecutive runs that share the same packager
+    # (preserving the original ordering) so that a packager can act on a
+    # whole run at once instead of one package at a time.
+    runs = []
+    for p in pkgs:
+        packager = make_packager(p, default_class, **kwargs)
+        if runs and runs[-1][0] is packager:
+            runs[-1][1].append(p)
+        else:
+            runs.append((packager, [p]))
+    return runs
+
+
 # Remove any private keys from a package dictionary
 def filter_package(pkg):
     n_pkg = {}
@@ -98,6 +207,12 @@ class PkgInstallComponent(component.Component):
         component.Component.__init__(self, *args, **kargs)
         trace_fn = tr.trace_filename(self.get_option('trace_dir'), 'created')
         self.tracewriter = tr.TraceWriter(trace_fn, break_if_there=False)
+        # Set (by the install action) when what all components need
+        # has been pre-solved (and verified) all at once, the versions
+        # it selected are then the ones installed
+        self.solution = None
+        # Whether the last download changed the source (none if unknown)
+        self.source_changed = None
 
     def _get_download_config(self):
         return None
@@ -124,13 +239,24 @@ class PkgInstallComponent(component.Component):
             # This is used to delete what is downloaded (done before
             # fetching to ensure its cleaned up even on download failures)
             self.tracewriter.download_happened(target_dir, from_uri)
-            fetcher = down.GitDownloader(self.distro, from_uri, target_dir)
-            fetcher.download()
+            mirror_dir = None
+            if self.get_bool_option('use_git_mirror'):
+                mirror_dir = self.get_option('git_mirror_dir')
+                if not mirror_dir:
+                    mirror_dir = sh.joinpths(self.get_option('root_dir'), 'git-mirrors')
+            fetcher = down.GitDownloader(self.distro, from_uri, target_dir,
+                                         mirror_dir=mirror_dir,
+                                         shallow=self.get_bool_option('git_shallow'),
+                                         depth=self.get_int_option('git_depth', default_value=1),
+                                         update=self.get_bool_option('git_update'),
+                                         keep_local_changes=self.get_bool_option('git_keep_local_changes',
+                                                                                 default_value=True))
+            self.source_changed = fetcher.download()
             return uris
 
     def patch(self, section):
         what_patches = self.get_option('patches', section)
-        (_from_uri, target_dir) = self._get_download_location()
+        (from_uri, target_dir) = self._get_download_location()
         if not what_patches:
             what_patches = []
         canon_what_patches = []
@@ -141,6 +267,9 @@ class PkgInstallComponent(component.Component):
                 canon_what_patches.append(path)
         if canon_what_patches:
             patcher.apply_patches(canon_what_patches, target_dir)
+            if target_dir and sh.isdir(sh.joinpths(target_dir, '.git')):
+                # So that updating the checkout knows these changes are ours
+                down.GitDownloader(self.distro, from_uri, target_dir).remember_patched()
 
     def config_params(self, config_fn):
         mp = dict(self.params)
@@ -157,7 +286,12 @@ class PkgInstallComponent(component.Component):
             if 'packages' in values:
                 LOG.debug("Extending package list with packages for subsystem: %r", name)
                 pkg_list.extend(values.get('packages'))
-        return pkg_list
+        return self._pin_packages(pkg_list)
+
+    def _pin_packages(self, pkg_list):
+        if self.solution is None:
+            return pkg_list
+        return [self.solution.pin_package(p) for p in pkg_list]
 
     def install(self):
         LOG.debug('Preparing to install packages for: %r', self.name)
@@ -218,19 +352,73 @@ class PkgInstallComponent(component.Component):
     def _config_param_replace(self, config_fn, contents, parameters):
         return utils.expand_template(contents, parameters)
 
+    def config_programs(self, config_fn):
+        # The names of the programs that read the given config file (and
+        # so need restarting when it changes), empty meaning all of them
+        return []
+
+    def config_skippable(self, config_fn):
+        # Whether making the given config file can be skipped when what it is
+        # made from is unchanged, files whose adjusting also does other work
+        # (ie making directories) or looks at the host should not be skipped
+        return True
+
+    def _config_digest(self, config_fn, contents, parameters):
+        # Everything the config file is made from (the source contents, the
+        # parameters, the options and passwords the adjusters look at); when
+        # none of it changes then neither does what is made from it
+        inputs = {
+            'component': tu.obj_name(self),
+            'config_fn': config_fn,
+            'source': hashlib.sha1(contents).hexdigest(),
+            'parameters': parameters,
+            'options': self.options,
+            'passwords': self.passwords,
+        }
+        return hashlib.sha1(json.dumps(inputs, sort_keys=True, default=str)).hexdigest()
+
+    def _config_unchanged(self, tgt_fn, digest, previous):
+        if not previous or previous.get('inputs') != digest:
+            return False
+        # Someone may have edited (or removed) it since it was made
+        if not sh.isfile(tgt_fn):
+            return False
+        return hashlib.sha1(sh.load_file(tgt_fn)).hexdigest() == previous.get('made')
+
     def _configure_files(self):
         config_fns = self.config_files
         if config_fns:
             utils.log_iterable(config_fns, logger=LOG,
                                header="Configuring %s files" % (len(config_fns)))
+            trace_dir = self.get_option('trace_dir')
+            digests = _load_config_state(trace_dir, CONFIG_DIGESTS_FN)
+            changes = _load_config_state(trace_dir, CONFIG_CHANGES_FN)
             for fn in config_fns:
                 tgt_fn = self.target_config(fn)
                 sh.mkdirslist(sh.dirname(tgt_fn), tracewriter=self.tracewriter)
                 (source_fn, contents) = self.source_config(fn)
+                parameters = self.config_params(fn)
+                digest = self._config_digest(fn, contents, parameters)
+                previous = digests.get(tgt_fn)
+                if self.config_skippable(fn) and self._config_unchanged(tgt_fn, digest, previous):
+                    LOG.debug("Skipping configuring file %s since what it is made from is unchanged.", tgt_fn)
+                    continue
                 LOG.debug("Configuring file %s ---> %s.", (source_fn), (tgt_fn))
-                contents = self._config_param_replace(fn, contents, self.config_params(fn))
+                contents = self._config_param_replace(fn, contents, parameters)
                 contents = self._config_adjust(contents, fn)
+                made = hashlib.sha1(contents).hexdigest()
+                if not (previous and previous.get('made') == made and sh.isfile(tgt_fn)):
+                    changes[tgt_fn] = list(self.config_programs(fn))
                 sh.write_file(tgt_fn, contents, tracewriter=self.tracewriter)
+                digests[tgt_fn] = {
+                    'inputs': digest,
+                    'made': made,
+                }
+            _save_config_state(trace_dir, CONFIG_DIGESTS_FN, digests)
+            _save_config_state(trace_dir, CONFIG_CHANGES_FN, changes)
+            if changes:
+                utils.log_iterable(sorted(changes.keys()), logger=LOG,
+                                   header="Programs using %s changed config files will need restarting" % (len(changes)))
         return len(config_fns)
 
     def _configure_symlinks(self):
@@ -290,7 +478,7 @@ class PythonInstallComponent(PkgInstallComponent):
         pkg_list = super(PythonInstallComponent, self).packages
         if not pkg_list:
             pkg_list = []
-        pkg_list.extend(self._get_mapped_packages())
+        pkg_list.extend(self._pin_packages(self._get_mapped_packages()))
         return pkg_list
 
     @property
@@ -337,25 +525,29 @@ class PythonInstallComponent(PkgInstallComponent):
 
         LOG.debug("Attempting to find who satisfies pip requirement '%s'", pip_req)
 
+        def visible(entries):
+            # Only look at the ones that activate before me (and my own)
+            # since if they activate after, we can't depend on it
+            # to satisfy our requirement...
+            mine = []
+            others = []
+            for (who, there_pip, pip_info) in entries:
+                if who == self.name:
+                    mine.append((who, there_pip, pip_info))
+                else:
+                    c = self.instances.get(who)
+                    if c is not None and c.activated:
+                        others.append((who, there_pip, pip_info))
+            return mine + others
+
+        resolver = get_pip_resolver(self.instances)
+
         # Try to find it in anyones pip -> pkg list
-        all_pip_2_pkgs = {
-            self.name: self.pips_to_packages,
-        }
-        # Gather them all (but only if they activate before me)
-        # since if they activate after, we can't depend on it
-        # to satisfy our requirement...
-        for (name, c) in self.instances.items():
-            if c is self or not c.activated:
+        for (who, there_pip, pip_info) in visible(resolver.pips_to_packages(pip_req.key)):
+            if not pip_use(who, there_pip):
                 continue
-            if isinstance(c, (PythonInstallComponent)):
-                all_pip_2_pkgs[name] = c.pips_to_packages
-        for (who, pips_2_pkgs) in all_pip_2_pkgs.items():
-            for pip_info in pips_2_pkgs:
-                there_pip = pip.extract_requirement(pip_info)
-                if not pip_use(who, there_pip):
-                    continue
-                LOG.debug("Matched pip->pkg '%s' from component %r", there_pip, who)
-                return (dict(pip_info.get('package')), False)
+            LOG.debug("Matched pip->pkg '%s' from component %r", there_pip, who)
+            return (dict(pip_info.get('package')), False)
 
         # Ok nobody had it in there pip->pkg mapping
         # but now lets see if we can automatically find
@@ -364,35 +556,30 @@ class PythonInstallComponent(PkgInstallComponent):
         installer = make_packager({}, self.distro.package_manager_class,
                                   distro=self.distro)
         if installer and isinstance(installer, (yum.YumPackager)):
-            try:
-                rpm_pkg = installer.match_pip_2_package(pip_req)
-                if rpm_pkg:
-                    pkg_info = {
-                        'name': str(rpm_pkg.name),
-                        'version': str(rpm_pkg.version),
-                    }
-                    LOG.debug("Auto-matched %s -> %s", pip_req, rpm_pkg)
-                    return (pkg_info, False)
-            except yum.MultiplePackageSolutions as e:
-                LOG.warn("Unable to automatically map pip to package: %s", e)
+
+            def auto_match(req):
+                try:
+                    return installer.match_pip_2_package(req)
+                except yum.MultiplePackageSolutions as e:
+                    LOG.warn("Unable to automatically map pip to package: %s", e)
+                    return None
+
+            rpm_pkg = resolver.auto_match(pip_req, auto_match)
+            if rpm_pkg:
+                pkg_info = {
+                    'name': str(rpm_pkg.name),
+                    'version': str(rpm_pkg.version),
+                }
+                LOG.debug("Auto-matched %s -> %s", pip_req, rpm_pkg)
+                return (pkg_info, False)
 
         # Ok nobody had it in a pip->pkg mapping
         # but see if they had it in there pip collection
-        all_pips = {
-            self.name: self._base_pips(),  # Use base pips to avoid recursion...
-        }
-        for (name, c) in self.instances.items():
-            if not c.activated or c is self:
+        for (who, there_pip, pip_info) in visible(resolver.pips(pip_req.key)):
+            if not pip_use(who, there_pip):
                 continue
-            if isinstance(c, (PythonInstallComponent)):
-                all_pips[name] = c._base_pips()  # pylint: disable=W0212
-        for (who, there_pips) in all_pips.items():
-            for pip_info in there_pips:
-                there_pip = pip.extract_requirement(pip_info)
-                if not pip_use(who, there_pip):
-                    continue
-                LOG.debug("Matched pip '%s' from component %r", there_pip, who)
-                return (dict(pip_info), True)
+            LOG.debug("Matched pip '%s' from component %r", there_pip, who)
+            return (dict(pip_info), True)
 
         return (None, False)
 
@@ -438,22 +625,63 @@ class PythonInstallComponent(PkgInstallComponent):
     def pips(self):
         pip_list = self._base_pips()
         pip_list.extend(self._get_mapped_pips())
+        if self.solution is not None:
+            pip_list = [self.solution.pin_pip(p) for p in pip_list]
         return pip_list
 
+    @property
+    def wheelhouse(self):
+        if not self.get_bool_option('use_wheelhouse'):
+            return None
+        wheel_dir = self.get_option('wheelhouse_dir')
+        if not wheel_dir:
+            wheel_dir = sh.joinpths(self.get_option('root_dir'), 'wheelhouse')
+        return wh.Wheelhouse(self.distro, wheel_dir,
+                             max_workers=self.get_int_option('wheelhouse_workers', default_value=4),
+                             find_links=self.get_option('wheelhouse_find_links'))
+
+    def _wheel_pips(self, pips):
+        # Build whatever wheels are still missing (now that this components
+        # packages are installed those wheels may actually build) and point
+        # the pips that have a wheel at the wheelhouse.
+        wheelhouse = self.wheelhouse
+        if not wheelhouse or not pips:
+            return pips
+        wheelhouse.build([pip.extract_requirement(p) for p in pips])
+        wheeled_pips = []
+        for p in pips:
+            if wheelhouse.has_wheel(pip.extract_requirement(p)):
+                p = dict(p)
+                options = p.get('options') or []
+                if not isinstance(options, (list, tuple, set)):
+                    options = [options]
+                p['options'] = list(options) + wheelhouse.install_options()
+            wheeled_pips.append(p)
+        return wheeled_pips
+
     def _install_pips(self):
-        pips = self.pips
+        pips = self._wheel_pips(self.pips)
         if pips:
             pip_names = [p['name'] for p in pips]
             utils.log_iterable(pip_names, logger=LOG,
                                header="Setting up %s python packages" % (len(pip_names)))
+            batch = self.get_bool_option('batch_pips', default_value=True)
             with utils.progress_bar('Installing', len(pips)) as p_bar:
-                for (i, p) in enumerate(pips):
-                    installer = make_packager(p, pip.Packager,
-                                              distro=self.distro)
-                    installer.install(p)
-                    # Note that we did it so that we can remove it...
-                    self.tracewriter.pip_installed(filter_package(p))
-                    p_bar.update(i + 1)
+                done = 0
+                for (installer, run_pips) in group_by_packager(pips, pip.Packager, distro=self.distro):
+                    if batch and isinstance(installer, pip.Packager):
+                        # Note that these are being done before doing them so
+                        # that whatever gets installed (even if the batch fails
+                        # part way through) can be removed...
+                        for p in run_pips:
+                            self.tracewriter.pip_installed(filter_package(p))
+                        installer.install_batch(run_pips)
+                    else:
+                        for p in run_pips:
+                            installer.install(p)
+                            self.tracewriter.pip_installed(filter_package(p))
+                    done += len(run_pips)
+                    p_bar.update(done)
 
     def _clean_pip_requires(self):
         # Fixup these files if they exist, sometimes they have 'junk' in them
@@ -534,6 +762,10 @@ class PythonInstallComponent(PkgInstallComponent):
         return matchings
 
     def _verify_pip_requires(self):
+        if self.solution is not None:
+            # Already verified (along with every other components
+            # requirements) when the solution was made...
+            return
         all_pips = self.pip_requires
         for details in all_pips:
             req = details['requirement']
@@ -607,6 +839,41 @@ class ProgramRuntime(component.Component):
         # How many applications restarted
         return 0
 
+    def restart_changed(self):
+        """
+        Restarts the programs whose config files changed since those
+        programs were last started (returning how many were restarted).
+        """
+        changed = self.changed_programs()
+        if not changed:
+            return 0
+        amount_restarted = self._restart_programs(changed)
+        if amount_restarted:
+            self._configs_applied()
+        return amount_restarted
+
+    def _restart_programs(self, names):
+        # Runtimes that can not restart single programs restart them all
+        return self.restart()
+
+    def _configs_applied(self):
+        # What the programs were (re)started with is now the latest config
+        sh.unlink(sh.joinpths(self.get_option('trace_dir'), CONFIG_CHANGES_FN))
+
+    def changed_programs(self):
+        """
+        Returns the names of the programs whose config files changed (when
+        configuring) since those programs were last started.
+        """
+        changes = _load_config_state(self.get_option('trace_dir'), CONFIG_CHANGES_FN)
+        if not changes:
+            return []
+        all_names = [program.name for program in self.applications]
+        names = set()
+        for programs in changes.values():
+            names.update(programs or all_names)
+        return sorted(names)
+
     def post_start(self):
         pass
 
@@ -626,6 +893,10 @@ class ProgramRuntime(component.Component):
         # How many applications stopped
         return 0
 
+    def scrub(self):
+        # How many corrupt cached items (downloaded images...) were removed
+        return 0
+
     # TODO(harlowja): seems like this could be a mixin?
     def wait_active(self, between_wait=1, max_attempts=5):
         # Attempt to wait until all potentially started applications
@@ -698,9 +969,39 @@ class PythonRuntime(ProgramRuntime):
         for program in self.applications:
             self._start_app(program, starter)
             amount_started += 1
+        self._configs_applied()
         return amount_started
 
-    def _start_app(self, program, starter):
+    def restart(self):
+        amount_restarted = self._restart_programs([program.name for program in self.applications])
+        if amount_restarted:
+            self._configs_applied()
+        return amount_restarted
+
+    def _restart_programs(self, names):
+        # Only the programs that were started (and are wanted) get restarted
+        what_was_started = []
+        try:
+            what_was_started = self.tracereader.apps_started()
+        except excp.NoTraceException:
+            pass
+        programs = dict((program.name, program) for program in self.applications)
+        applications_restarted = []
+        for (name, handler) in self._locate_investigators(what_was_started):
+            if name not in names or name not in programs:
+                continue
+            handler.stop(name)
+            # The handler is the runner that started it, which has already
+            # been recorded (and stays the same) so it is not traced again
+            self._start_app(programs[name], handler, record=False)
+            applications_restarted.append(name)
+        if applications_restarted:
+            utils.log_iterable(applications_restarted,
+                               header="Restarted %s programs started under %s component" % (len(applications_restarted), self.name),
+                               logger=LOG)
+        return len(applications_restarted)
+
+    def _start_app(self, program, starter, record=True):
         app_working_dir = program.working_dir
         if not app_working_dir:
             app_working_dir = self.get_option('app_dir')
@@ -723,7 +1024,8 @@ class PythonRuntime(ProgramRuntime):
 
         # This trace is used to locate details about what/how to stop
         LOG.info("Started program %s under component %s.", colorizer.quote(program.name), self.name)
-        self.tracewriter.app_started(program.name, details_path, starter.name)
+        if record:
+            self.tracewriter.app_started(program.name, details_path, starter.name)
 
     def _locate_investigators(self, applications_started):
         # Recreate the runners that can be used to dive deeper into the applications list
@@ -880,20 +1182,33 @@ class PythonUninstallComponent(PkgUninstallComponent):
             utils.log_iterable(pip_names, logger=LOG,
                                header="Potentially removing %s python packages" % (len(pip_names)))
             which_removed = []
+            batch = self.get_bool_option('batch_pips', default_value=True)
+
+            def remove_pips(uninstaller, run_pips):
+                try:
+                    if batch and isinstance(uninstaller, pip.Packager):
+                        return [p['name'] for p in uninstaller.remove_batch(run_pips)]
+                    elif uninstaller.remove(run_pips[0]):
+                        return [run_pips[0]['name']]
+                except excp.ProcessExecutionError as e:
+                    # NOTE(harlowja): pip seems to die if a pkg isn't there even in quiet mode
+                    combined = (str(e.stderr) + str(e.stdout))
+                    if not re.search(r"not\s+installed", combined, re.I):
+                        raise
+                return []
+
             with utils.progress_bar('Uninstalling', len(pips), reverse=True) as p_bar:
-                for (i, p) in enumerate(pips):
-                    try:
-                        uninstaller = make_packager(p, pip.Packager,
-                                                    distro=self.distro,
-                                                    remove_default=self.purge_packages)
-                        if uninstaller.remove(p):
-                            which_removed.append(p['name'])
-                    except excp.ProcessExecutionError as e:
-                        # NOTE(harlowja): pip seems to die if a pkg isn't there even in quiet mode
-                        combined = (str(e.stderr) + str(e.stdout))
-                        if not re.search(r"not\s+installed", combined, re.I):
-                            raise
-                    p_bar.update(i + 1)
+                done = 0
+                for (uninstaller, run_pips) in group_by_packager(pips, pip.Packager,
+                                                                 distro=self.distro,
+                                                                 remove_default=self.purge_packages):
+                    if batch and isinstance(uninstaller, pip.Packager):
+                        which_removed.extend(remove_pips(uninstaller, run_pips))
+                    else:
+                        for p in run_pips:
+                            which_removed.extend(remove_pips(uninstaller, [p]))
+                    done += len(run_pips)
+                    p_bar.update(done)
             utils.log_iterable(which_removed, logger=LOG,
                                header="Actually removed %s python packages" % (len(which_removed)))
 
@@ -157,6 +157,7 @@ class DBRuntime(comp.ProgramRuntime):
     def start(self):
         if self.statii()[0].status != comp.STATUS_STARTED:
             self._run_action('start')
+            self._configs_applied()
             return 1
         else:
             return 0
@@ -171,6 +172,7 @@ class DBRuntime(comp.ProgramRuntime):
     def restart(self):
         LOG.info("Restarting your database.")
         self._run_action('restart')
+        self._configs_applied()
         return 1
 
     def statii(self):
@@ -179,6 +179,20 @@ class GlanceInstaller(comp.PythonInstallComponent):
         else:
             return comp.PythonInstallComponent._config_param_replace(self, config_fn, contents, parameters)
 
+    def config_programs(self, config_fn):
+        if config_fn in [API_CONF, API_PASTE_CONF]:
+            return ['glance-api']
+        elif config_fn in [REG_CONF, REG_PASTE_CONF]:
+            return ['glance-registry']
+        else:
+            return comp.PythonInstallComponent.config_programs(self, config_fn)
+
+    def config_skippable(self, config_fn):
+        # Adjusting the api config also resets the image store directory
+        if config_fn == API_CONF:
+            return False
+        return comp.PythonInstallComponent.config_skippable(self, config_fn)
+
     def _config_adjust(self, contents, name):
         if name in [REG_CONF, API_CONF]:
             return self._config_adjust_api_reg(contents, name)
@@ -222,8 +236,23 @@ class GlanceRuntime(comp.PythonRuntime):
             return []
 
     def _get_image_urls(self):
-        uris = self.get_option('image_urls', default_value=[])
-        return [u.strip() for u in uris if len(u.strip())]
+        uris = []
+        for u in self.get_option('image_urls', default_value=[]):
+            # A list is a list of mirrors of the same image
+            if isinstance(u, (list, tuple)):
+                mirrors = [m.strip() for m in u if len(m.strip())]
+                if mirrors:
+                    uris.append(mirrors)
+            elif len(u.strip()):
+                uris.append(u.strip())
+        return uris
+
+    def _get_image_cache_dir(self):
+        return self.get_option('image_cache_dir') or ghelper.DEF_CACHE_DIR
+
+    def scrub(self):
+        removed = ghelper.ImageCache(self._get_image_cache_dir()).scrub()
+        return len(removed)
 
     def post_start(self):
         comp.PythonRuntime.post_start(self)
@@ -236,9 +265,13 @@ class GlanceRuntime(comp.PythonRuntime):
                                                            service_user='glance',
                                                            **utils.merge_dicts(self.get_option('keystone'),
                                                                                khelper.get_shared_passwords(self)))
-            cache_dir = self.get_option('image_cache_dir')
-            if cache_dir:
-                params['cache_dir'] = cache_dir
+            params['cache_dir'] = self._get_image_cache_dir()
+            params['cache_max_bytes'] = self.get_int_option('image_cache_max_mb', default_value=0) * 1024 * 1024
+            params['download_segments'] = self.get_int_option('image_download_segments', default_value=1)
+            params['mirror_stats_fn'] = self.mirror_stats_fn
+            params['convert_qcow2'] = self.get_bool_option('image_convert_qcow2')
+            params['max_uploads'] = self.get_int_option('image_max_uploads', default_value=2)
+            params['filter_by_name'] = self.get_bool_option('image_filter_by_name')
             ghelper.UploadService(**params).install(self._get_image_urls())
 
 
@@ -14,15 +14,21 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import Queue
 import contextlib
 import hashlib
 import os
 import re
+import subprocess
+import sys
 import tarfile
+import threading
+import time
 import urlparse
 
 from anvil import colorizer
 from anvil import downloader as down
+from anvil import exceptions as excp
 from anvil import importer
 from anvil import log
 from anvil import shell as sh
@@ -45,6 +51,9 @@ NAME_CLEANUPS = [
 NAME_CLEANUPS.sort()
 NAME_CLEANUPS.reverse()
 
+# Where downloaded images (and details about them) are cached by default
+DEF_CACHE_DIR = '/usr/share/anvil/glance/cache'
+
 # Used to match various file names with what could be a kernel image
 KERNEL_CHECKS = [
     re.compile(r"(.*)vmlinuz(.*)$", re.I),
@@ -74,6 +83,19 @@ SKIP_CHECKS = [
 # File extensions we will skip over (typically of content hashes)
 BAD_EXTENSIONS = ['md5', 'sha', 'sfv']
 
+# Decompressors (that use all the cpus) which are used (when installed)
+# to decompress archives instead of decompressing them in process
+PARALLEL_DECOMPRESSORS = {
+    '.bz2': ['pbzip2', '-d', '-c'],
+    '.gz': ['pigz', '-d', '-c'],
+    '.gzip': ['pigz', '-d', '-c'],
+    '.tgz': ['pigz', '-d', '-c'],
+}
+
+
+# Disk formats that can be converted to (compressed) qcow2 images
+QCOW2_CONVERTIBLE = ['raw', 'ami']
+
 
 def _hash_it(content, hash_algo='md5'):
     hasher = hashlib.new(hash_algo)
@@ -82,17 +104,190 @@ def _hash_it(content, hash_algo='md5'):
     return digest
 
 
-class Unpacker(object):
+def _hash_file(path, hash_algo='md5', chunk_size=1024 * 1024):
+    hasher = hashlib.new(hash_algo)
+    with open(path, 'rb') as fh:
+        while True:
+            data = fh.read(chunk_size)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def _disk_usage(path):
+    # Blocks actually used (images are sparse, so sizes would overcount)
+    if sh.isfile(path):
+        return os.lstat(path).st_blocks * 512
+    used = 0
+    for (root, _dirs, files) in os.walk(path):
+        for fn in files:
+            try:
+                used += os.lstat(os.path.join(root, fn)).st_blocks * 512
+            except OSError:
+                pass
+    return used
 
-    def _get_tar_file_members(self, arc_fn):
-        LOG.info("Finding what exists in %s.", colorizer.quote(arc_fn))
-        files = []
-        with contextlib.closing(tarfile.open(arc_fn, 'r')) as tfh:
-            for tmemb in tfh.getmembers():
-                if not tmemb.isfile():
-                    continue
-                files.append(tmemb.name)
-        return files
+
+def _image_pieces(details):
+    pieces = [details]
+    for kind in ['kernel', 'ramdisk']:
+        if details.get(kind):
+            pieces.append(details[kind])
+    return pieces
+
+
+class ImageCache(object):
+    """
+    Downloaded (and unpacked) images, each stored in a directory named by
+    the md5 of its url along with a details file that describes what is in
+    that directory.
+
+    An entry is only valid once its details file exists, that file is removed
+    before an entry is (re)populated and is only written (atomically) once
+    populating has completed so that entries being populated when anvil
+    crashed (or was interrupted) never look valid (although what they
+    downloaded so far can still be resumed from). The details also record
+    when an entry was last used so that the least recently used entries can
+    be evicted to keep the cache within a byte budget.
+    """
+
+    def __init__(self, cache_dir, max_bytes=0):
+        self.cache_dir = cache_dir
+        self.max_bytes = max(0, int(max_bytes))
+
+    def paths(self, url):
+        digest = _hash_it(url)
+        path = sh.joinpths(self.cache_dir, digest)
+        details_path = sh.joinpths(self.cache_dir, digest + ".details")
+        return (path, details_path)
+
+    def _read_details(self, details_path):
+        try:
+            details = utils.load_yaml_text(sh.load_file(details_path))
+        except Exception:
+            return None
+        if not isinstance(details, dict) or not details.get('file_name'):
+            return None
+        return details
+
+    def _is_intact(self, details, verify=False):
+        for piece in _image_pieces(details):
+            fn = piece.get('file_name')
+            if not fn or not sh.isfile(fn):
+                return False
+            if piece.get('size') is not None and os.path.getsize(fn) != piece['size']:
+                return False
+            if verify and piece.get('checksum') and _hash_file(fn) != piece['checksum']:
+                return False
+        return True
+
+    def load(self, url):
+        """Returns the details of the cached image for url (or None if not valid)."""
+        (cache_path, details_path) = self.paths(url)
+        if not sh.isdir(cache_path) or not sh.isfile(details_path):
+            return None
+        details = self._read_details(details_path)
+        if not details or not self._is_intact(details):
+            return None
+        self.save(url, details)
+        return details
+
+    def begin(self, url):
+        """Starts (re)populating the entry for url, returning the directory to populate."""
+        (cache_path, details_path) = self.paths(url)
+        sh.unlink(details_path)
+        sh.mkdir(cache_path)
+        return cache_path
+
+    def save(self, url, details):
+        """Saves (atomically) the details of the entry for url, making it valid."""
+        (_cache_path, details_path) = self.paths(url)
+        details['last_used'] = time.time()
+        tmp_path = "%s.tmp" % (details_path)
+        sh.write_file(tmp_path, utils.prettify_yaml(details))
+        sh.move(tmp_path, details_path)
+        return details
+
+    def _remove(self, cache_path, details_path):
+        # Invalidate it first (so that it never looks valid while half-removed)
+        sh.unlink(details_path)
+        sh.deldir(cache_path)
+
+    def _entries(self):
+        entries = []
+        if not sh.isdir(self.cache_dir):
+            return entries
+        for name in os.listdir(self.cache_dir):
+            cache_path = sh.joinpths(self.cache_dir, name)
+            if not sh.isdir(cache_path):
+                continue
+            details_path = cache_path + ".details"
+            details = None
+            if sh.isfile(details_path):
+                details = self._read_details(details_path)
+            last_used = None
+            if details:
+                last_used = details.get('last_used')
+            if last_used is None:
+                last_used = os.path.getmtime(cache_path)
+            size = _disk_usage(cache_path)
+            if sh.isfile(details_path):
+                size += _disk_usage(details_path)
+            entries.append((last_used, cache_path, details_path, details, size))
+        entries.sort(key=lambda entry: entry[0])
+        return entries
+
+    def evict(self, keep_urls=None):
+        """
+        Removes the least recently used entries until the cache is within
+        its byte budget (entries of the urls to keep are never removed, even
+        if that means the cache stays over its budget).
+        """
+        if not self.max_bytes:
+            return []
+        keep_paths = set()
+        for url in keep_urls or []:
+            keep_paths.add(self.paths(url)[0])
+        entries = self._entries()
+        total = sum([entry[-1] for entry in entries])
+        removed = []
+        for (_last_used, cache_path, details_path, _details, size) in entries:
+            if total <= self.max_bytes:
+                break
+            if cache_path in keep_paths:
+                continue
+            self._remove(cache_path, details_path)
+            total -= size
+            removed.append(cache_path)
+        if removed:
+            utils.log_iterable(removed, logger=LOG,
+                               header="Evicted %s least recently used cached images (to stay within %s bytes)"
+                                      % (len(removed), self.max_bytes))
+        return removed
+
+    def scrub(self, max_workers=2):
+        """
+        Verifies (in parallel) the checksums of all the cached images and
+        removes the entries that are corrupt, returning the removed entries.
+        """
+        entries = [entry for entry in self._entries() if entry[3]]
+        if not entries:
+            return []
+        LOG.info("Verifying the checksums of %s cached images in %s.", len(entries), colorizer.quote(self.cache_dir))
+        verified = utils.run_in_parallel(lambda entry: self._is_intact(entry[3], verify=True),
+                                         entries, max_workers)
+        removed = []
+        for ((_last_used, cache_path, details_path, _details, _size), intact, exc_info) in verified:
+            if intact and not exc_info:
+                continue
+            LOG.warn("Removing corrupt cached image %s.", colorizer.quote(cache_path))
+            self._remove(cache_path, details_path)
+            removed.append(cache_path)
+        return removed
+
+
+class Unpacker(object):
 
     def _pat_checker(self, fn, patterns):
         (_root_fn, fn_ext) = os.path.splitext(fn)
@@ -130,11 +325,47 @@ class Unpacker(object):
 
         return (img_fn, ramdisk_fn, kernel_fn)
 
+    def _classify(self, fn):
+        # Same matching (and order) as _find_pieces but for a single file
+        if self._pat_checker(fn, SKIP_CHECKS):
+            return None
+        if self._pat_checker(fn, KERNEL_CHECKS):
+            return 'kernel'
+        elif self._pat_checker(fn, RAMDISK_CHECKS):
+            return 'ramdisk'
+        elif self._pat_checker(fn, ROOT_CHECKS):
+            return 'root'
+        return None
+
+    @contextlib.contextmanager
+    def _open_tar_stream(self, arc_fn):
+        (_root_fn, fn_ext) = os.path.splitext(arc_fn)
+        decompressor = PARALLEL_DECOMPRESSORS.get(fn_ext.lower())
+        if not decompressor or not sh.which(decompressor[0]):
+            with contextlib.closing(tarfile.open(arc_fn, 'r|*')) as tfh:
+                yield tfh
+            return
+        LOG.debug("Decompressing %s using %s.", arc_fn, decompressor[0])
+        cmd = decompressor + [arc_fn]
+        proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, close_fds=True)
+        try:
+            with contextlib.closing(tarfile.open(fileobj=proc.stdout, mode='r|')) as tfh:
+                yield tfh
+        finally:
+            proc.stdout.close()
+            rc = proc.wait()
+        if rc != 0:
+            raise IOError("Decompressing %r using %s failed with exit code %s" % (arc_fn, decompressor[0], rc))
+
     def _unpack_tar_member(self, tarhandle, member, output_location):
         LOG.info("Extracting %s to %s.", colorizer.quote(member.name), colorizer.quote(output_location))
         with contextlib.closing(tarhandle.extractfile(member)) as mfh:
             with open(output_location, "wb") as ofh:
-                return sh.pipe_in_out(mfh, ofh)
+                # Images are mostly zeros, leave holes for those instead (the
+                # checksum glance will have is found at the same time)
+                hasher = hashlib.md5()
+                size = sh.pipe_in_out(mfh, ofh, sparse=True, hasher=hasher)
+                return (hasher.hexdigest(), size)
 
     def _describe(self, root_fn, ramdisk_fn, kernel_fn):
         """
@@ -169,29 +400,50 @@ class Unpacker(object):
         return filtered
 
     def _unpack_tar(self, file_name, file_location, tmp_dir):
+        # The archive is read (and decompressed) only once, the pieces are
+        # found and extracted as they stream by (later matches replace
+        # earlier ones, the same as when the pieces are found up front).
         (root_name, _) = os.path.splitext(file_name)
-        tar_members = self._filter_files(self._get_tar_file_members(file_location))
-        (root_img_fn, ramdisk_fn, kernel_fn) = self._find_pieces(tar_members, file_location)
-        if not root_img_fn:
+        extract_dir = sh.mkdir(sh.joinpths(tmp_dir, root_name))
+        LOG.info("Extracting the kernel/ramdisk/root images from %s.", colorizer.quote(file_location))
+        found = {}
+        sums = {}
+        seen = []
+        with self._open_tar_stream(file_location) as tfh:
+            for m in tfh:
+                if not m.isfile():
+                    continue
+                seen.append(m.name)
+                kind = self._classify(m.name)
+                if not kind:
+                    LOG.debug("Unknown member %r - skipping" % (m.name))
+                    continue
+                real_fn = sh.joinpths(extract_dir, sh.basename(m.name))
+                if kind in found and found[kind][1] != real_fn:
+                    sh.unlink(found[kind][1])
+                (checksum, size) = self._unpack_tar_member(tfh, m, real_fn)
+                found[kind] = (m.name, real_fn)
+                sums[kind] = (checksum, size)
+        utils.log_iterable(seen, logger=LOG,
+              header="Looked at %s files from %s to find the kernel/ramdisk/root images" % (len(seen), colorizer.quote(file_location)))
+        if 'root' not in found:
             msg = "Tar file %r has no root image member" % (file_name)
             raise IOError(msg)
-        kernel_real_fn = None
-        root_real_fn = None
-        ramdisk_real_fn = None
-        self._log_pieces_found('archive', root_img_fn, ramdisk_fn, kernel_fn)
-        extract_dir = sh.mkdir(sh.joinpths(tmp_dir, root_name))
-        with contextlib.closing(tarfile.open(file_location, 'r')) as tfh:
-            for m in tfh.getmembers():
-                if m.name == root_img_fn:
-                    root_real_fn = sh.joinpths(extract_dir, sh.basename(root_img_fn))
-                    self._unpack_tar_member(tfh, m, root_real_fn)
-                elif ramdisk_fn and m.name == ramdisk_fn:
-                    ramdisk_real_fn = sh.joinpths(extract_dir, sh.basename(ramdisk_fn))
-                    self._unpack_tar_member(tfh, m, ramdisk_real_fn)
-                elif kernel_fn and m.name == kernel_fn:
-                    kernel_real_fn = sh.joinpths(extract_dir, sh.basename(kernel_fn))
-                    self._unpack_tar_member(tfh, m, kernel_real_fn)
-        return self._describe(root_real_fn, ramdisk_real_fn, kernel_real_fn)
+        pieces = {}
+        real_pieces = {}
+        for (kind, (name, real_fn)) in found.items():
+            pieces[kind] = name
+            real_pieces[kind] = real_fn
+        self._log_pieces_found('archive', pieces.get('root'), pieces.get('ramdisk'), pieces.get('kernel'))
+        info = self._describe(real_pieces.get('root'), real_pieces.get('ramdisk'), real_pieces.get('kernel'))
+        for (kind, (checksum, size)) in sums.items():
+            if kind == 'root':
+                piece_info = info
+            else:
+                piece_info = info[kind]
+            piece_info['checksum'] = checksum
+            piece_info['size'] = size
+        return info
 
     def _log_pieces_found(self, src_type, root_fn, ramdisk_fn, kernel_fn):
         pieces = []
@@ -244,100 +496,214 @@ class Unpacker(object):
 
 
 class Registry(object):
-
-    def __init__(self, client):
+    """
+    An index of the images glance has (by name and by checksum + size), which
+    is fetched once and then kept up to date as images are added (so it can
+    be shared by many images); when filtering by name each name (or size) is
+    instead looked up (once) by asking glance for only the matching images.
+    """
+
+    def __init__(self, client, filter_by_name=False):
         self.client = client
-
-    def _extract_names(self):
-        names = dict()
-        images = self.client.images.list()
-        for image in images:
-            name = image.name
-            names[name] = image.id
-        return names
+        self.filter_by_name = filter_by_name
+        self._names = None
+        self._checksums = dict()
+        # Checksums + sizes being uploaded (by someone sharing this registry)
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def _list_images(self, **kwargs):
+        images = []
+        for image in self.client.images.list(**kwargs):
+            images.append((image.name, image.id,
+                           getattr(image, 'checksum', None),
+                           getattr(image, 'size', None)))
+        return images
+
+    def _remember(self, name, image_id, checksum=None, size=None):
+        self._names[name] = image_id
+        if checksum and size is not None:
+            key = (checksum, int(size))
+            if self._checksums.get(key) is None:
+                self._checksums[key] = image_id
+
+    def _index(self):
+        if self._names is None:
+            self._names = dict()
+            if not self.filter_by_name:
+                for details in self._list_images():
+                    self._remember(*details)
+        return self._names
+
+    def _lookup(self, name):
+        names = self._index()
+        if self.filter_by_name and name not in names:
+            names[name] = None
+            for details in self._list_images(filters={'name': name}):
+                self._remember(*details)
+        return names.get(name)
+
+    def _find(self, checksum, size):
+        self._index()
+        key = (checksum, int(size))
+        if self.filter_by_name and key not in self._checksums:
+            self._checksums[key] = None
+            for details in self._list_images(filters={'size_min': size, 'size_max': size}):
+                self._remember(*details)
+        return self._checksums.get(key)
+
+    def get(self, name):
+        with self._lock:
+            return self._lookup(name)
+
+    def find(self, checksum, size, claim=False):
+        """
+        Returns the id of an image with the given checksum + size (or None),
+        waiting for any upload of the same checksum + size to finish first. When
+        claiming and none is found the caller is expected to upload it (others
+        will wait for that upload until the claim is released).
+        """
+        key = (checksum, int(size))
+        while True:
+            with self._lock:
+                image_id = self._find(checksum, size)
+                if image_id is not None:
+                    return image_id
+                pending = self._pending.get(key)
+                if pending is None:
+                    if claim:
+                        self._pending[key] = threading.Event()
+                    return None
+            pending.wait()
+
+    def release(self, checksum, size):
+        with self._lock:
+            pending = self._pending.pop((checksum, int(size)), None)
+        if pending is not None:
+            pending.set()
+
+    def add(self, name, image_id, checksum=None, size=None):
+        with self._lock:
+            self._index()
+            self._remember(name, image_id, checksum, size)
 
     def __contains__(self, name):
-        names = self._extract_names()
-        if name in names:
-            return True
-        else:
+        if self.get(name) is None:
             return False
+        else:
+            return True
 
 
 class Image(object):
 
-    def __init__(self, client, url, is_public, cache_dir):
+    def __init__(self, client, url, is_public, cache_dir, download_segments=1, mirror_stats_fn=None,
+                 convert_qcow2=False, upload_slots=None, registry=None, cache=None):
         self.client = client
-        self.registry = Registry(client)
-        self.url = url
-        self.parsed_url = urlparse.urlparse(url)
+        if registry is None:
+            registry = Registry(client)
+        self.registry = registry
+        # A list of urls are mirrors of the same image (the first one is
+        # what the image is named and cached by)
+        if isinstance(url, (list, tuple)):
+            self.urls = list(url)
+        else:
+            self.urls = [url]
+        self.url = self.urls[0]
+        self.parsed_url = urlparse.urlparse(self.url)
         self.is_public = is_public
         self.cache_dir = cache_dir
+        if cache is None:
+            cache = ImageCache(cache_dir)
+        self.cache = cache
+        self.download_segments = download_segments
+        self.mirror_stats_fn = mirror_stats_fn
+        self.convert_qcow2 = convert_qcow2
+        if upload_slots is None:
+            upload_slots = threading.BoundedSemaphore(1)
+        self.upload_slots = upload_slots
 
     def _check_name(self, name):
         LOG.info("Checking if image %s already exists already in glance.", colorizer.quote(name))
         if name in self.registry:
             raise IOError("Image named %s already exists." % (name))
 
-    def _register(self, image_name, location):
+    def _find_existing(self, name, info, claimed):
+        # Images glance already has (with the same contents) are reused
+        # instead of uploading the same bytes again (under a new name)
+        checksum = info.get('checksum')
+        size = info.get('size')
+        if checksum and size is not None and (checksum, size) not in claimed:
+            existing_id = self.registry.find(checksum, size, claim=True)
+            if existing_id is None:
+                claimed.append((checksum, size))
+            else:
+                LOG.info("Image %s already exists in glance with id %s (same checksum and size), reusing it.",
+                         colorizer.quote(name), colorizer.quote(existing_id))
+                return existing_id
+        self._check_name(name)
+        return None
 
-        # Upload the kernel, if we have one
-        kernel = location.pop('kernel', None)
-        kernel_id = ''
-        if kernel:
-            kernel_image_name = "%s-vmlinuz" % (image_name)
-            self._check_name(kernel_image_name)
-            LOG.info('Adding kernel %s to glance.', colorizer.quote(kernel_image_name))
-            LOG.info("Please wait installing...")
-            args = {
-                'container_format': kernel['container_format'],
-                'disk_format': kernel['disk_format'],
-                'name': kernel_image_name,
-                'is_public': self.is_public,
-            }
-            with open(kernel['file_name'], 'r') as fh:
+    def _upload(self, image_name, info, properties=None):
+        args = {
+            'name': image_name,
+            'container_format': info['container_format'],
+            'disk_format': info['disk_format'],
+            'is_public': self.is_public,
+        }
+        if properties is not None:
+            args['properties'] = properties
+        # Only so many uploads (across all images) are done at the same time
+        with self.upload_slots:
+            LOG.info("Please wait installing %s...", colorizer.quote(image_name))
+            with open(info['file_name'], 'r') as fh:
                 resource = self.client.images.create(data=fh, **args)
-                kernel_id = resource.id
+        self.registry.add(image_name, resource.id, info.get('checksum'), info.get('size'))
+        return resource.id
 
-        # Upload the ramdisk, if we have one
+    def _register(self, image_name, location):
+        pieces = []
+        kernel = location.pop('kernel', None)
+        if kernel:
+            pieces.append(('kernel', "%s-vmlinuz" % (image_name), kernel))
         initrd = location.pop('ramdisk', None)
-        initrd_id = ''
         if initrd:
-            ram_image_name = "%s-initrd" % (image_name)
-            self._check_name(ram_image_name)
-            LOG.info('Adding ramdisk %s to glance.', colorizer.quote(ram_image_name))
-            LOG.info("Please wait installing...")
-            args = {
-                'container_format': initrd['container_format'],
-                'disk_format': initrd['disk_format'],
-                'name': ram_image_name,
-                'is_public': self.is_public,
-            }
-            with open(initrd['file_name'], 'r') as fh:
-                resource = self.client.images.create(data=fh, **args)
-                initrd_id = resource.id
-
-        # Upload the root, we must have one...
+            pieces.append(('ramdisk', "%s-initrd" % (image_name), initrd))
+        claimed = []
+        try:
+            return self._register_pieces(image_name, location, pieces, claimed)
+        finally:
+            for (checksum, size) in claimed:
+                self.registry.release(checksum, size)
+
+    def _register_pieces(self, image_name, location, pieces, claimed):
+        piece_ids = {}
+        for (kind, name, info) in list(pieces):
+            existing_id = self._find_existing(name, info, claimed)
+            if existing_id is not None:
+                piece_ids[kind] = existing_id
+                pieces.remove((kind, name, info))
+        root_id = self._find_existing(image_name, location, claimed)
+        if root_id is not None:
+            return root_id
+
+        # Upload the kernel and ramdisk (if we have them) at the same time
+        if pieces:
+            utils.log_iterable([name for (_kind, name, _info) in pieces], logger=LOG,
+                               header="Adding %s images (for %s) to glance" % (len(pieces), colorizer.quote(image_name)))
+            uploaded = utils.run_in_parallel(lambda piece: self._upload(piece[1], piece[2]), pieces, len(pieces))
+            for ((kind, _name, _info), piece_id, exc_info) in uploaded:
+                if exc_info:
+                    raise exc_info[1]
+                piece_ids[kind] = piece_id
+
+        # Upload the root, we must have one (and it needs the others ids)...
         LOG.info('Adding image %s to glance.', colorizer.quote(image_name))
-        self._check_name(image_name)
-        args = {
-            'name': image_name,
-            'container_format': location['container_format'],
-            'disk_format': location['disk_format'],
-            'is_public': self.is_public,
-            'properties': {},
-        }
-        if kernel_id or initrd_id:
-            if kernel_id:
-                args['properties']['kernel_id'] = kernel_id
-            if initrd_id:
-                args['properties']['ramdisk_id'] = initrd_id
-        LOG.info("Please wait installing...")
-        with open(location['file_name'], 'r') as fh:
-            resource = self.client.images.create(data=fh, **args)
-            img_id = resource.id
-
-        return img_id
+        properties = {}
+        if piece_ids.get('kernel'):
+            properties['kernel_id'] = piece_ids['kernel']
+        if piece_ids.get('ramdisk'):
+            properties['ramdisk_id'] = piece_ids['ramdisk']
+        return self._upload(image_name, location, properties)
 
     def _generate_img_name(self, url_fn):
         name = url_fn
@@ -351,62 +717,127 @@ class Image(object):
     def _is_url_local(self):
         return (sh.exists(self.url) or (self.parsed_url.scheme == '' and self.parsed_url.netloc == ''))
 
-    def _cached_paths(self):
-        digest = _hash_it(self.url)
-        path = sh.joinpths(self.cache_dir, digest)
-        details_path = sh.joinpths(self.cache_dir, digest + ".details")
-        return (path, details_path)
-
-    def _validate_cache(self, cache_path, details_path):
-        for path in [cache_path, details_path]:
-            if not sh.exists(path):
-                return False
-        check_files = []
-        try:
-            unpack_info = utils.load_yaml_text(sh.load_file(details_path))
-            check_files.append(unpack_info['file_name'])
-            if 'kernel' in unpack_info:
-                check_files.append(unpack_info['kernel']['file_name'])
-            if 'ramdisk' in unpack_info:
-                check_files.append(unpack_info['ramdisk']['file_name'])
-        except Exception:
-            return False
-        for path in check_files:
-            if not sh.isfile(path):
-                return False
-        return True
+    def _convert(self, unpack_info, cache_path):
+        # Converts the root image into a compressed qcow2 image (which is
+        # typically a lot smaller to upload, store and later fetch), the
+        # converted image is cached (in the images cache directory) by the
+        # checksum of the image it was converted from.
+        if unpack_info.get('disk_format') not in QCOW2_CONVERTIBLE:
+            return unpack_info
+        qemu_img = sh.which('qemu-img')
+        if not qemu_img:
+            LOG.warn("Unable to convert %s to a qcow2 image, qemu-img was not found.",
+                     colorizer.quote(unpack_info['file_name']))
+            return unpack_info
+        root_fn = unpack_info['file_name']
+        LOG.info("Finding the checksum of %s (to see if it was already converted).", colorizer.quote(root_fn))
+        digest = unpack_info.get('checksum') or _hash_file(root_fn)
+        converted_fn = sh.joinpths(cache_path, "%s.qcow2" % (digest))
+        if not sh.isfile(converted_fn):
+            LOG.info("Converting %s to a compressed qcow2 image at %s.", colorizer.quote(root_fn),
+                     colorizer.quote(converted_fn))
+            tmp_fn = "%s.tmp" % (converted_fn)
+            try:
+                sh.execute(qemu_img, 'convert', '-c', '-f', 'raw', '-O', 'qcow2', root_fn, tmp_fn)
+            except excp.ProcessExecutionError as e:
+                sh.unlink(tmp_fn)
+                LOG.warn("Failed converting %s to a qcow2 image: %s", colorizer.quote(root_fn), e)
+                return unpack_info
+            # Only completed conversions ever show up in the cache
+            sh.move(tmp_fn, converted_fn)
+        converted_info = dict(unpack_info)
+        converted_info['file_name'] = converted_fn
+        converted_info['disk_format'] = 'qcow2'
+        converted_info['container_format'] = 'bare'
+        converted_info['checksum'] = _hash_file(converted_fn)
+        converted_info['size'] = os.path.getsize(converted_fn)
+        converted_info['converted_from'] = {
+            'file_name': root_fn,
+            'disk_format': unpack_info['disk_format'],
+            'container_format': unpack_info['container_format'],
+            'md5': digest,
+        }
+        return converted_info
+
+    def _add_checksums(self, unpack_info):
+        # Pieces extracted from archives were checksummed while extracting
+        # and plain image files while downloading (unless the download could
+        # not find it, ie when downloaded in segments), the rest (local files
+        # and directories) are done here (once, since the checksums are
+        # stored with the cached details).
+        pieces = [unpack_info]
+        for kind in ['kernel', 'ramdisk']:
+            if unpack_info.get(kind):
+                pieces.append(unpack_info[kind])
+        for info in pieces:
+            if not info.get('checksum'):
+                LOG.info("Finding the checksum of %s.", colorizer.quote(info['file_name']))
+                info['checksum'] = _hash_file(info['file_name'])
+                info['size'] = os.path.getsize(info['file_name'])
+        return unpack_info
 
     def install(self):
+        (tgt_image_name, unpack_info) = self.prepare()
+        img_id = self.register(tgt_image_name, unpack_info)
+        return (tgt_image_name, img_id)
+
+    def register(self, tgt_image_name, unpack_info):
+        return self._register(tgt_image_name, dict(unpack_info))
+
+    def prepare(self):
         url_fn = self._extract_url_fn()
         if not url_fn:
             raise IOError("Can not determine file name from url: %r" % (self.url))
-        (cache_path, details_path) = self._cached_paths()
-        use_cached = self._validate_cache(cache_path, details_path)
-        if use_cached:
+        (cache_path, _details_path) = self.cache.paths(self.url)
+        unpack_info = self.cache.load(self.url)
+        if unpack_info:
             LOG.info("Found valid cached image + metadata at: %s", colorizer.quote(cache_path))
-            unpack_info = utils.load_yaml_text(sh.load_file(details_path))
+            if not unpack_info.get('checksum'):
+                self.cache.save(self.url, self._add_checksums(unpack_info))
         else:
-            sh.mkdir(cache_path)
+            cache_path = self.cache.begin(self.url)
+            fetched_md5 = None
             if not self._is_url_local():
-                (fetched_fn, bytes_down) = down.UrlLibDownloader(self.url,
-                                                                 sh.joinpths(cache_path, url_fn)).download()
+                fetcher = down.UrlLibDownloader(self.urls,
+                                                sh.joinpths(cache_path, url_fn),
+                                                segments=self.download_segments,
+                                                sparse=True,
+                                                mirror_stats_fn=self.mirror_stats_fn)
+                (fetched_fn, bytes_down) = fetcher.download()
+                fetched_md5 = fetcher.md5
                 LOG.debug("For url %s we downloaded %s bytes to %s", self.url, bytes_down, fetched_fn)
             else:
                 fetched_fn = self.url
             unpack_info = Unpacker().unpack(url_fn, fetched_fn, cache_path)
-            sh.write_file(details_path, utils.prettify_yaml(unpack_info))
+            if fetched_md5 and unpack_info.get('file_name') == fetched_fn:
+                # Used as is (not unpacked) so the checksum found while
+                # downloading is the checksum of the image
+                unpack_info['checksum'] = fetched_md5
+                unpack_info['size'] = os.path.getsize(fetched_fn)
+            self.cache.save(self.url, self._add_checksums(unpack_info))
+        if self.convert_qcow2:
+            converted_info = self._convert(unpack_info, cache_path)
+            if converted_info is not unpack_info:
+                unpack_info = self.cache.save(self.url, converted_info)
         tgt_image_name = self._generate_img_name(url_fn)
-        img_id = self._register(tgt_image_name, unpack_info)
-        return (tgt_image_name, img_id)
+        return (tgt_image_name, unpack_info)
 
 
 class UploadService(object):
 
-    def __init__(self, glance, keystone, cache_dir='/usr/share/anvil/glance/cache', is_public=True):
+    def __init__(self, glance, keystone, cache_dir=DEF_CACHE_DIR, is_public=True,
+                 download_segments=1, mirror_stats_fn=None, convert_qcow2=False, max_uploads=2,
+                 filter_by_name=False, cache_max_bytes=0):
         self.glance_params = glance
         self.keystone_params = keystone
         self.cache_dir = cache_dir
+        self.cache = ImageCache(cache_dir, max_bytes=cache_max_bytes)
         self.is_public = is_public
+        self.download_segments = download_segments
+        self.mirror_stats_fn = mirror_stats_fn
+        self.convert_qcow2 = convert_qcow2
+        self.max_uploads = max(1, int(max_uploads))
+        self.filter_by_name = filter_by_name
 
     def _get_token(self, kclient_v2):
         LOG.info("Getting your keystone token so that image uploads may proceed.")
@@ -417,6 +848,92 @@ class UploadService(object):
                                    auth_url=k_params['endpoints']['public']['uri'])
         return client.auth_token
 
+    def _install_images(self, client, urls, upload_errors):
+        """
+        Downloads+extracts the images one after another while (up to
+        max_uploads) previously extracted images are uploaded, so that the
+        network and disk work of the next image overlaps the current upload.
+        """
+        utils.log_iterable(urls, logger=LOG,
+                           header="Attempting to download+extract+upload %s images" % len(urls))
+        upload_slots = threading.BoundedSemaphore(self.max_uploads)
+        registry = Registry(client, filter_by_name=self.filter_by_name)
+        prepared = Queue.Queue(maxsize=self.max_uploads)
+        installed = []
+        used_urls = []
+        # Failures (other than the expected upload ones) that the uploaders
+        # hit, these fail the whole install once the uploaders are done
+        failures = []
+
+        def uploader():
+            while True:
+                item = prepared.get()
+                if item is None:
+                    break
+                (url, img_handle, name, unpack_info) = item
+                try:
+                    img_id = img_handle.register(name, unpack_info)
+                    LOG.info("Installed image named %s with image id %s.", colorizer.quote(name), colorizer.quote(img_id))
+                    installed.append(url)
+                except upload_errors as e:
+                    LOG.exception('Installing %r failed due to: %s', url, e)
+                except Exception as e:
+                    LOG.exception('Installing %r failed unexpectedly due to: %s', url, e)
+                    failures.append(sys.exc_info())
+
+        uploaders = []
+
+        def enqueue(item):
+            # Never wait on the (bounded) queue when no uploaders are left
+            # to take from it (it would never have room again)
+            while True:
+                if not [t for t in uploaders if t.is_alive()]:
+                    return False
+                try:
+                    prepared.put(item, timeout=0.1)
+                    return True
+                except Queue.Full:
+                    pass
+
+        for _i in range(0, min(self.max_uploads, len(urls))):
+            t = threading.Thread(target=uploader)
+            t.daemon = True
+            t.start()
+            uploaders.append(t)
+        try:
+            for url in urls:
+                if failures:
+                    # Something is badly wrong, stop preparing more
+                    break
+                try:
+                    img_handle = Image(client, url,
+                                       is_public=self.is_public,
+                                       cache_dir=self.cache_dir,
+                                       download_segments=self.download_segments,
+                                       mirror_stats_fn=self.mirror_stats_fn,
+                                       convert_qcow2=self.convert_qcow2,
+                                       upload_slots=upload_slots,
+                                       registry=registry,
+                                       cache=self.cache)
+                    used_urls.append(img_handle.url)
+                    (name, unpack_info) = img_handle.prepare()
+                except upload_errors as e:
+                    LOG.exception('Installing %r failed due to: %s', url, e)
+                else:
+                    if not enqueue((url, img_handle, name, unpack_info)):
+                        break
+        finally:
+            for _t in uploaders:
+                if not enqueue(None):
+                    break
+            for t in uploaders:
+                t.join()
+        if failures:
+            exc_info = failures[0]
+            raise exc_info[0], exc_info[1], exc_info[2]
+        self.cache.evict(keep_urls=used_urls)
+        return len(installed)
+
     def install(self, urls):
         am_installed = 0
         try:
@@ -441,21 +958,10 @@ class UploadService(object):
                     kexceptions.ClientException, IOError) as e:
                 LOG.exception('Failed fetching needed clients for image calls due to: %s', e)
                 return am_installed
-            utils.log_iterable(urls, logger=LOG,
-                                header="Attempting to download+extract+upload %s images" % len(urls))
-            for url in urls:
-                try:
-                    img_handle = Image(client, url,
-                                       is_public=self.is_public,
-                                       cache_dir=self.cache_dir)
-                    (name, img_id) = img_handle.install()
-                    LOG.info("Installed image named %s with image id %s.", colorizer.quote(name), colorizer.quote(img_id))
-                    am_installed += 1
-                except (IOError,
-                        tarfile.TarError,
-                        gexceptions.ClientException,
-                        kexceptions.ClientException) as e:
-                    LOG.exception('Installing %r failed due to: %s', url, e)
+            upload_errors = (IOError, tarfile.TarError,
+                             gexceptions.ClientException,
+                             kexceptions.ClientException)
+            am_installed = self._install_images(client, urls, upload_errors)
         return am_installed
 
 
@@ -18,12 +18,11 @@ from anvil import colorizer
 from anvil import components as comp
 from anvil import downloader as down
 from anvil import exceptions as excp
+from anvil import importer
 from anvil import log as logging
 from anvil import shell as sh
 from anvil import utils
 
-from anvil.packaging import yum
-
 from tempfile import NamedTemporaryFile
 
 import binascii
@@ -32,6 +31,8 @@ import re
 
 LOG = logging.getLogger(__name__)
 
+yum = importer.lazy_import('anvil.packaging.yum')
+
 # See https://docs.djangoproject.com/en/dev/ref/settings/#std:setting-SECRET_KEY
 #
 # Needs to be a multiple of 2 for our usage...
@@ -76,8 +77,12 @@ class HorizonInstaller(comp.PythonInstallComponent):
         self._install_node_repo()
 
     def _install_node_repo(self):
-        repo_url = self.get_option('nodejs_repo')
-        if not repo_url:
+        repo_urls = self.get_option('nodejs_repo')
+        # A list is a list of mirrors of the same repository configuration
+        if not isinstance(repo_urls, (list, tuple)):
+            repo_urls = [repo_urls]
+        repo_urls = [u.strip() for u in repo_urls if u and u.strip()]
+        if not repo_urls:
             # Ok then, hope node js is in your path for when horizon attempts
             # to use it... if not possibly follow:
             #
@@ -85,6 +90,7 @@ class HorizonInstaller(comp.PythonInstallComponent):
             return
         # Download the said url and install it so that we can actually install
         # the node.js requirement which seems to be needed by horizon for css compiling??
+        repo_url = repo_urls[0]
         repo_basename = sh.basename(repo_url)
         (_fn, fn_ext) = os.path.splitext(repo_basename)
         fn_ext = fn_ext.lower().strip()
@@ -93,7 +99,8 @@ class HorizonInstaller(comp.PythonInstallComponent):
             return
         with NamedTemporaryFile(suffix=fn_ext) as temp_fh:
             LOG.info("Downloading node.js repository configuration from %s to %s.", repo_url, temp_fh.name)
-            down.UrlLibDownloader(repo_url, temp_fh.name).download()
+            down.UrlLibDownloader(repo_urls, temp_fh.name,
+                                  mirror_stats_fn=self.mirror_stats_fn).download()
             temp_fh.flush()
             if fn_ext == ".repo":
                 # Just write out the repo file after downloading it...
@@ -195,6 +202,7 @@ class HorizonRuntime(comp.ProgramRuntime):
     def start(self):
         if self.statii()[0].status != comp.STATUS_STARTED:
             self._run_action('start')
+            self._configs_applied()
             return 1
         else:
             return 0
@@ -207,6 +215,7 @@ class HorizonRuntime(comp.ProgramRuntime):
 
     def restart(self):
         self._run_action('restart')
+        self._configs_applied()
         return 1
 
     def stop(self):
@@ -228,6 +228,18 @@ class NovaInstaller(comp.PythonInstallComponent):
             contents = config.stringify(fn)
         return contents
 
+    def config_programs(self, config_fn):
+        if config_fn == PASTE_CONF:
+            return ['nova-api']
+        else:
+            return comp.PythonInstallComponent.config_programs(self, config_fn)
+
+    def config_skippable(self, config_fn):
+        # Generating nova.conf also makes the lock and instances directories
+        if config_fn == API_CONF:
+            return False
+        return comp.PythonInstallComponent.config_skippable(self, config_fn)
+
     def _config_adjust(self, contents, name):
         if name == PASTE_CONF:
             return self._config_adjust_paste(contents, name)
@@ -79,6 +79,7 @@ class RabbitRuntime(comp.ProgramRuntime):
     def start(self):
         if self.statii()[0].status != comp.STATUS_STARTED:
             self._run_action('start')
+            self._configs_applied()
             return 1
         else:
             return 0
@@ -132,6 +133,7 @@ class RabbitRuntime(comp.ProgramRuntime):
 
     def restart(self):
         self._run_action('restart')
+        self._configs_applied()
         return 1
 
     def stop(self):
@@ -0,0 +1,307 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import os
+import signal
+import socket
+import SocketServer
+import sys
+import time
+
+from anvil import action
+from anvil import actions
+from anvil import bundle
+from anvil import colorizer
+from anvil import distro
+from anvil import exceptions as excp
+from anvil import log as logging
+from anvil import persona
+from anvil import settings
+from anvil import shell as sh
+
+from anvil.packaging.helpers import pip_helper
+
+LOG = logging.getLogger(__name__)
+
+# The action name that starts the daemon (instead of running an action)
+SERVE_ACTION = 'serve'
+
+# Created in the root directory that the daemon is serving
+SOCKET_NAME = 'anvil.sock'
+
+
+def socket_path(root_dir):
+    return sh.joinpths(root_dir, SOCKET_NAME)
+
+
+def _to_str(value):
+    if isinstance(value, unicode):
+        return str(value)
+    return value
+
+
+def _to_exception(message):
+    # Recreate the same kind of exception (if its one of ours) so that
+    # callers can not tell the action ran somewhere else
+    exc_cls = getattr(excp, _to_str(message.get('type', '')), None)
+    if not (isinstance(exc_cls, type) and issubclass(exc_cls, excp.AnvilException)):
+        exc_cls = excp.AnvilException
+    return exc_cls(message.get('error', ''))
+
+
+def _is_listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
+
+
+class _LogRelay(logging.Handler):
+    """Sends the log records of a request back to the client that made it."""
+
+    def __init__(self, send):
+        logging.Handler.__init__(self)
+        self._send = send
+        self._closed = False
+
+    def emit(self, record):
+        # Records that were themselves relayed (from some other daemon)
+        # are not sent back around again
+        if self._closed or getattr(record, 'relayed', False):
+            return
+        try:
+            self._send({
+                'log': {
+                    'name': record.name,
+                    'levelno': record.levelno,
+                    'levelname': logging.getLevelName(record.levelno),
+                    'msg': record.getMessage(),
+                },
+            })
+        except socket.error:
+            # The client went away, keep on going without it
+            self._closed = True
+
+
+class _Loaded(object):
+    def __init__(self, config_bundle, dist, persona_obj):
+        self.bundle = config_bundle
+        self.distro = dist
+        self.persona = persona_obj
+        # Action runners (and the components they constructed) by the
+        # action name and options they were made with
+        self.runners = {}
+
+
+class _RequestHandler(SocketServer.StreamRequestHandler):
+    def _send(self, message):
+        self.wfile.write(json.dumps(message) + "\n")
+        self.wfile.flush()
+
+    def handle(self):
+        try:
+            request = json.loads(self.rfile.readline())
+            if not isinstance(request, dict):
+                raise ValueError("Request is not a dictionary")
+        except ValueError as e:
+            self._send({'error': "Invalid request: %s" % (e), 'type': 'OptionException'})
+            return
+        root_logger = logging.getLogger().logger
+        old_level = root_logger.level
+        relay = _LogRelay(self._send)
+        root_logger.addHandler(relay)
+        if (request.get('args') or {}).get('verbose'):
+            root_logger.setLevel(logging.DEBUG)
+        try:
+            start_time = time.time()
+            self.server.anvil_daemon.run(request)
+            response = {'result': 'ok', 'elapsed': time.time() - start_time}
+        except Exception as e:
+            LOG.debug("Failed running request %s", request, exc_info=True)
+            response = {'error': str(e), 'type': e.__class__.__name__}
+        finally:
+            root_logger.removeHandler(relay)
+            root_logger.setLevel(old_level)
+        try:
+            self._send(response)
+        except socket.error:
+            pass
+
+
+class _UnixServer(SocketServer.UnixStreamServer):
+    # Requests are handled one at a time (in the order received) since the
+    # actions (and the components they construct) are not safe to run at the
+    # same time as each other.
+    def __init__(self, path, anvil_daemon):
+        SocketServer.UnixStreamServer.__init__(self, path, _RequestHandler)
+        self.anvil_daemon = anvil_daemon
+
+
+class Daemon(object):
+    """
+    Runs actions (sent by clients over a unix socket) for a root directory
+    while keeping the distro, persona, interpolated options and constructed
+    components warm between them; these are loaded again when the yaml files
+    they came from change.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.path = socket_path(root_dir)
+        self._loaded = {}
+
+    def _load(self, persona_fn):
+        loaded = self._loaded.get(persona_fn)
+        if loaded is not None:
+            if bundle.is_current(loaded.bundle, settings.DISTRO_DIR, persona_fn,
+                                 settings.COMPONENT_CONF_DIR):
+                return loaded
+            LOG.info("Reloading %s since its configuration changed.", colorizer.quote(persona_fn))
+            self._loaded.pop(persona_fn, None)
+        config_bundle = bundle.load(self.root_dir, settings.DISTRO_DIR, persona_fn,
+                                    settings.COMPONENT_CONF_DIR,
+                                    base_names=action.BASE_YAML_INTERP)
+        dist = distro.load(settings.DISTRO_DIR, definitions=config_bundle.distros)
+        try:
+            persona_obj = persona.load(persona_fn, definition=config_bundle.persona)
+            persona_obj.verify(dist)
+        except Exception as e:
+            raise excp.OptionException("Error loading persona file: %s due to %s" % (persona_fn, e))
+        config_bundle.save()
+        loaded = _Loaded(config_bundle, dist, persona_obj)
+        self._loaded[persona_fn] = loaded
+        return loaded
+
+    def _get_runner(self, loaded, action_name, args):
+        key = (action_name, tuple(sorted(args.items())))
+        runner = loaded.runners.get(key)
+        if runner is None:
+            runner_cls = actions.class_for(action_name)
+            runner = runner_cls(distro=loaded.distro,
+                                root_dir=self.root_dir,
+                                name=action_name,
+                                cli_opts=dict(args))
+            runner.interpolator.update(loaded.bundle.options)
+            loaded.runners[key] = runner
+        return (key, runner)
+
+    def run(self, request):
+        action_name = _to_str(request.get('action') or '').strip().lower()
+        if action_name not in actions.names():
+            raise excp.OptionException("Invalid action name %r specified!" % (action_name))
+        persona_fn = _to_str(request.get('persona_fn') or '')
+        if not sh.isfile(persona_fn):
+            raise excp.OptionException("Invalid persona file %r specified!" % (persona_fn))
+        persona_fn = sh.abspth(persona_fn)
+        args = {}
+        for (k, v) in (request.get('args') or {}).items():
+            args[_to_str(k)] = _to_str(v)
+        # Dry-run is process wide (and was set when the daemon started) so
+        # only requests that agree with it can be ran here
+        dry_run = bool(args.get('dryrun', False))
+        if dry_run != sh.is_dry_run():
+            raise excp.OptionException("The daemon serving %s was started with dry-run %s and can not run"
+                                       " an action with dry-run %s!" % (self.root_dir, sh.is_dry_run(), dry_run))
+        # Others may have installed or removed pips since the last request
+        # (the site directories that changed get rescanned)
+        pip_helper.Helper.uncache_all()
+        loaded = self._load(persona_fn)
+        (key, runner) = self._get_runner(loaded, action_name, args)
+        LOG.info("Starting action %s for distro: %s", colorizer.quote(action_name),
+                 colorizer.quote(loaded.distro.name))
+        try:
+            runner.run(loaded.persona)
+        except Exception:
+            # Don't reuse components that may have been left half way
+            loaded.runners.pop(key, None)
+            raise
+
+    def serve(self):
+        if os.path.exists(self.path):
+            if _is_listening(self.path):
+                raise excp.OptionException("A daemon is already serving %s (at %s)!" % (self.root_dir, self.path))
+            # Left over by a daemon that did not exit cleanly
+            os.unlink(self.path)
+        server = _UnixServer(self.path, self)
+        # Don't use sh here so that these always happen (even if dry-run)
+        os.chmod(self.path, 0600)
+
+        def on_term(signum, frame):
+            sys.exit(0)
+
+        signal.signal(signal.SIGTERM, on_term)
+        LOG.info("Serving actions for %s on %s.", colorizer.quote(self.root_dir), colorizer.quote(self.path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            try:
+                os.unlink(self.path)
+            except OSError:
+                pass
+            LOG.info("Stopped serving actions for %s.", colorizer.quote(self.root_dir))
+
+
+class Client(object):
+    """Runs actions using the daemon serving a root directory."""
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.path = socket_path(root_dir)
+
+    def _relay(self, record):
+        fields = dict((_to_str(k), _to_str(v)) for (k, v) in record.items())
+        fields['relayed'] = True
+        logger = logging.getLogger(fields['name']).logger
+        if logger.isEnabledFor(fields['levelno']):
+            logger.handle(logging.makeLogRecord(fields))
+
+    def run(self, action, persona_fn, args):
+        request = {
+            'action': action,
+            'persona_fn': sh.abspth(persona_fn),
+            'args': args,
+        }
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(self.path)
+            except socket.error as e:
+                raise excp.OptionException("No daemon is serving %s (use the %s action to start one): %s"
+                                           % (self.root_dir, SERVE_ACTION, e))
+            sock.sendall(json.dumps(request) + "\n")
+            fh = sock.makefile('rb')
+            while True:
+                line = fh.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if 'log' in message:
+                    self._relay(message['log'])
+                elif 'error' in message:
+                    raise _to_exception(message)
+                elif 'result' in message:
+                    return message
+        finally:
+            sock.close()
+        raise excp.AnvilException("The daemon serving %s stopped before action %s finished" % (self.root_dir, action))
@@ -22,13 +22,12 @@ import platform
 import re
 import shlex
 
-import yaml
-
 from anvil import colorizer
 from anvil import exceptions as excp
 from anvil import importer
 from anvil import log as logging
 from anvil import shell as sh
+from anvil import utils
 
 LOG = logging.getLogger(__name__)
 
@@ -119,8 +118,8 @@ def _match_distro(distros):
         return distro_matched
 
 
-def load(path):
-    distro_possibles = []
+def read_definitions(path):
+    definitions = []
     input_files = glob.glob(sh.joinpths(path, '*.yaml'))
     if not input_files:
         raise excp.ConfigException('Did not find any distro definition files in %r' % path)
@@ -131,8 +130,16 @@ def load(path):
             # read this (even if dry-run)
             with open(fn, 'r') as fh:
                 contents = fh.read()
-                cls_kvs = yaml.safe_load(contents)
-                distro_possibles.append(Distro(**cls_kvs))
-        except (IOError, yaml.YAMLError) as err:
+                definitions.append(utils.load_yaml_text(contents))
+        except (IOError, utils.yaml.YAMLError) as err:
             LOG.warning('Could not load distro definition from %r: %s', fn, err)
+    return definitions
+
+
+def load(path, definitions=None):
+    if definitions is None:
+        definitions = read_definitions(path)
+    distro_possibles = []
+    for cls_kvs in definitions:
+        distro_possibles.append(Distro(**cls_kvs))
     return _match_distro(distro_possibles)
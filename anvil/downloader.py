@@ -17,18 +17,28 @@
 import abc
 import contextlib
 import functools
+import hashlib
+import httplib
+import os
+import re
+import threading
+import time
 import urllib2
+import urlparse
 
 from urlparse import parse_qs
 
-import progressbar
-
 from anvil import colorizer
+from anvil import exceptions as excp
+from anvil import importer
 from anvil import log as logging
 from anvil import shell as sh
+from anvil import utils
 
 LOG = logging.getLogger(__name__)
 
+progressbar = importer.lazy_import('progressbar')
+
 
 class Downloader(object):
     __metaclass__ = abc.ABCMeta
@@ -42,12 +52,82 @@ class Downloader(object):
         raise NotImplementedError()
 
 
+def _mirror_name(uri):
+    # Turn git://github.com/openstack/nova.git into github.com_openstack_nova.git
+    name = uri
+    if name.find("://") != -1:
+        name = name.split("://", 1)[1]
+    name = re.sub(r"[^A-Za-z0-9.\-]+", "_", name.strip("/"))
+    if not name.endswith(".git"):
+        name += ".git"
+    return name
+
+
+class GitMirror(object):
+    """A directory of bare (mirrored) git repositories.
+
+    Each uri gets a bare mirror which is fetched (instead of cloned) when it
+    already exists, checkouts are then made from that mirror using local
+    (hard linked) clones so that repeat downloads become local disk copies.
+    """
+
+    # Mirrors may be updated from several download workers at once
+    _locks = {}
+    _locks_lock = threading.Lock()
+
+    def __init__(self, distro, mirror_dir):
+        self.distro = distro
+        self.mirror_dir = mirror_dir
+
+    def path_for(self, uri):
+        return sh.joinpths(self.mirror_dir, _mirror_name(uri))
+
+    def _lock_for(self, path):
+        with self._locks_lock:
+            if path not in self._locks:
+                self._locks[path] = threading.Lock()
+            return self._locks[path]
+
+    def update(self, uri):
+        path = self.path_for(uri)
+        with self._lock_for(path):
+            if sh.isdir(path):
+                LOG.info("Updating git mirror of %s at %s.", colorizer.quote(uri), colorizer.quote(path))
+                cmd = list(self.distro.get_command('git', 'remote'))
+                cmd += ['update', '--prune']
+                sh.execute(*cmd, cwd=path)
+            else:
+                LOG.info("Mirroring %s to %s.", colorizer.quote(uri), colorizer.quote(path))
+                sh.mkdirslist(self.mirror_dir)
+                # Mirror into a temporary location first so that an
+                # interrupted mirroring never looks like a usable mirror.
+                tmp_path = "%s.tmp" % (path)
+                if sh.isdir(tmp_path):
+                    sh.deldir(tmp_path)
+                cmd = list(self.distro.get_command('git', 'clone'))
+                cmd += ['--mirror', uri, tmp_path]
+                sh.execute(*cmd)
+                sh.move(tmp_path, path)
+        return path
+
+
+# What anvil changed (by patching) in a checkout is remembered in this file
+# (in its .git directory) so that those changes are not taken to be the users
+GIT_PATCHED_FN = 'anvil-patched'
+
+
 class GitDownloader(Downloader):
-    def __init__(self, distro, uri, store_where):
+    def __init__(self, distro, uri, store_where, mirror_dir=None, shallow=False, depth=1,
+                 update=False, keep_local_changes=True):
         Downloader.__init__(self, uri, store_where)
         self.distro = distro
+        self.mirror_dir = mirror_dir
+        self.shallow = shallow
+        self.depth = depth
+        self.update = update
+        self.keep_local_changes = keep_local_changes
 
-    def download(self):
+    def _parse_uri(self):
         branch = None
         tag = None
         uri = self.uri
@@ -63,37 +143,323 @@ class GitDownloader(Downloader):
             uri = uri.strip()
         if not branch:
             branch = 'master'
+        return (uri, branch, tag)
+
+    def _git(self, cmd_key, *args, **kwargs):
+        cmd = list(self.distro.get_command('git', cmd_key))
+        cmd += list(args)
+        kwargs.setdefault('cwd', self.store_where)
+        return sh.execute(*cmd, **kwargs)
+
+    def _head(self):
+        (stdout, _stderr) = self._git('rev-parse', 'HEAD')
+        return stdout.strip()
+
+    def _local_changes(self):
+        # A digest of the checkouts uncommitted changes (none if clean)
+        (status, _stderr) = self._git('status', '--porcelain')
+        if not status.strip():
+            return None
+        (diff, _stderr) = self._git('diff', 'HEAD')
+        return hashlib.sha1(status + diff).hexdigest()
+
+    def _patched_fn(self):
+        return sh.joinpths(self.store_where, '.git', GIT_PATCHED_FN)
+
+    def remember_patched(self):
+        """
+        Remembers the current uncommitted changes of the checkout as the
+        ones anvil made (by applying its patches), so that updating can undo
+        them (and have them applied again) instead of leaving the checkout
+        alone because of them.
+        """
+        changes = self._local_changes()
+        if changes is None:
+            sh.unlink(self._patched_fn())
+        else:
+            sh.write_file(self._patched_fn(), changes)
+
+    def _patched_by_anvil(self, changes):
+        patched_fn = self._patched_fn()
+        if not sh.isfile(patched_fn):
+            return False
+        return sh.load_file(patched_fn).strip() == changes
+
+    def _clone(self, uri, branch, tag):
+        clone_from = uri
+        if self.mirror_dir:
+            clone_from = GitMirror(self.distro, self.mirror_dir).update(uri)
+        cmd = list(self.distro.get_command('git', 'clone'))
+        if self.shallow:
+            # Only the history (and ref) that is wanted; note that git ignores
+            # the depth for local clones unless given a file:// uri.
+            if self.mirror_dir:
+                clone_from = "file://%s" % (clone_from)
+            cmd += ['--depth', str(self.depth), '--single-branch', '--branch', tag or branch]
+        cmd += [clone_from, self.store_where]
+        sh.execute(*cmd)
+        if self.mirror_dir:
+            # Point the checkout at the real uri (and not the mirror)
+            self._git('remote', 'set-url', 'origin', uri)
+
+    def _checkout(self, branch, tag):
+        checkout_what = []
+        if tag:
+            # Avoid 'detached HEAD state' message by moving to a
+            # $tag-anvil branch for that tag
+            checkout_what = [tag, '-b', "%s-%s" % (tag, 'anvil')]
+            LOG.info("Adjusting to tag %s.", colorizer.quote(tag))
+        else:
+            if branch.lower() == 'master':
+                checkout_what = ['master']
+            else:
+                # Set it up to track the remote branch correctly
+                checkout_what = ['--track', '-b', branch, 'origin/%s' % (branch)]
+            LOG.info("Adjusting branch to %s.", colorizer.quote(branch))
+        self._git('checkout', *checkout_what)
+
+    def _update(self, uri, branch, tag):
+        reset = False
+        changes = self._local_changes()
+        if changes is not None:
+            if self._patched_by_anvil(changes):
+                # Ours, so undo them (including any files the patches made)
+                # and let them be applied again to whatever gets checked out
+                LOG.info("Undoing the patches applied in existing git directory located at %s.",
+                         colorizer.quote(self.store_where))
+                self._git('reset', '--hard', '-q')
+                self._git('clean', '-f', '-d', '-q')
+            elif self.keep_local_changes:
+                LOG.warn("Existing git directory located at %s has local changes, leaving it alone.",
+                         colorizer.quote(self.store_where))
+                return False
+            else:
+                LOG.warn("Discarding local changes in existing git directory located at %s.",
+                         colorizer.quote(self.store_where))
+                self._git('reset', '--hard', '-q')
+            sh.unlink(self._patched_fn())
+            reset = True
+        if tag:
+            local_branch = "%s-%s" % (tag, 'anvil')
+            target_ref = 'refs/tags/%s' % (tag)
+            refspec = '+%s:%s' % (target_ref, target_ref)
+        else:
+            local_branch = branch
+            target_ref = 'refs/remotes/origin/%s' % (branch)
+            refspec = '+refs/heads/%s:%s' % (branch, target_ref)
+        old_head = self._head()
+        # Only fetch the one ref that is wanted (from the mirror if one
+        # is being used, since it was just updated from the real uri).
+        fetch_from = 'origin'
+        if self.mirror_dir:
+            fetch_from = GitMirror(self.distro, self.mirror_dir).update(uri)
+        fetch_opts = ['-q']
+        if self.shallow:
+            fetch_opts += ['--depth', str(self.depth)]
+        LOG.info("Updating %s in existing git directory located at %s.",
+                 colorizer.quote(tag or branch), colorizer.quote(self.store_where))
+        self._git('fetch', *(fetch_opts + [fetch_from, refspec]))
+        (stdout, _stderr) = self._git('rev-parse', '--verify', '--quiet', 'refs/heads/%s' % (local_branch),
+                                      check_exit_code=False)
+        if not stdout.strip():
+            self._checkout(branch, tag)
+        else:
+            self._git('checkout', '-q', local_branch)
+            if self.keep_local_changes:
+                # Never throw away local commits, only move forward
+                try:
+                    self._git('merge', '-q', '--ff-only', target_ref)
+                except excp.ProcessExecutionError as e:
+                    raise excp.DownloadException("Can not fast-forward %s in %s to %s (local commits"
+                                                 " would be lost): %s" % (local_branch, self.store_where,
+                                                                         target_ref, e))
+            else:
+                self._git('reset', '--hard', '-q', target_ref)
+        new_head = self._head()
+        if new_head == old_head:
+            LOG.info("Existing git directory located at %s is up to date (at %s).",
+                     colorizer.quote(self.store_where), new_head[0:12])
+            # Even when it did not move its contents did if it was reset
+            return reset
+        LOG.info("Moved existing git directory located at %s from %s to %s.",
+                 colorizer.quote(self.store_where), old_head[0:12], new_head[0:12])
+        return True
+
+    def download(self):
+        """
+        Clones (or updates when asked to) the uri, returning whether
+        the checkouts contents changed (its HEAD moved or it was reset).
+        """
+        (uri, branch, tag) = self._parse_uri()
         if sh.isdir(self.store_where) and sh.isdir(sh.joinpths(self.store_where, '.git')):
+            if self.update:
+                return self._update(uri, branch, tag)
             LOG.info("Existing git directory located at %s, leaving it alone.", colorizer.quote(self.store_where))
-        else:
-            LOG.info("Downloading %s (%s) to %s.", colorizer.quote(uri), branch, colorizer.quote(self.store_where))
-            cmd = list(self.distro.get_command('git', 'clone'))
-            cmd += [uri, self.store_where]
-            sh.execute(*cmd)
-        if branch or tag:
-            checkout_what = []
-            if tag:
-                # Avoid 'detached HEAD state' message by moving to a
-                # $tag-anvil branch for that tag
-                checkout_what = [tag, '-b', "%s-%s" % (tag, 'anvil')]
-                LOG.info("Adjusting to tag %s.", colorizer.quote(tag))
+            return False
+        LOG.info("Downloading %s (%s) to %s.", colorizer.quote(uri), tag or branch, colorizer.quote(self.store_where))
+        self._clone(uri, branch, tag)
+        if not self.shallow or tag:
+            # Shallow clones are already on the wanted branch
+            self._checkout(branch, tag)
+        return True
+
+
+# Checksum algorithms that can be given in a uris fragment
+CHECKSUM_ALGOS = ['md5', 'sha1', 'sha224', 'sha256', 'sha384', 'sha512']
+
+
+class _NullWriter(object):
+    def write(self, data):
+        pass
+
+
+class _MultiHasher(object):
+    # Updates many hashers with the same data (while it is transferred once)
+    def __init__(self, hashers):
+        self.hashers = []
+        for h in hashers:
+            # The same hasher must not be given the same data twice
+            if h is not None and not [o for o in self.hashers if o is h]:
+                self.hashers.append(h)
+
+    def update(self, data):
+        for h in self.hashers:
+            h.update(data)
+
+
+def _parse_checksum(text):
+    # Checksums are given as 'algorithm=hexdigest' (ie md5=...)
+    (algo, _sep, digest) = text.partition("=")
+    algo = algo.strip().lower()
+    digest = digest.strip().lower()
+    if not algo or not digest:
+        raise ValueError("Invalid checksum %r (expected 'algorithm=hexdigest')" % (text))
+    hashlib.new(algo)
+    return (algo, digest)
+
+
+def _is_hex_digest(algo, digest):
+    # Hex digests have two hex characters per byte of the algorithms digest
+    length = hashlib.new(algo).digest_size * 2
+    return bool(re.match(r"^[0-9a-fA-F]{%s}$" % (length), digest))
+
+
+class MirrorStats(object):
+    """Remembers how mirrors (hosts) have done (across runs when given a file).
+
+    Keeps a moving average of the latency (seconds) of probing a mirror and
+    of the throughput (bytes per second) of transferring from it, which are
+    used to pick which mirror to try first the next time.
+    """
+
+    # How much a new measurement counts for in the moving averages
+    WEIGHT = 0.5
+
+    def __init__(self, fn=None):
+        self.fn = fn
+        self._stats = None
+        self._lock = threading.Lock()
+
+    def _key(self, uri):
+        parsed = urlparse.urlparse(uri)
+        return "%s://%s" % (parsed.scheme, parsed.netloc)
+
+    def _load(self):
+        if self._stats is not None:
+            return self._stats
+        stats = {}
+        if self.fn and sh.isfile(self.fn):
+            try:
+                stats = utils.load_yaml_text(sh.load_file(self.fn))
+                if not isinstance(stats, dict):
+                    stats = {}
+            except Exception as e:
+                LOG.warn("Failed loading mirror statistics from %s: %s", self.fn, e)
+                stats = {}
+        self._stats = stats
+        return stats
+
+    def _average(self, uri, key, value):
+        with self._lock:
+            stats = self._load().setdefault(self._key(uri), {})
+            old_value = stats.get(key)
+            if old_value is None:
+                stats[key] = float(value)
             else:
-                if branch.lower() == 'master':
-                    checkout_what = ['master']
-                else:
-                    # Set it up to track the remote branch correctly
-                    checkout_what = ['--track', '-b', branch, 'origin/%s' % (branch)]
-                LOG.info("Adjusting branch to %s.", colorizer.quote(branch))
-            cmd = list(self.distro.get_command('git', 'checkout'))
-            cmd += checkout_what
-            sh.execute(*cmd, cwd=self.store_where)
+                stats[key] = (self.WEIGHT * value) + ((1 - self.WEIGHT) * old_value)
+
+    def record_latency(self, uri, seconds):
+        self._average(uri, 'latency', seconds)
+
+    def record_transfer(self, uri, bytes_down, seconds):
+        if bytes_down > 0 and seconds > 0:
+            self._average(uri, 'throughput', bytes_down / seconds)
+
+    def record_failure(self, uri):
+        with self._lock:
+            stats = self._load().setdefault(self._key(uri), {})
+            stats['failures'] = stats.get('failures', 0) + 1
+
+    def get(self, uri, key):
+        with self._lock:
+            return self._load().get(self._key(uri), {}).get(key)
+
+    def save(self):
+        if not self.fn or self._stats is None:
+            return
+        with self._lock:
+            contents = utils.prettify_yaml(self._stats)
+        try:
+            sh.write_file(self.fn, contents, quiet=True)
+        except (IOError, OSError) as e:
+            LOG.warn("Failed saving mirror statistics to %s: %s", self.fn, e)
 
 
 class UrlLibDownloader(Downloader):
+    """Downloads a uri (using urllib2) into a file.
+
+    Downloads first go to a '.part' file which is resumed (using http
+    range requests, conditional on the remote file being unchanged) when
+    retrying or when a previous download was interrupted, and which is
+    only renamed to the final file name after it has been verified. The checksum to verify against can be given
+    directly, in the uris fragment (ie http://.../image.img#md5=...) or
+    found in a sidecar (ie image.img.sha256 or image.img.md5) file
+    next to the uri.
+
+    A list of uris (mirrors of the same file) can also be given, in which
+    case they are all probed at the same time and the one expected to be
+    the fastest (using how they did before) is downloaded from first, if
+    it fails the download fails over (resuming) to the next one.
+    """
+
+    # Sidecar checksum files that are looked for (in this order)
+    SIDECAR_ALGOS = ['sha256', 'md5']
+
     def __init__(self, uri, store_where, **kargs):
-        Downloader.__init__(self, uri, store_where)
+        if isinstance(uri, (list, tuple)):
+            uris = [u.strip() for u in uri if u.strip()]
+        else:
+            uris = [uri]
+        if not uris:
+            raise ValueError("No uris to download from given")
+        Downloader.__init__(self, uris[0], store_where)
+        self.uris = uris
+        self.stats = MirrorStats(kargs.get('mirror_stats_fn'))
         self.quiet = kargs.get('quiet', False)
         self.timeout = kargs.get('timeout', 5)
+        self.retries = max(0, kargs.get('retries', 3))
+        self.retry_delay = kargs.get('retry_delay', 1.0)
+        self.checksum = kargs.get('checksum')
+        self.check_sidecars = kargs.get('check_sidecars', True)
+        # Large downloads (from servers that accept range requests) can be
+        # split into this many segments which are fetched at the same time
+        self.segments = max(1, kargs.get('segments', 1))
+        self.min_segment_size = max(1, kargs.get('min_segment_size', 8 * 1024 * 1024))
+        # Leave holes (instead of writing) where blocks of zeros were downloaded
+        self.sparse = kargs.get('sparse', False)
+        # The md5 of what was downloaded (found while downloading, so
+        # that it does not have to be read again to find it) or none
+        self.md5 = None
 
     def _make_bar(self, size):
         widgets = [
@@ -104,26 +470,359 @@ class UrlLibDownloader(Downloader):
         ]
         return progressbar.ProgressBar(widgets=widgets, maxval=size)
 
-    def download(self):
-        LOG.info('Downloading using urllib2: %s to %s.', colorizer.quote(self.uri), colorizer.quote(self.store_where))
+    def _split_uris(self):
+        uris = []
+        checksum = self.checksum
+        for uri in self.uris:
+            (uri, _sep, fragment) = uri.partition("#")
+            uris.append(uri)
+            if not checksum and fragment:
+                for (algo, values) in parse_qs(fragment).items():
+                    if algo.lower() in CHECKSUM_ALGOS:
+                        checksum = "%s=%s" % (algo, values[0])
+                        break
+        return (uris, checksum)
+
+    def _rank(self, uris):
+        # Probe all the mirrors at the same time and order them by how long
+        # they are expected to take (unreachable ones go last, ties keep
+        # the order they were given in).
+        def probe(uri):
+            start = time.time()
+            (size, _accepts_ranges) = self._probe(uri)
+            latency = time.time() - start
+            self.stats.record_latency(uri, latency)
+            return (size, latency)
+
+        alive = []
+        dead = []
+        for (i, (uri, result, exc_info)) in enumerate(utils.run_in_parallel(probe, uris, len(uris))):
+            if exc_info:
+                LOG.debug("Probing mirror %s failed: %s", uri, exc_info[1])
+                self.stats.record_failure(uri)
+                dead.append(uri)
+            else:
+                alive.append((uri, i, result[0], result[1]))
+        known = [self.stats.get(uri, 'throughput') for (uri, _i, _size, _latency) in alive]
+        known = [t for t in known if t]
+
+        def expected_time(entry):
+            (uri, i, size, latency) = entry
+            throughput = self.stats.get(uri, 'throughput')
+            if not throughput and known:
+                # Assume an unknown mirror is as good as the best known one
+                throughput = max(known)
+            if size and throughput:
+                return (latency + (size / throughput), i)
+            return (latency, i)
+
+        alive.sort(key=expected_time)
+        ranked = [entry[0] for entry in alive] + dead
+        utils.log_iterable(ranked, logger=LOG,
+                           header="Trying %s mirrors in order" % (len(ranked)))
+        return ranked
+
+    def _find_sidecar_checksum(self, uri):
+        fn = sh.basename(urlparse.urlparse(uri).path)
+        for algo in self.SIDECAR_ALGOS:
+            sidecar_uri = "%s.%s" % (uri, algo)
+            try:
+                with contextlib.closing(urllib2.urlopen(sidecar_uri, timeout=self.timeout)) as conn:
+                    contents = conn.read(64 * 1024)
+            except (IOError, httplib.HTTPException):
+                continue
+            # Typically formatted like the output of md5sum (digest filename)
+            for line in contents.splitlines():
+                pieces = line.split()
+                if not pieces:
+                    continue
+                if len(pieces) != 1 and pieces[-1].lstrip("*") != fn:
+                    continue
+                # Anything else (ie an html error page served with a 200)
+                # is not a digest and would just fail the verification...
+                if not _is_hex_digest(algo, pieces[0]):
+                    LOG.debug("Ignoring %r found in %s, it is not a %s digest", pieces[0], sidecar_uri, algo)
+                    continue
+                LOG.debug("Found %s checksum for %s in %s", algo, uri, sidecar_uri)
+                return "%s=%s" % (algo, pieces[0])
+        return None
+
+    def _validator_fn(self, part_fn):
+        return "%s.validator" % (part_fn)
+
+    def _read_validator(self, part_fn, uri):
+        # Validators are only meaningful to the server that gave them out,
+        # etags (and even modification times) almost never match between
+        # mirrors so one from a different mirror is not used.
+        validator_fn = self._validator_fn(part_fn)
+        if not sh.isfile(validator_fn):
+            return None
+        (from_uri, _sep, validator) = sh.load_file(validator_fn).partition("\n")
+        validator = validator.strip()
+        if from_uri.strip() != uri or not validator:
+            return None
+        return validator
+
+    def _save_validator(self, part_fn, uri, headers):
+        # Weak etags can not be used with 'If-Range' so prefer
+        # the last modified time when that is all there is...
+        validator = headers.get('etag', '').strip()
+        if not validator or validator.startswith("W/"):
+            validator = headers.get('last-modified', '').strip()
+        validator_fn = self._validator_fn(part_fn)
+        if validator:
+            sh.write_file(validator_fn, "%s\n%s" % (uri, validator), quiet=True)
+        else:
+            sh.unlink(validator_fn)
+
+    def _fetch(self, uri, part_fn, hasher, verifiable=False):
+        # The hasher (if any) is given everything downloaded, verifiable
+        # should be true when the result is checked against a checksum
+        offset = 0
+        if sh.isfile(part_fn):
+            offset = os.path.getsize(part_fn)
+        validator = None
+        if offset:
+            validator = self._read_validator(part_fn, uri)
+            if not validator and not verifiable:
+                # Nothing can tell if the remote file changed (or is the same
+                # file when resuming from another mirror) since the part file
+                # was started so appending to it could splice two different
+                # files together (and nothing would notice)
+                LOG.info("Unable to tell if %s has what was downloaded before, restarting the download.",
+                         colorizer.quote(uri))
+                offset = 0
+            # Otherwise without a validator (ie after failing over to another
+            # mirror) the checksum will catch a file that got spliced
+        request = urllib2.Request(uri)
+        if offset:
+            request.add_header('Range', 'bytes=%s-' % (offset))
+            if validator:
+                # Get the whole (new) file instead if it has changed
+                request.add_header('If-Range', validator)
+        try:
+            conn = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib2.HTTPError as e:
+            if e.code == 416 and offset:
+                # Nothing left to get (the checksum, if any, will
+                # tell if what was gotten before is actually valid).
+                LOG.debug("Nothing left to download for %s after %s bytes.", uri, offset)
+                self._hash_file(part_fn, hasher)
+                return offset
+            raise
+        with contextlib.closing(conn):
+            if offset and conn.getcode() != 206:
+                LOG.info("Server for %s did not resume (unsupported or the file changed), restarting the download.",
+                         colorizer.quote(uri))
+                offset = 0
+            if not offset:
+                self._save_validator(part_fn, uri, conn.headers)
+            if offset:
+                LOG.info("Resuming download of %s after %s bytes.", colorizer.quote(uri), offset)
+                self._hash_file(part_fn, hasher)
+                # Not appending since appends ignore seeking (which
+                # sparse writing uses to leave holes)
+                mode = 'r+b'
+            else:
+                mode = 'wb'
+            c_len = conn.headers.get('content-length')
+            try:
+                c_len = int(c_len)
+            except (TypeError, ValueError):
+                c_len = None
+            p_bar = None
+            if c_len is not None and not self.quiet:
+                p_bar = self._make_bar(c_len + offset)
+                p_bar.start()
+                p_bar.update(offset)
+
+            def update_bar(bytes_down):
+                if p_bar:
+                    p_bar.update(offset + bytes_down)
+
+            try:
+                with open(part_fn, mode) as ofh:
+                    ofh.seek(offset)
+                    bytes_down = sh.pipe_in_out(conn, ofh, chunk_cb=update_bar, hasher=hasher,
+                                                sparse=self.sparse)
+            finally:
+                if p_bar:
+                    p_bar.finish()
+            if c_len is not None and bytes_down != c_len:
+                raise IOError("Download of %s ended early (got %s of %s bytes)" % (uri, bytes_down, c_len))
+            return offset + bytes_down
+
+    def _probe(self, uri):
+        request = urllib2.Request(uri)
+        request.get_method = lambda: 'HEAD'
+        with contextlib.closing(urllib2.urlopen(request, timeout=self.timeout)) as conn:
+            accepts = conn.headers.get('accept-ranges', '').strip().lower()
+            try:
+                size = int(conn.headers.get('content-length'))
+            except (TypeError, ValueError):
+                size = None
+        return (size, accepts == 'bytes')
+
+    def _fetch_segment(self, uri, seg_fn, start, end, progress_cb):
+        request = urllib2.Request(uri)
+        request.add_header('Range', 'bytes=%s-%s' % (start, end))
+        with contextlib.closing(urllib2.urlopen(request, timeout=self.timeout)) as conn:
+            if conn.getcode() != 206:
+                raise IOError("Server did not return the requested range %s-%s of %s" % (start, end, uri))
+            with open(seg_fn, 'r+b') as ofh:
+                ofh.seek(start)
+                bytes_down = sh.pipe_in_out(conn, ofh, chunk_cb=functools.partial(progress_cb, start),
+                                            sparse=self.sparse)
+        if bytes_down != (end - start + 1):
+            raise IOError("Download of range %s-%s of %s ended early (got %s bytes)" % (start, end, uri, bytes_down))
+        return bytes_down
+
+    def _fetch_segmented(self, uri, part_fn):
+        # Returns the size downloaded (or none if it could not be downloaded
+        # in segments, in which case it should be downloaded normally).
+        try:
+            (size, accepts_ranges) = self._probe(uri)
+        except (IOError, httplib.HTTPException) as e:
+            LOG.debug("Could not probe %s for range support: %s", uri, e)
+            return None
+        if not accepts_ranges or not size:
+            return None
+        count = min(self.segments, size // self.min_segment_size)
+        if count <= 1:
+            return None
+        segment_size = size // count
+        ranges = []
+        for i in range(0, count):
+            start = i * segment_size
+            end = start + segment_size - 1
+            if i == count - 1:
+                end = size - 1
+            ranges.append((start, end))
+        # Segments are written into their place in a preallocated (sparse) file
+        # which is kept apart from the resumable part file (since it will
+        # have holes in it until all the segments finish).
+        seg_fn = "%s.segments" % (self.store_where)
+        with open(seg_fn, 'wb') as fh:
+            fh.truncate(size)
+        LOG.info("Downloading %s in %s segments of ~%s bytes.", colorizer.quote(uri), count, segment_size)
         p_bar = None
+        if not self.quiet:
+            p_bar = self._make_bar(size)
+            p_bar.start()
+        progress = {}
+        progress_lock = threading.Lock()
 
-        def update_bar(progress_bar, bytes_down):
-            if progress_bar:
-                progress_bar.update(bytes_down)
+        def update_bar(start, bytes_down):
+            with progress_lock:
+                progress[start] = bytes_down
+                if p_bar:
+                    p_bar.update(sum(progress.values()))
 
         try:
-            with contextlib.closing(urllib2.urlopen(self.uri, timeout=self.timeout)) as conn:
-                c_len = conn.headers.get('content-length')
-                if c_len is not None:
-                    try:
-                        p_bar = self._make_bar(int(c_len))
-                        p_bar.start()
-                    except ValueError:
-                        pass
-                with open(self.store_where, 'wb') as ofh:
-                    return (self.store_where, sh.pipe_in_out(conn, ofh,
-                                                             chunk_cb=functools.partial(update_bar, p_bar)))
+            results = utils.run_in_parallel(lambda r: self._fetch_segment(uri, seg_fn, r[0], r[1], update_bar),
+                                            ranges, count)
         finally:
             if p_bar:
                 p_bar.finish()
+        failures = [exc_info for (_r, _got, exc_info) in results if exc_info]
+        if failures:
+            sh.unlink(seg_fn)
+            LOG.warn("Downloading %s in segments failed (%s), falling back to a single stream.",
+                     colorizer.quote(uri), failures[0][1])
+            return None
+        os.rename(seg_fn, part_fn)
+        return size
+
+    def _make_hashers(self, algo):
+        # The hasher for the checksum being verified against (if any) and
+        # one for the md5 of the download (which may be the same one)
+        hasher = None
+        if algo:
+            hasher = hashlib.new(algo)
+        if algo == 'md5':
+            return (hasher, hasher)
+        return (hasher, hashlib.md5())
+
+    def _hash_file(self, path, hasher):
+        if hasher is None:
+            return
+        with open(path, 'rb') as fh:
+            sh.pipe_in_out(fh, _NullWriter(), hasher=hasher)
+
+    def _is_retryable(self, e):
+        if isinstance(e, urllib2.HTTPError):
+            # Client errors (except timeouts) will not get better by trying again
+            return not (400 <= e.code < 500) or e.code in (408, 416)
+        return True
+
+    def download(self):
+        try:
+            return self._download()
+        finally:
+            self.stats.save()
+
+    def _download(self):
+        (uris, checksum) = self._split_uris()
+        if len(uris) > 1:
+            uris = self._rank(uris)
+        if not checksum and self.check_sidecars:
+            checksum = self._find_sidecar_checksum(uris[0])
+        algo = None
+        digest = None
+        if checksum:
+            (algo, digest) = _parse_checksum(checksum)
+        LOG.info('Downloading using urllib2: %s to %s.', colorizer.quote(uris[0]), colorizer.quote(self.store_where))
+        part_fn = "%s.part" % (self.store_where)
+        hasher = None
+        md5_hasher = None
+        size = None
+        if self.segments > 1 and not sh.isfile(part_fn):
+            size = self._fetch_segmented(uris[0], part_fn)
+            if size is not None and algo:
+                # Segments arrive out of order so verify the stitched file
+                (hasher, md5_hasher) = self._make_hashers(algo)
+                self._hash_file(part_fn, _MultiHasher([hasher, md5_hasher]))
+        attempt = 0
+        index = 0
+        while size is None:
+            uri = uris[index]
+            (hasher, md5_hasher) = self._make_hashers(algo)
+            had = 0
+            if sh.isfile(part_fn):
+                had = os.path.getsize(part_fn)
+            start = time.time()
+            try:
+                size = self._fetch(uri, part_fn, _MultiHasher([hasher, md5_hasher]),
+                                   verifiable=hasher is not None)
+                self.stats.record_transfer(uri, size - had, time.time() - start)
+            except (IOError, httplib.HTTPException) as e:
+                self.stats.record_failure(uri)
+                if index + 1 < len(uris):
+                    # Resume from the next mirror (it might not have the
+                    # same problem, or might have the file at all...)
+                    index += 1
+                    LOG.warn("Downloading %s failed (%s), failing over to %s.",
+                             colorizer.quote(uri), e, colorizer.quote(uris[index]))
+                    continue
+                if attempt >= self.retries or not self._is_retryable(e):
+                    raise
+                delay = self.retry_delay * (2 ** attempt)
+                attempt += 1
+                index = 0
+                LOG.warn("Downloading %s failed (%s), retrying (%s of %s) in %.1f seconds.",
+                         colorizer.quote(uri), e, attempt, self.retries, delay)
+                time.sleep(delay)
+        if hasher is not None:
+            if hasher.hexdigest() != digest:
+                # Do not resume from this again, it is not what was wanted...
+                sh.unlink(part_fn)
+                sh.unlink(self._validator_fn(part_fn))
+                raise IOError("Downloaded %s does not match its %s checksum (expected %s but got %s)"
+                              % (self.uri, algo, digest, hasher.hexdigest()))
+            LOG.info("Verified %s checksum of %s.", algo, colorizer.quote(self.uri))
+        # Only complete (and verified) downloads ever show up at the final location
+        os.rename(part_fn, self.store_where)
+        sh.unlink(self._validator_fn(part_fn))
+        if md5_hasher is not None:
+            self.md5 = md5_hasher.hexdigest()
+        return (self.store_where, size)
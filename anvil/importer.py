@@ -16,13 +16,65 @@
 #    under the License.
 
 import sys
+import threading
 
 from anvil import log as logging
-from anvil import utils
 
 LOG = logging.getLogger(__name__)
 
 
+class LazyModule(object):
+    """
+    Stands in for a module that is only imported when one of its attributes
+    is first used; for modules that are slow to import (or that pull in
+    large dependencies) which many runs of anvil never end up using.
+    """
+
+    def __init__(self, module_name):
+        self.__dict__['_module_name'] = module_name
+        self.__dict__['_module'] = None
+        self.__dict__['_lock'] = threading.Lock()
+
+    def _load(self):
+        module = self.__dict__['_module']
+        if module is None:
+            with self.__dict__['_lock']:
+                module = self.__dict__['_module']
+                if module is None:
+                    module_name = self.__dict__['_module_name']
+                    LOG.debug("Importing module: %s (on first use)", module_name)
+                    __import__(module_name)
+                    module = sys.modules[module_name]
+                    self.__dict__['_module'] = module
+        return module
+
+    def __getattr__(self, name):
+        return getattr(self._load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._load(), name, value)
+
+    def __repr__(self):
+        if self.__dict__['_module'] is None:
+            return "<lazy module %r (not yet imported)>" % (self.__dict__['_module_name'])
+        return repr(self.__dict__['_module'])
+
+
+def lazy_import(module_name):
+    """
+    Returns the module (if it was already imported) or a lazy module that
+    imports it when it is first used.
+    """
+    module = sys.modules.get(module_name)
+    if module is not None:
+        return module
+    return LazyModule(module_name)
+
+
+# Avoids the import cycle (utils lazily imports its dependencies using this module)
+utils = lazy_import('anvil.utils')
+
+
 def construct_entry_point(fullname, *args, **kwargs):
     cls = import_entry_point(fullname)
     LOG.debug("Constructing %r (%s)", fullname, cls)
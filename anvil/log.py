@@ -48,12 +48,14 @@ log = logging.log
 
 # Nice translator
 getLevelName = logging.getLevelName
+makeLogRecord = logging.makeLogRecord
 
 # Classes
 root = logging.root
 Formatter = logging.Formatter
 
 # Handlers
+Handler = logging.Handler
 StreamHandler = logging.StreamHandler
 WatchedFileHandler = WatchedFileHandler
 SysLogHandler = SysLogHandler
@@ -18,6 +18,7 @@ from optparse import IndentedHelpFormatter
 from optparse import (OptionParser, OptionGroup, OptionValueError)
 
 from anvil import actions
+from anvil import daemon
 from anvil import settings
 from anvil import shell as sh
 from anvil import utils
@@ -90,13 +91,19 @@ def parse(previous_settings=None):
                           type="string",
                           dest="action",
                           metavar="ACTION",
-                          help="required action to perform: %s" % (_format_list(actions.names())))
+                          help="required action to perform: %s" % (_format_list(actions.names() + [daemon.SERVE_ACTION])))
     base_group.add_option("-d", "--directory",
                           action="store",
                           type="string",
                           dest="dir",
                           metavar="DIR",
                           help=("empty root DIR or DIR with existing components"))
+    base_group.add_option("--use-daemon",
+                          action="store_true",
+                          dest="use_daemon",
+                          default=False,
+                          help=("have the daemon serving DIR (started with the '%s' action)"
+                                " perform ACTION (default: %%default)" % (daemon.SERVE_ACTION)))
     parser.add_option_group(base_group)
 
     suffixes = ("Known suffixes 'K' (kilobyte, 1024),"
@@ -128,6 +135,14 @@ def parse(previous_settings=None):
                                 default=False,
                                 help=("when installing only perform the"
                                       " download and install phases (default: %default)"))
+    install_group.add_option("--download-workers",
+                                action="store",
+                                type="int",
+                                dest="download_workers",
+                                default=4,
+                                metavar="NUMBER",
+                                help=("when installing download (clone) at most this many"
+                                      " components at the same time (default: %default)"))
     parser.add_option_group(install_group)
 
     uninstall_group = OptionGroup(parser, "Uninstall specific options")
@@ -152,7 +167,9 @@ def parse(previous_settings=None):
     values['action'] = (options.action or "")
     values['persona_fn'] = options.persona_fn
     values['verbose'] = options.verbose
+    values['use_daemon'] = options.use_daemon
     values['only_configure'] = options.only_configure
+    values['download_workers'] = max(1, options.download_workers)
     values['prompt_for_passwords'] = options.prompt_for_passwords
     values['show_amount'] = max(0, options.show_amount)
     values['store_passwords'] = options.store_passwords
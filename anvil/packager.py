@@ -43,11 +43,14 @@ class Packager(object):
         else:
             LOG.debug("Skipping install of %r since %s is already there.", pkg['name'], installed_already)
 
-    def remove(self, pkg):
+    def _should_remove(self, pkg):
         should_remove = self.remove_default
         if 'removable' in pkg:
             should_remove = type_utils.make_bool(pkg['removable'])
-        if not should_remove:
+        return should_remove
+
+    def remove(self, pkg):
+        if not self._should_remove(pkg):
             return False
         self._remove(pkg)
         return True
@@ -14,18 +14,38 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+from distutils import sysconfig
 from distutils import version as vr
 
-import copy
-import pkg_resources
+import os
+import sys
+import time
 
+from anvil import importer
 from anvil import log as logging
 from anvil import shell as sh
 
+from anvil.utils import OrderedDict
+
 LOG = logging.getLogger(__name__)
 
+pkg_resources = importer.lazy_import('pkg_resources')
+
 FREEZE_CMD = ['freeze', '--local']
 
+# Ran by a python interpreter other than the one running anvil to get
+# the same directories that _site_paths() would of found for it
+SITE_PATHS_SCRIPT = """
+import os
+import sys
+from distutils import sysconfig
+for plat_specific in [False, True]:
+    print(sysconfig.get_python_lib(plat_specific=plat_specific))
+for path in sys.path:
+    if os.path.basename(path) in ['site-packages', 'dist-packages']:
+        print(path)
+"""
+
 
 class Requirement(object):
     def __init__(self, name, version=None):
@@ -70,29 +90,224 @@ def parse_requirements(contents, adjust=False):
     return requires
 
 
+class InstalledIndex(object):
+    """Index of the python distributions installed in site-packages.
+
+    Built in-process from the egg/dist-info metadata found in the site
+    directories (instead of running 'pip freeze'), when marked stale only
+    the site directories whose modification times changed are rescanned.
+    """
+
+    def __init__(self, paths):
+        self.paths = list(paths)
+        self.stale = True
+        self._scanned = {}
+        self._installed = OrderedDict()
+
+    def _scan(self, path):
+        dists = list(pkg_resources.find_distributions(path, only=True))
+        for entry in sorted(os.listdir(path)):
+            if entry.lower().endswith('.egg'):
+                dists.extend(pkg_resources.find_distributions(os.path.join(path, entry)))
+        return [d.as_requirement() for d in dists]
+
+    def _needs_scan(self, path, mtime):
+        if path not in self._scanned:
+            return True
+        (old_mtime, scanned_at, _reqs) = self._scanned[path]
+        if old_mtime != mtime:
+            return True
+        # File system timestamps may be coarse (ie 1 second) so a change
+        # made just around when we scanned could of been missed...
+        if mtime is not None and mtime >= (scanned_at - 1):
+            return True
+        return False
+
+    def refresh(self):
+        changed = False
+        for path in self.paths:
+            try:
+                mtime = os.stat(path).st_mtime
+            except OSError:
+                mtime = None
+            if not self._needs_scan(path, mtime):
+                continue
+            LOG.debug("Scanning %r for installed python distributions.", path)
+            reqs = []
+            scanned_at = time.time()
+            if mtime is not None:
+                try:
+                    reqs = self._scan(path)
+                except (IOError, OSError) as e:
+                    LOG.warn("Failed scanning %r for installed python distributions: %s", path, e)
+            self._scanned[path] = (mtime, scanned_at, reqs)
+            changed = True
+        if changed:
+            installed = OrderedDict()
+            # Like the python path, earlier directories take precedence
+            for path in self.paths:
+                for req in self._scanned[path][2]:
+                    if req.key not in installed:
+                        installed[req.key] = req
+            self._installed = installed
+        self.stale = False
+        return changed
+
+    def _ensure_fresh(self):
+        if self.stale:
+            self.refresh()
+
+    def get_installed(self, name):
+        self._ensure_fresh()
+        return self._installed.get(Requirement(name).key)
+
+    def list_installed(self):
+        self._ensure_fresh()
+        return list(self._installed.values())
+
+
+class FrozenIndex(object):
+    """Index of the python distributions a pip command reports via 'pip freeze'.
+
+    Used when the site directories of the python interpreter behind the
+    pip command can not be determined (so they can not be scanned).
+    """
+
+    def __init__(self, pip_cmd):
+        self.pip_cmd = list(pip_cmd)
+        self.stale = True
+        self._installed = OrderedDict()
+
+    def refresh(self):
+        cmd = self.pip_cmd + FREEZE_CMD
+        (stdout, _stderr) = sh.execute(*cmd)
+        installed = OrderedDict()
+        for req in parse_requirements(stdout):
+            if req.key not in installed:
+                installed[req.key] = req
+        self._installed = installed
+        self.stale = False
+        return True
+
+    def _ensure_fresh(self):
+        if self.stale:
+            self.refresh()
+
+    def get_installed(self, name):
+        self._ensure_fresh()
+        return self._installed.get(Requirement(name).key)
+
+    def list_installed(self):
+        self._ensure_fresh()
+        return list(self._installed.values())
+
+
+def _pip_python(pip_cmd):
+    # Finds the python interpreter that the pip command runs with (or none
+    # if that can not be determined), either 'python -m pip' or a pip script
+    if len(pip_cmd) >= 3 and pip_cmd[1:3] == ['-m', 'pip']:
+        return sh.which(pip_cmd[0]) or pip_cmd[0]
+    if len(pip_cmd) != 1:
+        return None
+    pip_path = pip_cmd[0]
+    if not os.path.isabs(pip_path):
+        pip_path = sh.which(pip_path)
+    if not pip_path or not os.path.isfile(pip_path):
+        return None
+    try:
+        with open(pip_path, 'rb') as fh:
+            first_line = fh.readline(1024)
+    except IOError:
+        return None
+    if not first_line.startswith("#!"):
+        return None
+    interp = first_line[2:].strip().split()
+    if interp and os.path.basename(interp[0]) == 'env':
+        interp = interp[1:]
+    if not interp:
+        return None
+    if os.path.isabs(interp[0]):
+        return interp[0]
+    return sh.which(interp[0])
+
+
+def _same_python(python):
+    try:
+        return os.path.samefile(python, sys.executable)
+    except OSError:
+        return False
+
+
+def _site_paths(python=None):
+    # The directories that 'pip freeze --local' would of looked at (using
+    # the given python interpreter or the one running anvil if not given)
+    paths = []
+    if python is None or _same_python(python):
+        for plat_specific in [False, True]:
+            paths.append(sysconfig.get_python_lib(plat_specific=plat_specific))
+        for path in sys.path:
+            if os.path.basename(path) in ['site-packages', 'dist-packages']:
+                paths.append(path)
+    else:
+        (stdout, _stderr) = sh.execute(python, '-c', SITE_PATHS_SCRIPT)
+        for line in stdout.splitlines():
+            line = line.strip()
+            if line:
+                paths.append(line)
+    site_paths = []
+    for path in paths:
+        path = os.path.abspath(path)
+        if path not in site_paths and os.path.isdir(path):
+            site_paths.append(path)
+    return site_paths
+
+
 class Helper(object):
     # Cache of whats installed
     _installed_cache = {}
 
     def __init__(self, call_how):
-        if not isinstance(call_how, (basestring, str)):
+        if not isinstance(call_how, (basestring, str, list, tuple)):
             # Assume u are passing in a distro object
-            self._pip_how = str(call_how.get_command_config('pip'))
-        else:
-            self._pip_how = call_how
+            call_how = call_how.get_command_config('pip')
+        if not isinstance(call_how, (list, tuple)):
+            call_how = [call_how]
+        self._pip_cmd = [str(c) for c in call_how]
+        self._pip_how = " ".join(self._pip_cmd)
 
-    def _list_installed(self):
-        cmd = [self._pip_how] + FREEZE_CMD
-        (stdout, _stderr) = sh.execute(*cmd)
-        return parse_requirements(stdout, True)
+    def _make_index(self):
+        # Only scan the site directories of the python that the pip command
+        # installs into, if those can't be found ask pip what it has instead
+        python = _pip_python(self._pip_cmd)
+        if python:
+            try:
+                paths = _site_paths(python)
+            except (IOError, OSError) as e:
+                LOG.warn("Failed finding the site directories of %r: %s", python, e)
+                paths = []
+            if paths:
+                return InstalledIndex(paths)
+        LOG.debug("Using 'pip freeze' to find what %r has installed.", self._pip_how)
+        return FrozenIndex(self._pip_cmd)
+
+    def _get_index(self):
+        if not (self._pip_how in Helper._installed_cache):
+            Helper._installed_cache[self._pip_how] = self._make_index()
+        return Helper._installed_cache[self._pip_how]
 
     def uncache(self):
-        Helper._installed_cache.pop(self._pip_how, None)
+        # The next lookup will rescan whichever site directories changed
+        self._get_index().stale = True
+
+    @staticmethod
+    def uncache_all():
+        # Used by long running processes (ie the daemon) that can not know
+        # if something else installed or removed pips since the last lookup
+        for index in Helper._installed_cache.values():
+            index.stale = True
 
     def whats_installed(self):
-        if not (self._pip_how in Helper._installed_cache):
-            Helper._installed_cache[self._pip_how] = self._list_installed()
-        return copy.copy(Helper._installed_cache[self._pip_how])
+        return self._get_index().list_installed()
 
     def is_installed(self, name):
         if self.get_installed(name):
@@ -100,10 +315,4 @@ class Helper(object):
         return False
 
     def get_installed(self, name):
-        whats_there = self.whats_installed()
-        wanted_package = Requirement(name)
-        for whats_installed in whats_there:
-            if not (wanted_package.key == whats_installed.key):
-                continue
-            return whats_installed
-        return None
+        return self._get_index().get_installed(name)
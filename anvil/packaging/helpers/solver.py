@@ -0,0 +1,175 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from anvil import log as logging
+
+from anvil.packaging import pip
+
+from anvil.utils import OrderedDict
+
+LOG = logging.getLogger(__name__)
+
+UPGRADE_OPTS = ['-U', '--upgrade']
+
+
+class Solution(object):
+    def __init__(self):
+        # Requirement key -> version (or None if any version will do)
+        self.pips = OrderedDict()
+        # Package name -> version (or None if any version will do)
+        self.packages = OrderedDict()
+        # Problems that make the above not consistent
+        self.conflicts = []
+        # Problems that may or may not be problems
+        self.warnings = []
+
+    def pin_pip(self, pip_info):
+        # The pip (a copy of it) at the version selected for every component
+        req = pip.extract_requirement(pip_info)
+        version = self.pips.get(req.key)
+        if version is None or str(req.version) == version:
+            return pip_info
+        pip_info = dict(pip_info)
+        pip_info['version'] = version
+        return pip_info
+
+    def pin_package(self, pkg_info):
+        # The package (a copy of it) at the version selected for every component
+        name = pkg_info.get('name', '').strip()
+        version = self.packages.get(name)
+        if version is None or str(pkg_info.get('version')) == version:
+            return pkg_info
+        pkg_info = dict(pkg_info)
+        pkg_info['version'] = version
+        return pkg_info
+
+
+class Solver(object):
+    """Finds a version for every package and pip a set of components want.
+
+    All the packages, pips and pip requirements (from requirement files)
+    are added first and then solved in one go so that all the conflicts
+    between them are found (and reported) at the same time. The versions
+    selected are then what gets installed (see pin_pip and pin_package).
+    """
+
+    def __init__(self):
+        self._pips = OrderedDict()
+        self._packages = OrderedDict()
+        self._requirements = []
+
+    def add_pip(self, who, pip_info):
+        req = pip.extract_requirement(pip_info)
+        options = pip_info.get('options') or []
+        if not isinstance(options, (list, tuple, set)):
+            options = [options]
+        upgrade = False
+        for opt in options:
+            if str(opt) in UPGRADE_OPTS:
+                upgrade = True
+        self._pips.setdefault(req.key, []).append((who, req, upgrade))
+
+    def add_package(self, who, pkg_info):
+        name = pkg_info.get('name', '').strip()
+        if not name:
+            raise ValueError("Package provided with an empty name")
+        version = pkg_info.get('version')
+        if version is not None:
+            version = str(version)
+        self._packages.setdefault(name, []).append((who, version))
+
+    def add_requirement(self, who, details):
+        self._requirements.append((who, details))
+
+    def _solve_pips(self, solution, installed):
+        for (key, entries) in self._pips.items():
+            wanted = OrderedDict()
+            upgrade = False
+            for (who, req, req_upgrade) in entries:
+                upgrade = upgrade or req_upgrade
+                if req.version is not None:
+                    wanted.setdefault(str(req.version), []).append(who)
+            versions = list(wanted.keys())
+            if len(versions) > 1:
+                msg = "Pip '%s' is wanted at different versions (%s)" % (key, self._explain(wanted))
+                if upgrade:
+                    # The last one installed will upgrade over the others
+                    solution.warnings.append(msg)
+                else:
+                    solution.conflicts.append(msg)
+            version = None
+            if versions:
+                version = versions[-1]
+            solution.pips[key] = version
+            if installed and version is not None and not upgrade:
+                there = installed(entries[0][1].name)
+                if there and version not in there:
+                    solution.conflicts.append(("Pip %s is already installed and it is not compatible"
+                                               " with pip '%s==%s' wanted by %s")
+                                              % (there, key, version, self._explain(wanted)))
+
+    def _solve_packages(self, solution):
+        for (name, entries) in self._packages.items():
+            wanted = OrderedDict()
+            for (who, version) in entries:
+                if version is not None:
+                    wanted.setdefault(version, []).append(who)
+            versions = list(wanted.keys())
+            if len(versions) > 1:
+                # The package manager will keep whichever newer one gets
+                # installed first (and skip the older ones) so this
+                # may or may not be a problem...
+                solution.warnings.append("Package '%s' is wanted at different versions (%s)"
+                                         % (name, self._explain(wanted)))
+            version = None
+            if versions:
+                version = versions[-1]
+            solution.packages[name] = version
+
+    def _solve_requirements(self, solution):
+        for (who, details) in self._requirements:
+            req = details['requirement']
+            pkg_info = details['package']
+            if not pkg_info:
+                solution.conflicts.append(("Pip dependency '%s' needed by '%s' is not translatable to a listed"
+                                           " (from this or previously activated components) pip package"
+                                           " or a pip->package mapping") % (req, details['needed_by']))
+                continue
+            if not details['from_pip'] or not req.specs:
+                continue
+            there = pip.extract_requirement(pkg_info)
+            version = solution.pips.get(there.key)
+            if version is not None and version not in req:
+                solution.conflicts.append("Pip dependency '%s' needed by '%s' (of %s) is not satisfied by the selected '%s==%s'"
+                                          % (req, details['needed_by'], who, there.key, version))
+
+    def _explain(self, wanted):
+        explained = []
+        for (version, whos) in wanted.items():
+            explained.append("%s by %s" % (version, ", ".join(sorted(set(whos)))))
+        return "; ".join(explained)
+
+    def solve(self, installed=None):
+        """
+        Solves what was added, the optional installed callable (given a pip
+        name it should return the requirement installed or None) is used to
+        find pips that are already installed at incompatible versions.
+        """
+        solution = Solution()
+        self._solve_pips(solution, installed)
+        self._solve_packages(solution)
+        self._solve_requirements(solution)
+        return solution
@@ -0,0 +1,139 @@
+# vim: tabstop=4 shiftwidth=4 softtabstop=4
+
+#    Copyright (C) 2012 Yahoo! Inc. All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+from distutils import util as dutil
+
+import re
+import sys
+
+from anvil import colorizer
+from anvil import exceptions as excp
+from anvil import importer
+from anvil import log as logging
+from anvil import shell as sh
+from anvil import utils
+
+LOG = logging.getLogger(__name__)
+
+pkg_resources = importer.lazy_import('pkg_resources')
+
+# Dependencies get wheels built as well, since installing (with no index)
+# from the wheelhouse can only find what is in it.
+WHEEL_CMD_OPTS = ['wheel', '-q']
+
+# See: http://www.python.org/dev/peps/pep-0427/#file-name-convention
+WHEEL_FN_RE = re.compile(r"^(?P<name>[^-]+)-(?P<version>[^-]+)(-\d[^-]*)?-[^-]+-[^-]+-[^-]+\.whl$")
+
+
+def _wheel_key(name):
+    # Wheels escape '-' in the distribution name as '_'
+    return pkg_resources.safe_name(name).lower().replace("-", "_")
+
+
+def abi_tag():
+    # Wheels built here are only reusable by the same python (abi) on the
+    # same platform, so the wheelhouse gets a directory per such combination.
+    py_tag = "cp%s%s" % (sys.version_info[0], sys.version_info[1])
+    if sys.maxunicode == 0x10ffff:
+        py_tag += "mu"
+    else:
+        py_tag += "m"
+    platform = dutil.get_platform().replace("-", "_").replace(".", "_")
+    return "%s-%s" % (py_tag, platform)
+
+
+class Wheelhouse(object):
+    def __init__(self, distro, base_dir, max_workers=4, find_links=None):
+        self.distro = distro
+        self.base_dir = base_dir
+        self.wheel_dir = sh.joinpths(base_dir, abi_tag())
+        self.max_workers = max_workers
+        self.find_links = find_links
+
+    def _get_pip_command(self):
+        pip_cmd = self.distro.get_command_config('pip')
+        if not isinstance(pip_cmd, (list, tuple)):
+            pip_cmd = [pip_cmd]
+        return list(pip_cmd)
+
+    def _list_wheels(self):
+        wheels = {}
+        if not sh.isdir(self.wheel_dir):
+            return wheels
+        for fn in sh.listdir(self.wheel_dir, files_only=True):
+            match = WHEEL_FN_RE.match(sh.basename(fn))
+            if not match:
+                continue
+            key = _wheel_key(match.group('name'))
+            wheels.setdefault(key, []).append(match.group('version'))
+        return wheels
+
+    def has_wheel(self, req, wheels=None):
+        if wheels is None:
+            wheels = self._list_wheels()
+        versions = wheels.get(_wheel_key(req.name), [])
+        if req.version is None:
+            return bool(versions)
+        wanted = pkg_resources.safe_version(str(req.version))
+        for v in versions:
+            if pkg_resources.safe_version(v) == wanted:
+                return True
+        return False
+
+    def install_options(self):
+        return ['--no-index', '--find-links=%s' % (self.wheel_dir)]
+
+    def _build_one(self, req):
+        with utils.tempdir() as tdir:
+            cmd = self._get_pip_command() + WHEEL_CMD_OPTS
+            cmd.append('--wheel-dir=%s' % (tdir))
+            if self.find_links:
+                cmd += ['--no-index', '--find-links=%s' % (self.find_links)]
+            cmd.append(str(req))
+            sh.execute(*cmd)
+            # Only move completed wheels in so that a failed or interrupted
+            # build never leaves a partial wheel in the wheelhouse.
+            built = [fn for fn in sh.listdir(tdir, files_only=True) if fn.endswith('.whl')]
+            if not built:
+                raise excp.DependencyException("No wheel was built for %s" % (req))
+            for fn in built:
+                sh.move(fn, sh.joinpths(self.wheel_dir, sh.basename(fn)))
+            return [sh.basename(fn) for fn in built]
+
+    def build(self, reqs):
+        """
+        Builds wheels (in parallel) for the requirements that are not already
+        in the wheelhouse, returning the requirements that failed to build.
+        """
+        sh.mkdirslist(self.wheel_dir)
+        wheels = self._list_wheels()
+        missing = []
+        seen = set()
+        for req in reqs:
+            if str(req) in seen or self.has_wheel(req, wheels):
+                continue
+            seen.add(str(req))
+            missing.append(req)
+        if not missing:
+            return []
+        utils.log_iterable([str(req) for req in missing], logger=LOG,
+                           header="Building %s wheels into %s" % (len(missing), colorizer.quote(self.wheel_dir)))
+        failures = []
+        for (req, _built, exc_info) in utils.run_in_parallel(self._build_one, missing, self.max_workers):
+            if exc_info:
+                LOG.warn("Failed building a wheel for %s: %s", colorizer.quote(req), exc_info[1])
+                failures.append(req)
+        return failures
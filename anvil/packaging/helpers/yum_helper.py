@@ -14,12 +14,17 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import os
+
+from anvil import importer
 from anvil import shell as sh
 
 # See http://yum.baseurl.org/api/yum-3.2.26/yum-module.html
-from yum import YumBase
+yum = importer.lazy_import('yum')
+yum_packages = importer.lazy_import('yum.packages')
 
-from yum.packages import PackageObject
+# Changes whenever packages are installed or removed
+RPM_DB = '/var/lib/rpm/Packages'
 
 
 class Requirement(object):
@@ -39,26 +44,38 @@ class Requirement(object):
         # can be used to compare against
         # other rpm packages using the
         # standard rpm routines
-        my_pkg = PackageObject()
+        my_pkg = yum_packages.PackageObject()
         my_pkg.name = self.name
         if self.version is not None:
             my_pkg.version = str(self.version)
         return my_pkg
 
 
+def _rpm_db_stamp():
+    try:
+        return os.path.getmtime(RPM_DB)
+    except OSError:
+        return None
+
+
 class Helper(object):
-    # Cache of yumbase object
+    # Cache of yumbase object (and the rpm database stamp it was made at)
     _yum_base = None
+    _yum_base_stamp = None
 
     @staticmethod
     def _get_yum_base():
-        if Helper._yum_base is None:
+        # A long running process (ie the daemon) may see packages change
+        # underneath it, so don't keep answering from a stale yumbase
+        stamp = _rpm_db_stamp()
+        if Helper._yum_base is None or Helper._yum_base_stamp != stamp:
             # This 'root' seems needed...
             # otherwise 'cannot open Packages database in /var/lib/rpm' starts to happen
             with sh.Rooted(True):
-                _yum_base = YumBase()
+                _yum_base = yum.YumBase()
                 _yum_base.setCacheDir(force=True)
             Helper._yum_base = _yum_base
+            Helper._yum_base_stamp = stamp
         return Helper._yum_base
 
     def is_installed(self, name):
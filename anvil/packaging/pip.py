@@ -15,16 +15,19 @@
 #    under the License.
 
 from anvil import exceptions as excp
+from anvil import importer
 from anvil import log as logging
 from anvil import packager as pack
 from anvil import shell as sh
 
-from anvil.packaging.helpers import pip_helper
+from anvil.utils import OrderedDict
 
-import pkg_resources
+from anvil.packaging.helpers import pip_helper
 
 LOG = logging.getLogger(__name__)
 
+pkg_resources = importer.lazy_import('pkg_resources')
+
 PIP_UNINSTALL_CMD_OPTS = ['-y', '-q']
 PIP_INSTALL_CMD_OPTS = ['-q']
 
@@ -96,18 +99,76 @@ class Packager(pack.Packager):
             # not consistent anymore so uncache it
             self.helper.uncache()
 
+    def _get_options(self, pip):
+        options = pip.get('options')
+        if not options:
+            return tuple()
+        if not isinstance(options, (list, tuple, set)):
+            options = [options]
+        return tuple([str(opt) for opt in options])
+
     def _install(self, pip):
         cmd = ['install'] + PIP_INSTALL_CMD_OPTS
-        options = pip.get('options')
-        if options:
-            if not isinstance(options, (list, tuple, set)):
-                options = [str(options)]
-            for opt in options:
-                cmd.append(str(opt))
+        cmd.extend(self._get_options(pip))
         install_what = extract_requirement(pip)
         cmd.append(str(install_what))
         self._execute_pip(cmd)
 
+    def install_batch(self, pips):
+        # Pip options apply to every requirement on the command line so
+        # group the pips that are not already there by the options they
+        # want, each group then needs only a single pip invocation. The
+        # same requirement key may not appear twice in one invocation (pip
+        # rejects double requirements) so those spill into another group.
+        groups = []
+        for p in pips:
+            installed_already = self._anything_there(p)
+            if installed_already:
+                LOG.debug("Skipping install of %r since %s is already there.", p['name'], installed_already)
+                continue
+            options = self._get_options(p)
+            install_what = extract_requirement(p)
+            matched = False
+            for (g_options, g_reqs) in groups:
+                if g_options != options:
+                    continue
+                if install_what.key in g_reqs:
+                    if str(g_reqs[install_what.key]) == str(install_what):
+                        matched = True
+                        break
+                    continue
+                g_reqs[install_what.key] = install_what
+                matched = True
+                break
+            if not matched:
+                g_reqs = OrderedDict()
+                g_reqs[install_what.key] = install_what
+                groups.append((options, g_reqs))
+        for (options, g_reqs) in groups:
+            cmd = ['install'] + PIP_INSTALL_CMD_OPTS
+            cmd.extend(options)
+            cmd.extend([str(req) for req in g_reqs.values()])
+            self._execute_pip(cmd)
+            LOG.debug("Installed %s", ", ".join([str(req) for req in g_reqs.values()]))
+        return len(groups)
+
+    def remove_batch(self, pips):
+        # Returns the pips that were allowed to be removed (whether or not
+        # they were actually installed), mirroring what remove() reports.
+        removable = [p for p in pips if self._should_remove(p)]
+        remove_names = []
+        for p in removable:
+            remove_what = extract_requirement(p)
+            if remove_what.name in remove_names:
+                continue
+            if not self.helper.is_installed(remove_what.name):
+                continue
+            remove_names.append(remove_what.name)
+        if remove_names:
+            cmd = ['uninstall'] + PIP_UNINSTALL_CMD_OPTS + remove_names
+            self._execute_pip(cmd)
+        return removable
+
     def _remove(self, pip):
         # Versions don't seem to matter here...
         remove_what = extract_requirement(pip)
@@ -19,12 +19,12 @@ import binascii
 import getpass
 import os
 
-from keyring.backend import CryptedFileKeyring
-from keyring.backend import UncryptedFileKeyring
-
+from anvil import importer
 from anvil import log as logging
 
 LOG = logging.getLogger(__name__)
+
+keyring_backend = importer.lazy_import('keyring.backend')
 RAND_PW_LEN = 20
 PW_USER = 'anvil'
 
@@ -36,9 +36,9 @@ class KeyringProxy(object):
             path = "%s.crypt" % (path)
         self.path = path
         if keyring_encrypted:
-            self.ring = CryptedFileKeyring()
+            self.ring = keyring_backend.CryptedFileKeyring()
         else:
-            self.ring = UncryptedFileKeyring()
+            self.ring = keyring_backend.UncryptedFileKeyring()
         self.ring.file_path = path
         self.enable_prompt = enable_prompt
         self.random_on_empty = random_on_empty
@@ -14,9 +14,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
-import yaml
-
 from anvil import log as logging
+from anvil import utils
 
 LOG = logging.getLogger(__name__)
 
@@ -40,12 +39,18 @@ class Persona(object):
                 raise RuntimeError("Persona provided component %s but its not supported by the loaded distro" % (c))
 
 
-def load(fn):
+def read_definition(fn):
     # Don't use sh here so that we always
     # read this (even if dry-run)
     with open(fn, 'r') as fh:
         contents = fh.read()
-    cls_kvs = yaml.safe_load(contents)
+    return utils.load_yaml_text(contents)
+
+
+def load(fn, definition=None):
+    if definition is None:
+        definition = read_definition(fn)
+    cls_kvs = dict(definition)
     cls_kvs['source'] = fn
     instance = Persona(**cls_kvs)
     return instance
@@ -16,6 +16,7 @@
 
 import getpass
 import grp
+import io
 import os
 import pwd
 import resource
@@ -26,12 +27,14 @@ import subprocess
 import sys
 import time
 
-import psutil  # http://code.google.com/p/psutil/wiki/Documentation
-
 from anvil import env
 from anvil import exceptions as excp
+from anvil import importer
 from anvil import log as logging
 
+# See: http://code.google.com/p/psutil/wiki/Documentation
+psutil = importer.lazy_import('psutil')
+
 LOG = logging.getLogger(__name__)
 
 SHELL_QUOTE_REPLACERS = {
@@ -50,10 +53,20 @@ SUDO_GID = env.get_key('SUDO_GID')
 # Set only once
 IS_DRYRUN = None
 
+# Made when first used (so that psutil is only imported when needed)
+PROCESS_CLS = None
+
+
+def _make_process(pid):
+    global PROCESS_CLS
+    if PROCESS_CLS is None:
+
+        class Process(psutil.Process):
+            def __str__(self):
+                return "%s (%s)" % (self.pid, self.name)
 
-class Process(psutil.Process):
-    def __str__(self):
-        return "%s (%s)" % (self.pid, self.name)
+        PROCESS_CLS = Process
+    return PROCESS_CLS(pid)
 
 
 class Rooted(object):
@@ -232,22 +245,96 @@ def isuseable(path, options=os.W_OK | os.R_OK | os.X_OK):
     return os.access(path, options)
 
 
+# Transfers start reading in chunks of this size and double it (up to the
+# maximum size) while reads keep filling the chunks asked for...
+PIPE_CHUNK_SIZE = 64 * 1024
+PIPE_MAX_CHUNK_SIZE = 4 * 1024 * 1024
+
+# The chunk callback is called at most this often (in seconds)
+PIPE_CB_INTERVAL = 0.1
+
+# Sparse transfers skip over (instead of writing) blocks of this size that
+# are all zeros, leaving holes in the output file
+SPARSE_BLOCK_SIZE = 64 * 1024
+
+
+def _writes_buffers(out_fh):
+    # Only binary files (and binary io streams) accept buffers (ie memoryviews)
+    # being written, text mode files only accept strings...
+    if isinstance(out_fh, (io.BufferedIOBase, io.RawIOBase)):
+        return True
+    if isinstance(out_fh, file):
+        return 'b' in getattr(out_fh, 'mode', '')
+    return False
+
+
+def _write_sparse(out_fh, data):
+    for i in range(0, len(data), SPARSE_BLOCK_SIZE):
+        block = data[i:i + SPARSE_BLOCK_SIZE]
+        if block.strip('\0'):
+            out_fh.write(block)
+        else:
+            out_fh.seek(len(block), os.SEEK_CUR)
+
+
 # Useful for doing progress bars that get told the current progress
-# for the transfer ever chunk via the chunk callback function that
-# will be called after each chunk has been written...
-def pipe_in_out(in_fh, out_fh, chunk_size=1024, chunk_cb=None):
+# for the transfer via the chunk callback function that will be called
+# after chunks have been written (at most every cb_interval seconds and
+# always once at the end), if a hasher (ie from hashlib) is given it
+# is updated with all the data transferred. When sparse the output file
+# (which must be seekable and not opened for appending) gets holes
+# instead of blocks of zeros.
+def pipe_in_out(in_fh, out_fh, chunk_size=PIPE_CHUNK_SIZE, chunk_cb=None,
+                hasher=None, max_chunk_size=PIPE_MAX_CHUNK_SIZE, cb_interval=PIPE_CB_INTERVAL,
+                sparse=False):
     bytes_piped = 0
-    LOG.debug("Transferring the contents of %s to %s in chunks of size %s.", in_fh, out_fh, chunk_size)
+    bytes_reported = 0
+    last_cb = time.time()
+    max_chunk_size = max(chunk_size, max_chunk_size)
+    LOG.debug("Transferring the contents of %s to %s in chunks of size %s (up to %s).",
+              in_fh, out_fh, chunk_size, max_chunk_size)
+    # Real files can read into a reused buffer (avoiding making a new
+    # string for every chunk) when written to a binary file that accepts
+    # buffers, everything else (sockets, tar members, text mode files...)
+    # gets read and written the normal way.
+    readinto = getattr(in_fh, 'readinto', None)
+    view = None
+    if not sparse and readinto is not None and _writes_buffers(out_fh):
+        view = memoryview(bytearray(max_chunk_size))
     while True:
-        data = in_fh.read(chunk_size)
-        if data == '':
+        if view is not None:
+            data = view[0:readinto(view[0:chunk_size])]
+        else:
+            data = in_fh.read(chunk_size)
+        data_len = len(data)
+        if not data_len:
             # EOF
             break
+        if sparse:
+            _write_sparse(out_fh, data)
         else:
             out_fh.write(data)
-            bytes_piped += len(data)
-            if chunk_cb:
+        if hasher is not None:
+            hasher.update(data)
+        bytes_piped += data_len
+        if data_len == chunk_size and chunk_size < max_chunk_size:
+            chunk_size = min(chunk_size * 2, max_chunk_size)
+        if chunk_cb:
+            now = time.time()
+            if now - last_cb >= cb_interval:
                 chunk_cb(bytes_piped)
+                bytes_reported = bytes_piped
+                last_cb = now
+    if sparse:
+        # A hole at the end still needs to make the file that long (but
+        # never make it shorter, since it may have been preallocated)
+        pos = out_fh.tell()
+        out_fh.seek(0, os.SEEK_END)
+        if pos > out_fh.tell():
+            out_fh.truncate(pos)
+        out_fh.seek(pos)
+    if chunk_cb and bytes_reported != bytes_piped:
+        chunk_cb(bytes_piped)
     return bytes_piped
 
 
@@ -395,7 +482,7 @@ def _attempt_kill(proc, signal_type, max_try, wait_time):
 def kill(pid, max_try=4, wait_time=1):
     if not is_running(pid) or is_dry_run():
         return (True, 0)
-    proc = Process(pid)
+    proc = _make_process(pid)
     # Try the nicer sig-int first...
     (killed, i_attempts) = _attempt_kill(proc, signal.SIGINT, int(max_try / 2), wait_time)
     if killed:
@@ -465,7 +552,7 @@ def is_running(pid):
     if is_dry_run():
         return True
     try:
-        return Process(pid).is_running()
+        return _make_process(pid).is_running()
     except psutil.error.NoSuchProcess:
         return False
 
@@ -755,6 +842,15 @@ def is_executable(fn):
     return isfile(fn) and isuseable(fn, options=os.X_OK)
 
 
+def which(program):
+    # Returns the full path of the program (found in the path) or none
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        fn = joinpths(path.strip('"'), program)
+        if is_executable(fn):
+            return fn
+    return None
+
+
 def geteuid():
     return os.geteuid()
 
@@ -0,0 +1,83 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from anvil import bundle
+from anvil import distro
+from anvil import persona
+
+DISTRO = """
+name: test
+platform_pattern: ".*"
+packager_name: anvil.packaging.yum:YumPackager
+commands: {}
+components:
+    db:
+        action_classes: {}
+"""
+
+PERSONA = """
+components:
+- db
+supports:
+- test
+"""
+
+
+class TestBundle(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.distro_dir = self._make_dir('distros')
+        self.component_dir = self._make_dir('components')
+        self.persona_fn = os.path.join(self.root_dir, 'persona.yaml')
+        self._write(os.path.join(self.distro_dir, 'test.yaml'), DISTRO)
+        self._write(self.persona_fn, PERSONA)
+        self._write(os.path.join(self.component_dir, 'general.yaml'), 'user: "$(auto:user)"\n')
+        self._write(os.path.join(self.component_dir, 'db.yaml'), 'type: mysql\nuser: "$(general:user)"\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def _make_dir(self, name):
+        path = os.path.join(self.root_dir, name)
+        os.makedirs(path)
+        return path
+
+    def _write(self, fn, contents):
+        with open(fn, 'w') as fh:
+            fh.write(contents)
+
+    def _load(self):
+        return bundle.load(self.root_dir, self.distro_dir, self.persona_fn, self.component_dir,
+                           base_names=['general'])
+
+    def test_load(self):
+        config = self._load()
+        self.assertFalse(config.loaded)
+        self.assertEquals(config.options['db']['type'], 'mysql')
+        self.assertEquals(config.options['db']['user'], config.options['general']['user'])
+        dist = distro.load(self.distro_dir, definitions=config.distros)
+        persona.load(self.persona_fn, definition=config.persona).verify(dist)
+        config.save()
+        config = self._load()
+        self.assertTrue(config.loaded)
+        self.assertEquals(config.options['db']['type'], 'mysql')
+        self.assertEquals(dist.name, distro.load(self.distro_dir, definitions=config.distros).name)
+
+    def test_changed(self):
+        self._load().save()
+        # Touching a file (without changing it) keeps the bundle valid
+        db_fn = os.path.join(self.component_dir, 'db.yaml')
+        os.utime(db_fn, (time.time() + 10, time.time() + 10))
+        self.assertTrue(self._load().loaded)
+        self._write(db_fn, 'type: postgres\n')
+        config = self._load()
+        self.assertFalse(config.loaded)
+        self.assertEquals(config.options['db']['type'], 'postgres')
+
+    def test_added(self):
+        self._load().save()
+        self._write(os.path.join(self.component_dir, 'other.yaml'), 'a: b\n')
+        self.assertFalse(self._load().loaded)
@@ -0,0 +1,57 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from anvil import cfg
+from anvil import exceptions as excp
+
+
+class TestYamlInterpolator(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.calls = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _write(self, name, contents):
+        with open(os.path.join(self.base_dir, "%s.yaml" % (name)), 'w') as fh:
+            fh.write(contents)
+
+    def _make(self):
+        interpolator = cfg.YamlInterpolator(self.base_dir)
+
+        def get_ip():
+            self.calls += 1
+            return '10.0.0.1'
+
+        interpolator.auto_specials['ip'] = get_ip
+        return interpolator
+
+    def test_extract(self):
+        self._write('a', 'host: "$(b:host)"\nurl: "http://$(a:host):80"\nlisten: ["$(auto:ip)"]\n')
+        self._write('b', 'host: "$(auto:ip)"\nport: 80\n')
+        interpolator = self._make()
+        a = interpolator.extract('a')
+        self.assertEquals(a['host'], '10.0.0.1')
+        self.assertEquals(a['url'], 'http://10.0.0.1:80')
+        self.assertEquals(a['listen'], ['10.0.0.1'])
+        self.assertEquals(interpolator.extract('b')['port'], 80)
+        # Auto values are only found once
+        self.assertEquals(self.calls, 1)
+
+    def test_dependencies(self):
+        self._write('a', 'host: "$(b:host)"\nurl: "http://$(a:host):80"\n')
+        self._write('b', 'host: "$(b:ip)"\nip: "$(auto:ip)"\n')
+        interpolator = self._make()
+        interpolator.extract('a')
+        self.assertEquals(interpolator.dependencies('a', 'url'),
+                          set([('a', 'host'), ('b', 'host'), ('b', 'ip')]))
+        self.assertEquals(interpolator.dependencies('b', 'ip'), set())
+
+    def test_cycle(self):
+        self._write('a', 'x: "$(b:y)"\n')
+        self._write('b', 'y: "$(a:x)"\n')
+        interpolator = self._make()
+        self.assertRaises(excp.ConfigException, interpolator.extract, 'a')
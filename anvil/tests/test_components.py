@@ -0,0 +1,137 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from anvil import components as comp
+from anvil import utils
+
+
+class FakeInstaller(comp.PkgInstallComponent):
+    def __init__(self, *args, **kargs):
+        comp.PkgInstallComponent.__init__(self, *args, **kargs)
+        self.sources = {
+            'a.conf': 'a=$A\n',
+            'b.conf': 'b=$B\n',
+        }
+        self.rendered = []
+
+    @property
+    def config_files(self):
+        return sorted(self.sources.keys())
+
+    @property
+    def symlinks(self):
+        return {}
+
+    def source_config(self, config_fn):
+        return (config_fn, self.sources[config_fn])
+
+    def config_params(self, config_fn):
+        params = comp.PkgInstallComponent.config_params(self, config_fn)
+        params['A'] = self.get_option('a')
+        params['B'] = self.get_option('b')
+        return params
+
+    def config_programs(self, config_fn):
+        if config_fn == 'a.conf':
+            return ['fake-a']
+        return []
+
+    def config_skippable(self, config_fn):
+        return config_fn != 'b.conf' or not self.get_option('b_side_effects')
+
+    def _config_adjust(self, contents, config_fn):
+        self.rendered.append(config_fn)
+        return contents
+
+
+class FakeRuntime(comp.ProgramRuntime):
+    def __init__(self, *args, **kargs):
+        comp.ProgramRuntime.__init__(self, *args, **kargs)
+        self.restarted = []
+
+    @property
+    def applications(self):
+        return [comp.Program('fake-a'), comp.Program('fake-b')]
+
+    def _restart_programs(self, names):
+        self.restarted.extend(names)
+        return len(names)
+
+
+class TestConfigure(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def _make(self, cls, **options):
+        options['trace_dir'] = os.path.join(self.root_dir, 'traces')
+        options['cfg_dir'] = os.path.join(self.root_dir, 'config')
+        return cls(name='fake', subsystems={}, instances={}, options=options,
+                   siblings={}, distro=None, passwords={})
+
+    def _changes(self):
+        fn = os.path.join(self.root_dir, 'traces', comp.CONFIG_CHANGES_FN)
+        with open(fn) as fh:
+            return utils.load_yaml_text(fh.read())
+
+    def test_unchanged_skipped(self):
+        installer = self._make(FakeInstaller, a=1, b=2)
+        installer.configure()
+        self.assertEqual(['a.conf', 'b.conf'], installer.rendered)
+        installer = self._make(FakeInstaller, a=1, b=2)
+        installer.configure()
+        self.assertEqual([], installer.rendered)
+        with open(os.path.join(self.root_dir, 'config', 'a.conf')) as fh:
+            self.assertEqual('a=1\n', fh.read())
+
+    def test_not_skippable(self):
+        self._make(FakeInstaller, a=1, b=2, b_side_effects=True).configure()
+        os.unlink(os.path.join(self.root_dir, 'traces', comp.CONFIG_CHANGES_FN))
+        installer = self._make(FakeInstaller, a=1, b=2, b_side_effects=True)
+        installer.configure()
+        self.assertEqual(['b.conf'], installer.rendered)
+        # Remade the same so nothing needs restarting
+        self.assertEqual({}, self._changes())
+
+    def test_changed_remade(self):
+        self._make(FakeInstaller, a=1, b=2).configure()
+        installer = self._make(FakeInstaller, a=1, b=2)
+        installer.sources['b.conf'] = 'b=$B!\n'
+        installer.configure()
+        self.assertEqual(['b.conf'], installer.rendered)
+        with open(os.path.join(self.root_dir, 'config', 'b.conf')) as fh:
+            self.assertEqual('b=2!\n', fh.read())
+
+    def test_edited_remade(self):
+        self._make(FakeInstaller, a=1, b=2).configure()
+        with open(os.path.join(self.root_dir, 'config', 'a.conf'), 'w') as fh:
+            fh.write('a=3\n')
+        installer = self._make(FakeInstaller, a=1, b=2)
+        installer.configure()
+        self.assertEqual(['a.conf'], installer.rendered)
+
+    def test_changed_programs(self):
+        self._make(FakeInstaller, a=1, b=2).configure()
+        runtime = self._make(FakeRuntime)
+        self.assertEqual(['fake-a', 'fake-b'], runtime.changed_programs())
+        # Pretend they were started (with the latest configs)
+        os.unlink(os.path.join(self.root_dir, 'traces', comp.CONFIG_CHANGES_FN))
+        self.assertEqual([], runtime.changed_programs())
+        self._make(FakeInstaller, a=5, b=2).configure()
+        changes = self._changes()
+        self.assertEqual([os.path.join(self.root_dir, 'config', 'a.conf')], list(changes.keys()))
+        self.assertEqual(['fake-a'], runtime.changed_programs())
+
+    def test_restart_changed(self):
+        self._make(FakeInstaller, a=1, b=2).configure()
+        os.unlink(os.path.join(self.root_dir, 'traces', comp.CONFIG_CHANGES_FN))
+        self._make(FakeInstaller, a=5, b=2).configure()
+        runtime = self._make(FakeRuntime)
+        self.assertEqual(1, runtime.restart_changed())
+        self.assertEqual(['fake-a'], runtime.restarted)
+        self.assertEqual([], runtime.changed_programs())
+        self.assertEqual(0, runtime.restart_changed())
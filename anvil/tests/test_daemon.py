@@ -0,0 +1,119 @@
+import shutil
+import tempfile
+import threading
+import unittest
+
+from anvil import daemon
+from anvil import exceptions as excp
+from anvil import log as logging
+from anvil import shell as sh
+
+from anvil.tests import test_main
+
+LOG = logging.getLogger(__name__)
+
+
+class FakeDaemon(object):
+    def __init__(self):
+        self.requests = []
+
+    def run(self, request):
+        self.requests.append(request)
+        LOG.info("Running %s", request['action'])
+        if request['action'] == 'broken':
+            raise excp.StartException("It broke")
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.daemon = FakeDaemon()
+        self.server = daemon._UnixServer(daemon.socket_path(self.root_dir), self.daemon)
+        self.client = daemon.Client(self.root_dir)
+        self.handler = RecordingHandler()
+        self.logger = logging.getLogger().logger
+        self.logger.addHandler(self.handler)
+        self.old_level = self.logger.level
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.removeHandler(self.handler)
+        self.logger.setLevel(self.old_level)
+        self.server.server_close()
+        shutil.rmtree(self.root_dir)
+
+    def _run(self, action):
+        serving = threading.Thread(target=self.server.handle_request)
+        serving.start()
+        try:
+            return self.client.run(action, 'persona.yaml', {'dryrun': True})
+        finally:
+            serving.join()
+
+    def test_run(self):
+        result = self._run('status')
+        self.assertEqual('ok', result['result'])
+        request = self.daemon.requests[0]
+        self.assertEqual('status', request['action'])
+        self.assertEqual({'dryrun': True}, request['args'])
+        # Logged once by the daemon and once more when relayed to the client
+        self.assertEqual(2, self.handler.messages.count("Running status"))
+
+    def test_error(self):
+        self.assertRaises(excp.StartException, self._run, 'broken')
+
+    def test_no_daemon(self):
+        self.server.server_close()
+        client = daemon.Client(tempfile.gettempdir() + "/does-not-exist")
+        self.assertRaises(excp.OptionException, client.run, 'status', 'persona.yaml', {})
+
+
+class TestRealDaemon(test_main.MainFixture):
+    def setUp(self):
+        test_main.MainFixture.setUp(self)
+        # Like smithy does before it starts serving
+        sh.set_dry_run(True)
+        self.daemon = daemon.Daemon(self.root_dir)
+        self.server = daemon._UnixServer(self.daemon.path, self.daemon)
+        self.client = daemon.Client(self.root_dir)
+
+    def tearDown(self):
+        self.server.server_close()
+        test_main.MainFixture.tearDown(self)
+
+    def _run(self, args):
+        serving = threading.Thread(target=self.server.handle_request)
+        serving.start()
+        try:
+            return self.client.run(args.pop('action'), args.pop('persona_fn'), args)
+        finally:
+            serving.join()
+
+    def _request_args(self, action, **kwargs):
+        args = self._args(action)
+        args.pop('dir')
+        args.pop('use_daemon')
+        args.update(kwargs)
+        return args
+
+    def test_status(self):
+        for _i in range(0, 2):
+            result = self._run(self._request_args('status'))
+            self.assertEqual('ok', result['result'])
+        # The second request reused what the first loaded
+        self.assertEqual(1, len(self.daemon._loaded))
+        loaded = self.daemon._loaded.values()[0]
+        self.assertEqual(1, len(loaded.runners))
+
+    def test_dry_run_mismatch(self):
+        self.assertRaises(excp.OptionException, self._run,
+                          self._request_args('status', dryrun=False))
@@ -0,0 +1,385 @@
+import BaseHTTPServer
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from anvil import downloader as down
+from anvil import utils
+
+
+class FakeDistro(object):
+    def get_command(self, key, cmd_key):
+        return [key, cmd_key]
+
+
+def git(*args, **kwargs):
+    subprocess.check_call(['git'] + list(args), stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, **kwargs)
+
+
+class TestGitDownloader(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.repos = []
+        for name in ['nova', 'glance', 'keystone']:
+            work_dir = os.path.join(self.base_dir, "%s-work" % (name))
+            bare_dir = os.path.join(self.base_dir, "%s.git" % (name))
+            git('init', '-q', work_dir)
+            with open(os.path.join(work_dir, 'README'), 'w') as fh:
+                fh.write(name)
+            git('add', 'README', cwd=work_dir)
+            git('-c', 'user.name=anvil', '-c', 'user.email=anvil@localhost',
+                'commit', '-q', '-m', name, cwd=work_dir)
+            git('branch', '-M', 'master', cwd=work_dir)
+            git('clone', '-q', '--bare', work_dir, bare_dir)
+            self.repos.append((name, "file://%s" % (bare_dir)))
+
+    def _push_change(self, name, contents):
+        work_dir = os.path.join(self.base_dir, "%s-work" % (name))
+        with open(os.path.join(work_dir, 'README'), 'w') as fh:
+            fh.write(contents)
+        git('-c', 'user.name=anvil', '-c', 'user.email=anvil@localhost',
+            'commit', '-q', '-a', '-m', contents, cwd=work_dir)
+        git('push', '-q', os.path.join(self.base_dir, "%s.git" % (name)), 'master', cwd=work_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _fetch(self, repo):
+        (name, uri) = repo
+        target = os.path.join(self.base_dir, 'checkouts', name)
+        down.GitDownloader(FakeDistro(), uri, target).download()
+        return target
+
+    def test_parallel_download(self):
+        results = utils.run_in_parallel(self._fetch, self.repos, max_workers=3)
+        self.assertEquals(len(results), len(self.repos))
+        for ((name, _uri), (_repo, target, exc_info)) in zip(self.repos, results):
+            self.assertEquals(exc_info, None)
+            with open(os.path.join(target, 'README'), 'r') as fh:
+                self.assertEquals(fh.read(), name)
+
+    def test_failures_collected(self):
+        repos = list(self.repos)
+        repos.append(('missing', "file://%s" % (os.path.join(self.base_dir, 'missing.git'))))
+        results = utils.run_in_parallel(self._fetch, repos, max_workers=2)
+        failed = [repo[0] for (repo, _target, exc_info) in results if exc_info]
+        self.assertEquals(failed, ['missing'])
+
+    def test_mirror_download(self):
+        mirror_dir = os.path.join(self.base_dir, 'mirrors')
+        (name, uri) = self.repos[0]
+        for i in range(0, 2):
+            target = os.path.join(self.base_dir, 'checkouts-%s' % (i), name)
+            down.GitDownloader(FakeDistro(), uri, target, mirror_dir=mirror_dir).download()
+            with open(os.path.join(target, 'README'), 'r') as fh:
+                self.assertEquals(fh.read(), name)
+            origin = subprocess.Popen(['git', 'config', 'remote.origin.url'], cwd=target,
+                                      stdout=subprocess.PIPE).communicate()[0]
+            self.assertEquals(origin.strip(), uri)
+        self.assertEquals(os.listdir(mirror_dir), [down._mirror_name(uri)])
+
+    def test_shallow_download(self):
+        (name, uri) = self.repos[1]
+        target = os.path.join(self.base_dir, 'checkouts', name)
+        down.GitDownloader(FakeDistro(), uri + "?branch=master", target, shallow=True).download()
+        self.assertTrue(os.path.isfile(os.path.join(target, '.git', 'shallow')))
+
+    def test_update(self):
+        (name, uri) = self.repos[2]
+        target = os.path.join(self.base_dir, 'checkouts', name)
+        fetcher = down.GitDownloader(FakeDistro(), uri, target, update=True)
+        self.assertTrue(fetcher.download())
+        self.assertFalse(fetcher.download())
+        self._push_change(name, 'updated')
+        self.assertTrue(fetcher.download())
+        with open(os.path.join(target, 'README'), 'r') as fh:
+            self.assertEquals(fh.read(), 'updated')
+
+    def test_update_keeps_local_changes(self):
+        (name, uri) = self.repos[2]
+        target = os.path.join(self.base_dir, 'checkouts', name)
+        self.assertTrue(down.GitDownloader(FakeDistro(), uri, target).download())
+        self._push_change(name, 'updated')
+        with open(os.path.join(target, 'README'), 'w') as fh:
+            fh.write('local')
+        self.assertFalse(down.GitDownloader(FakeDistro(), uri, target, update=True).download())
+        with open(os.path.join(target, 'README'), 'r') as fh:
+            self.assertEquals(fh.read(), 'local')
+        fetcher = down.GitDownloader(FakeDistro(), uri, target, update=True,
+                                     keep_local_changes=False)
+        self.assertTrue(fetcher.download())
+        with open(os.path.join(target, 'README'), 'r') as fh:
+            self.assertEquals(fh.read(), 'updated')
+
+    def _patch(self, target):
+        # Like applying anvil's download patches
+        with open(os.path.join(target, 'README'), 'w') as fh:
+            fh.write('patched')
+        with open(os.path.join(target, 'PATCHED'), 'w') as fh:
+            fh.write('patched')
+        down.GitDownloader(FakeDistro(), None, target).remember_patched()
+
+    def test_update_undoes_patches(self):
+        (name, uri) = self.repos[2]
+        target = os.path.join(self.base_dir, 'checkouts', name)
+        self.assertTrue(down.GitDownloader(FakeDistro(), uri, target).download())
+        self._patch(target)
+        fetcher = down.GitDownloader(FakeDistro(), uri, target, update=True)
+        # Nothing new upstream, but the patches were undone (and so need
+        # to be applied again)
+        self.assertTrue(fetcher.download())
+        with open(os.path.join(target, 'README'), 'r') as fh:
+            self.assertEquals(fh.read(), name)
+        self.assertFalse(os.path.exists(os.path.join(target, 'PATCHED')))
+        self._patch(target)
+        self._push_change(name, 'updated')
+        self.assertTrue(fetcher.download())
+        with open(os.path.join(target, 'README'), 'r') as fh:
+            self.assertEquals(fh.read(), 'updated')
+
+    def test_update_keeps_edited_patches(self):
+        (name, uri) = self.repos[2]
+        target = os.path.join(self.base_dir, 'checkouts', name)
+        self.assertTrue(down.GitDownloader(FakeDistro(), uri, target).download())
+        self._patch(target)
+        with open(os.path.join(target, 'README'), 'w') as fh:
+            fh.write('local')
+        self.assertFalse(down.GitDownloader(FakeDistro(), uri, target, update=True).download())
+        with open(os.path.join(target, 'README'), 'r') as fh:
+            self.assertEquals(fh.read(), 'local')
+
+    def test_update_reset_is_a_change(self):
+        (name, uri) = self.repos[2]
+        target = os.path.join(self.base_dir, 'checkouts', name)
+        self.assertTrue(down.GitDownloader(FakeDistro(), uri, target).download())
+        with open(os.path.join(target, 'README'), 'w') as fh:
+            fh.write('local')
+        fetcher = down.GitDownloader(FakeDistro(), uri, target, update=True,
+                                     keep_local_changes=False)
+        self.assertTrue(fetcher.download())
+        self.assertFalse(fetcher.download())
+
+
+class RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        if self.path not in self.server.files:
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(self.server.files[self.path])))
+        if self.server.advertise_ranges:
+            self.send_header('Accept-Ranges', 'bytes')
+        self.end_headers()
+
+    def do_GET(self):
+        files = self.server.files
+        if self.path not in files:
+            self.send_error(404)
+            return
+        data = files[self.path]
+        start = 0
+        end = len(data) - 1
+        # Like different mirrors, each host name gives out its own etags
+        etag = '"%s-%s"' % (hashlib.md5(data).hexdigest(), self.headers.get('Host'))
+        rng = self.headers.get('Range')
+        if_range = self.headers.get('If-Range')
+        if if_range and if_range != etag:
+            # Changed since, so send the whole (new) thing instead
+            rng = None
+        if rng and self.server.ranges:
+            (start, end) = rng.split("=", 1)[1].split("-")
+            start = int(start)
+            if end:
+                end = int(end)
+            else:
+                end = len(data) - 1
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.server.resumed += 1
+            self.send_response(206)
+        else:
+            start = 0
+            self.send_response(200)
+        self.server.requests += 1
+        self.send_header('Content-Length', str(end - start + 1))
+        if self.server.etags:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        body = data[start:end + 1]
+        if self.server.cut_short:
+            # Pretend the connection dropped half way
+            self.server.cut_short -= 1
+            body = body[0:len(body) // 2]
+        self.wfile.write(body)
+
+
+class QuietHTTPServer(BaseHTTPServer.HTTPServer):
+    def handle_error(self, request, client_address):
+        # Clients hang up early in some of these tests...
+        pass
+
+
+class TestUrlLibDownloader(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.data = os.urandom(256 * 1024)
+        self.server = QuietHTTPServer(('127.0.0.1', 0), RangeHandler)
+        self.server.files = {'/image.img': self.data}
+        self.server.ranges = True
+        self.server.advertise_ranges = True
+        self.server.cut_short = 0
+        self.server.requests = 0
+        self.server.etags = True
+        self.server.resumed = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.uri = "http://127.0.0.1:%s/image.img" % (self.server.server_port)
+        self.target = os.path.join(self.base_dir, 'image.img')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.base_dir)
+
+    def _download(self, uri=None, **kwargs):
+        kwargs.setdefault('quiet', True)
+        kwargs.setdefault('retry_delay', 0)
+        fetcher = down.UrlLibDownloader(uri or self.uri, self.target, **kwargs)
+        return fetcher.download()
+
+    def _read_target(self):
+        with open(self.target, 'rb') as fh:
+            return fh.read()
+
+    def test_resume(self):
+        self.server.cut_short = 1
+        (fn, size) = self._download()
+        self.assertEquals(fn, self.target)
+        self.assertEquals(size, len(self.data))
+        self.assertEquals(self._read_target(), self.data)
+        self.assertFalse(os.path.exists(self.target + ".part"))
+
+    def test_md5_found(self):
+        md5 = hashlib.md5(self.data).hexdigest()
+        fetcher = down.UrlLibDownloader(self.uri, self.target, quiet=True, retry_delay=0)
+        fetcher.download()
+        self.assertEquals(fetcher.md5, md5)
+        # Also when resumed and when verifying some other checksum
+        self.server.cut_short = 1
+        self.server.files['/image.img.sha256'] = "%s  image.img\n" % (hashlib.sha256(self.data).hexdigest())
+        fetcher = down.UrlLibDownloader(self.uri, self.target, quiet=True, retry_delay=0)
+        fetcher.download()
+        self.assertEquals(fetcher.md5, md5)
+
+    def test_resume_changed(self):
+        self.server.cut_short = 1
+        self.assertRaises(IOError, self._download, retries=0)
+        self.assertTrue(os.path.exists(self.target + ".part"))
+        self.data = os.urandom(len(self.data))
+        self.server.files['/image.img'] = self.data
+        self._download()
+        self.assertEquals(self._read_target(), self.data)
+        self.assertFalse(os.path.exists(self.target + ".part.validator"))
+
+    def test_resume_without_validator(self):
+        self.server.etags = False
+        self.server.cut_short = 1
+        self.assertRaises(IOError, self._download, retries=0)
+        self.data = os.urandom(len(self.data))
+        self.server.files['/image.img'] = self.data
+        self._download()
+        self.assertEquals(self._read_target(), self.data)
+
+    def test_no_range_support(self):
+        self.server.ranges = False
+        self.server.cut_short = 1
+        self._download()
+        self.assertEquals(self._read_target(), self.data)
+
+    def test_fragment_checksum(self):
+        md5 = hashlib.md5(self.data).hexdigest()
+        self._download(uri="%s#md5=%s" % (self.uri, md5))
+        self.assertEquals(self._read_target(), self.data)
+        self.assertRaises(IOError, self._download, uri="%s#md5=%s" % (self.uri, "0" * 32))
+        self.assertFalse(os.path.exists(self.target + ".part"))
+
+    def test_sidecar_checksum(self):
+        self.server.files['/image.img.sha256'] = "%s  image.img\n" % ("0" * 64)
+        self.assertRaises(IOError, self._download)
+        self.assertFalse(os.path.exists(self.target))
+        self.server.files['/image.img.sha256'] = "%s  image.img\n" % (hashlib.sha256(self.data).hexdigest())
+        self._download()
+        self.assertEquals(self._read_target(), self.data)
+
+    def test_sidecar_not_a_digest(self):
+        self.server.files['/image.img.sha256'] = "<html>Not&nbsp;here</html>\n"
+        self.server.files['/image.img.md5'] = "%s  image.img\n" % (hashlib.sha256(self.data).hexdigest())
+        fetcher = down.UrlLibDownloader(self.uri, self.target, quiet=True)
+        self.assertEquals(fetcher._find_sidecar_checksum(self.uri), None)
+        self._download()
+        self.assertEquals(self._read_target(), self.data)
+
+    def test_missing(self):
+        self.assertRaises(IOError, self._download, uri=self.uri + ".missing")
+
+    def test_segmented(self):
+        md5 = hashlib.md5(self.data).hexdigest()
+        (_fn, size) = self._download(uri="%s#md5=%s" % (self.uri, md5),
+                                     segments=4, min_segment_size=1024)
+        self.assertEquals(size, len(self.data))
+        self.assertEquals(self._read_target(), self.data)
+        self.assertEquals(self.server.requests, 4)
+
+    def test_segmented_fallback(self):
+        # Claims to support ranges but then does not...
+        self.server.ranges = False
+        self._download(segments=4, min_segment_size=1024)
+        self.assertEquals(self._read_target(), self.data)
+        self.assertFalse(os.path.exists(self.target + ".segments"))
+
+    def test_mirror_failover(self):
+        stats_fn = os.path.join(self.base_dir, 'mirrors.yaml')
+        dead_uri = "http://127.0.0.1:1/image.img"
+        self._download(uri=[dead_uri, self.uri + ".missing", self.uri],
+                       mirror_stats_fn=stats_fn)
+        self.assertEquals(self._read_target(), self.data)
+        stats = down.MirrorStats(stats_fn)
+        self.assertTrue(stats.get(self.uri, 'throughput') > 0)
+        self.assertTrue(stats.get(dead_uri, 'failures') >= 1)
+
+    def test_mirror_resume(self):
+        # The first mirror drops the connection half way, the download
+        # then resumes from the second one
+        self.server.cut_short = 1
+        other_uri = self.uri.replace("127.0.0.1", "localhost")
+        self._download(uri=[self.uri, other_uri], retries=0)
+        self.assertEquals(self._read_target(), self.data)
+
+    def test_mirror_resume_checksum(self):
+        # The first mirrors etag means nothing to the second one, only the
+        # checksum can tell if resuming from it spliced different files
+        self.server.cut_short = 1
+        md5 = hashlib.md5(self.data).hexdigest()
+        other_uri = self.uri.replace("127.0.0.1", "localhost")
+        self._download(uri=[self.uri, "%s#md5=%s" % (other_uri, md5)], retries=0)
+        self.assertEquals(self._read_target(), self.data)
+        self.assertEquals(self.server.resumed, 1)
+
+    def test_mirror_resume_changed(self):
+        self.server.cut_short = 1
+        md5 = hashlib.md5(self.data).hexdigest()
+        self.server.files['/other.img'] = os.urandom(len(self.data))
+        other_uri = self.uri.replace("127.0.0.1", "localhost").replace("image.img", "other.img")
+        self.assertRaises(IOError, self._download,
+                          uri=[self.uri, "%s#md5=%s" % (other_uri, md5)], retries=0)
+        self.assertFalse(os.path.exists(self.target + ".part"))
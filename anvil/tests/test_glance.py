@@ -0,0 +1,327 @@
+import hashlib
+import os
+import shutil
+import tarfile
+import tempfile
+import threading
+import time
+import unittest
+
+from anvil.components.helpers import glance
+
+from anvil.tests import test_downloader
+
+
+class TestUnpacker(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.arc_fn = os.path.join(self.base_dir, 'cirros-0.3.0-x86_64-uec.tar.gz')
+        members = {
+            'cirros/README': 'readme',
+            'cirros/cirros-0.3.0-x86_64-vmlinuz': 'kernel',
+            'cirros/cirros-0.3.0-x86_64-initrd': 'ramdisk',
+            'cirros/cirros-0.3.0-x86_64-blank.img': 'root',
+            'cirros/cirros-0.3.0-x86_64-blank.img.md5': 'hash',
+            'cirros/.hidden.img': 'hidden',
+        }
+        src_dir = os.path.join(self.base_dir, 'src')
+        with tarfile.open(self.arc_fn, 'w:gz') as tfh:
+            for (name, contents) in sorted(members.items()):
+                fn = os.path.join(src_dir, name)
+                if not os.path.isdir(os.path.dirname(fn)):
+                    os.makedirs(os.path.dirname(fn))
+                with open(fn, 'w') as fh:
+                    fh.write(contents)
+                tfh.add(fn, arcname=name)
+        self.tmp_dir = os.path.join(self.base_dir, 'tmp')
+        os.makedirs(self.tmp_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _check_unpacked(self, info):
+        with open(info['file_name']) as fh:
+            self.assertEquals(fh.read(), 'root')
+        with open(info['kernel']['file_name']) as fh:
+            self.assertEquals(fh.read(), 'kernel')
+        with open(info['ramdisk']['file_name']) as fh:
+            self.assertEquals(fh.read(), 'ramdisk')
+        extracted = os.listdir(os.path.dirname(info['file_name']))
+        self.assertEquals(len(extracted), 3)
+
+    def test_unpack_tar(self):
+        info = glance.Unpacker().unpack(os.path.basename(self.arc_fn), self.arc_fn, self.tmp_dir)
+        self._check_unpacked(info)
+
+    def test_unpack_tar_decompressor(self):
+        decompressors = dict(glance.PARALLEL_DECOMPRESSORS)
+        glance.PARALLEL_DECOMPRESSORS['.gz'] = ['gzip', '-d', '-c']
+        try:
+            info = glance.Unpacker().unpack(os.path.basename(self.arc_fn), self.arc_fn, self.tmp_dir)
+        finally:
+            glance.PARALLEL_DECOMPRESSORS.clear()
+            glance.PARALLEL_DECOMPRESSORS.update(decompressors)
+        self._check_unpacked(info)
+
+
+class FakeImages(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.created = []
+        self.active = 0
+        self.peak = 0
+        self.listings = []
+
+    def list(self, filters=None):
+        with self.lock:
+            self.listings.append(filters)
+            images = list(self.created)
+        if filters and 'name' in filters:
+            images = [image for image in images if image.name == filters['name']]
+        if filters and 'size_min' in filters:
+            images = [image for image in images if filters['size_min'] <= image.size <= filters['size_max']]
+        return images
+
+    def create(self, data, **kwargs):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        try:
+            contents = data.read()
+            time.sleep(0.1)
+        finally:
+            with self.lock:
+                self.active -= 1
+        with self.lock:
+            image = FakeImage(kwargs['name'], "id-%s" % (len(self.created)), kwargs,
+                              checksum=hashlib.md5(contents).hexdigest(), size=len(contents))
+            self.created.append(image)
+        return image
+
+
+class FakeImage(object):
+    def __init__(self, name, image_id, args, checksum=None, size=None):
+        self.name = name
+        self.id = image_id
+        self.args = args
+        self.checksum = checksum
+        self.size = size
+
+
+class FakeClient(object):
+    def __init__(self):
+        self.images = FakeImages()
+
+
+class BrokenImages(FakeImages):
+    def create(self, data, **kwargs):
+        raise RuntimeError("Broken")
+
+
+class BrokenClient(object):
+    def __init__(self):
+        self.images = BrokenImages()
+
+
+class TestUploadService(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.urls = []
+        for name in ['cirros', 'other']:
+            src_dir = os.path.join(self.base_dir, 'src', name)
+            os.makedirs(src_dir)
+            arc_fn = os.path.join(self.base_dir, '%s-uec.tar.gz' % (name))
+            with tarfile.open(arc_fn, 'w:gz') as tfh:
+                for (suffix, contents) in [('vmlinuz', 'kernel'), ('initrd', 'ramdisk'), ('blank.img', 'root')]:
+                    fn = os.path.join(src_dir, "%s-%s" % (name, suffix))
+                    with open(fn, 'w') as fh:
+                        fh.write("%s-%s" % (name, contents))
+                    tfh.add(fn, arcname="%s/%s-%s" % (name, name, suffix))
+            self.urls.append(arc_fn)
+        self.cache_dir = os.path.join(self.base_dir, 'cache')
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _make_service(self, max_uploads):
+        return glance.UploadService({}, {}, cache_dir=self.cache_dir, max_uploads=max_uploads)
+
+    def test_upload(self):
+        client = FakeClient()
+        installed = self._make_service(2)._install_images(client, self.urls, (IOError,))
+        self.assertEquals(installed, 2)
+        created = dict((image.name, image) for image in client.images.created)
+        self.assertEquals(len(created), 6)
+        for name in ['cirros-uec', 'other-uec']:
+            properties = created[name].args['properties']
+            self.assertEquals(properties['kernel_id'], created["%s-vmlinuz" % (name)].id)
+            self.assertEquals(properties['ramdisk_id'], created["%s-initrd" % (name)].id)
+        # The kernel + ramdisk should have been uploaded at the same time
+        self.assertEquals(client.images.peak, 2)
+
+    def test_upload_limit(self):
+        client = FakeClient()
+        installed = self._make_service(1)._install_images(client, self.urls, (IOError,))
+        self.assertEquals(installed, 2)
+        self.assertEquals(client.images.peak, 1)
+
+    def test_upload_unexpected_failure(self):
+        # Uploads that fail unexpectedly fail the install (and don't hang it
+        # even with more images than there is room for in the queue)
+        urls = self.urls * 3
+        self.assertRaises(RuntimeError, self._make_service(1)._install_images,
+                          BrokenClient(), urls, (IOError,))
+
+    def test_upload_existing(self):
+        client = FakeClient()
+        service = self._make_service(2)
+        self.assertEquals(service._install_images(client, self.urls[0:1], (IOError,)), 1)
+        # The same image (with the same contents) is reused (not uploaded again)
+        self.assertEquals(service._install_images(client, self.urls[0:1], (IOError,)), 1)
+        self.assertEquals(len(client.images.created), 3)
+        # Glance was only asked for its images once (for each install)
+        self.assertEquals(client.images.listings, [None, None])
+
+    def test_details_checksums(self):
+        image = glance.Image(FakeClient(), self.urls[0], is_public=True, cache_dir=self.cache_dir)
+        (_name, info) = image.prepare()
+        self.assertEquals(info['checksum'], hashlib.md5('cirros-root').hexdigest())
+        self.assertEquals(info['size'], 11)
+        self.assertEquals(info['kernel']['checksum'], hashlib.md5('cirros-kernel').hexdigest())
+        # Warm runs use what was stored with the cached details
+        (_cache_path, details_path) = image.cache.paths(image.url)
+        with open(details_path) as fh:
+            self.assertTrue(info['checksum'] in fh.read())
+
+    def test_download_checksum(self):
+        # Plain images are checksummed while downloading (not read again)
+        data = os.urandom(64 * 1024)
+        server = test_downloader.QuietHTTPServer(('127.0.0.1', 0), test_downloader.RangeHandler)
+        server.files = {'/plain.img': data}
+        server.ranges = True
+        server.cut_short = 0
+        server.requests = 0
+        server.resumed = 0
+        server.etags = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        hash_file = glance._hash_file
+
+        def no_hash_file(path, *args, **kwargs):
+            raise AssertionError("%s should not have been read again" % (path))
+
+        glance._hash_file = no_hash_file
+        try:
+            url = "http://127.0.0.1:%s/plain.img" % (server.server_port)
+            image = glance.Image(FakeClient(), url, is_public=True, cache_dir=self.cache_dir)
+            (_name, info) = image.prepare()
+        finally:
+            glance._hash_file = hash_file
+            server.shutdown()
+            server.server_close()
+        self.assertEquals(info['checksum'], hashlib.md5(data).hexdigest())
+        self.assertEquals(info['size'], len(data))
+
+    def test_reuse_other_name(self):
+        client = FakeClient()
+        service = self._make_service(2)
+        other_fn = os.path.join(self.base_dir, 'copy-uec.tar.gz')
+        shutil.copyfile(self.urls[0], other_fn)
+        self.assertEquals(service._install_images(client, [self.urls[0], other_fn], (IOError,)), 2)
+        self.assertEquals(len(client.images.created), 3)
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.client = FakeClient()
+        self.client.images.created.append(FakeImage('there', 'id-there', {}))
+
+    def test_listed_once(self):
+        registry = glance.Registry(self.client)
+        self.assertTrue('there' in registry)
+        self.assertFalse('missing' in registry)
+        registry.add('missing', 'id-missing')
+        self.assertTrue('missing' in registry)
+        self.assertEquals(registry.get('missing'), 'id-missing')
+        self.assertEquals(self.client.images.listings, [None])
+
+    def test_find(self):
+        registry = glance.Registry(self.client)
+        self.assertEquals(registry.find('abc', 3), None)
+        registry.add('new', 'id-new', 'abc', 3)
+        self.assertEquals(registry.find('abc', 3), 'id-new')
+        self.assertEquals(registry.find('abc', 4), None)
+        self.assertEquals(self.client.images.listings, [None])
+
+    def test_filter_by_name(self):
+        registry = glance.Registry(self.client, filter_by_name=True)
+        self.assertTrue('there' in registry)
+        self.assertTrue('there' in registry)
+        self.assertFalse('missing' in registry)
+        registry.add('missing', 'id-missing')
+        self.assertTrue('missing' in registry)
+        self.assertEquals(self.client.images.listings, [{'name': 'there'}, {'name': 'missing'}])
+
+
+class TestImageCache(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.cache = glance.ImageCache(self.base_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _populate(self, url, contents):
+        cache_path = self.cache.begin(url)
+        fn = os.path.join(cache_path, 'root.img')
+        with open(fn, 'wb') as fh:
+            fh.write(contents)
+        details = {
+            'file_name': fn,
+            'disk_format': 'raw',
+            'container_format': 'bare',
+            'checksum': hashlib.md5(contents).hexdigest(),
+            'size': len(contents),
+        }
+        return (fn, details)
+
+    def test_populate(self):
+        (fn, details) = self._populate('http://a/root.img', 'root')
+        # Not valid until its details are saved
+        self.assertEquals(self.cache.load('http://a/root.img'), None)
+        self.cache.save('http://a/root.img', details)
+        self.assertEquals(self.cache.load('http://a/root.img')['file_name'], fn)
+        # Repopulating makes it invalid (until saved again)
+        self.cache.begin('http://a/root.img')
+        self.assertEquals(self.cache.load('http://a/root.img'), None)
+
+    def test_truncated(self):
+        (fn, details) = self._populate('http://a/root.img', 'root')
+        self.cache.save('http://a/root.img', details)
+        with open(fn, 'wb') as fh:
+            fh.write('ro')
+        self.assertEquals(self.cache.load('http://a/root.img'), None)
+
+    def test_evict(self):
+        self.cache.max_bytes = 1
+        for (i, url) in enumerate(['http://a/1.img', 'http://a/2.img', 'http://a/3.img']):
+            (_fn, details) = self._populate(url, 'root' * 4096)
+            self.cache.save(url, details)
+            details['last_used'] = i
+            self.cache.save(url, details)
+        # Used ones are kept (even when that means the budget is exceeded)
+        removed = self.cache.evict(keep_urls=['http://a/1.img'])
+        self.assertEquals(len(removed), 2)
+        self.assertTrue(self.cache.load('http://a/1.img'))
+        self.assertEquals(self.cache.load('http://a/2.img'), None)
+
+    def test_scrub(self):
+        for (url, contents) in [('http://a/good.img', 'good'), ('http://a/bad.img', 'bad')]:
+            (fn, details) = self._populate(url, contents)
+            self.cache.save(url, details)
+        with open(self.cache.load('http://a/bad.img')['file_name'], 'wb') as fh:
+            fh.write('BAD')
+        removed = self.cache.scrub()
+        self.assertEquals(removed, [self.cache.paths('http://a/bad.img')[0]])
+        self.assertTrue(self.cache.load('http://a/good.img'))
@@ -0,0 +1,53 @@
+import subprocess
+import sys
+import unittest
+
+# Modules that are slow to import (or drag in large dependency trees) and
+# that should only be imported by the actions that really use them.
+HEAVY_MODULES = [
+    'Cheetah',
+    'keyring',
+    'netifaces',
+    'pkg_resources',
+    'progressbar',
+    'psutil',
+    'yum',
+]
+
+# Generous, this is only meant to catch a heavy import sneaking back in.
+IMPORT_BUDGET = 2.0
+
+CHECK = """
+import sys
+import time
+start = time.time()
+import anvil.__main__
+from anvil import actions
+for name in actions.names():
+    actions.class_for(name)
+elapsed = time.time() - start
+print(elapsed)
+for name in %r:
+    if name in sys.modules:
+        print(name)
+""" % (HEAVY_MODULES,)
+
+
+class TestImports(unittest.TestCase):
+    def _check(self):
+        proc = subprocess.Popen([sys.executable, '-c', CHECK],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        (stdout, stderr) = proc.communicate()
+        self.assertEqual(0, proc.returncode, stderr)
+        lines = stdout.splitlines()
+        return (float(lines[0]), lines[1:])
+
+    def test_heavy_modules_not_imported(self):
+        (_elapsed, loaded) = self._check()
+        self.assertEqual([], loaded)
+
+    def test_import_budget(self):
+        (elapsed, _loaded) = self._check()
+        self.assertTrue(elapsed < IMPORT_BUDGET,
+                        "Importing took %0.3fs (budget %0.3fs)" % (elapsed, IMPORT_BUDGET))
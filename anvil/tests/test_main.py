@@ -0,0 +1,92 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from anvil import __main__ as main
+from anvil import settings
+from anvil import shell as sh
+
+DISTRO = """
+name: test
+platform_pattern: ".*"
+packager_name: anvil.packaging.yum:YumPackager
+commands: {}
+components:
+    db:
+        action_classes:
+            running: anvil.components:EmptyRuntime
+"""
+
+PERSONA = """
+components:
+- db
+supports:
+- test
+"""
+
+
+class MainFixture(unittest.TestCase):
+    """A root directory, distro, persona and component yamls to run with."""
+
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.distro_dir = os.path.join(self.root_dir, 'distros')
+        self.component_dir = os.path.join(self.root_dir, 'components')
+        os.mkdir(self.distro_dir)
+        os.mkdir(self.component_dir)
+        self.persona_fn = os.path.join(self.root_dir, 'persona.yaml')
+        self._write(os.path.join(self.distro_dir, 'test.yaml'), DISTRO)
+        self._write(self.persona_fn, PERSONA)
+        self._write(os.path.join(self.component_dir, 'general.yaml'), 'user: "$(auto:user)"\n')
+        self._write(os.path.join(self.component_dir, 'db.yaml'), 'type: mysql\nuser: "$(general:user)"\n')
+        self.old_settings = (settings.DISTRO_DIR, settings.COMPONENT_CONF_DIR)
+        settings.DISTRO_DIR = self.distro_dir
+        settings.COMPONENT_CONF_DIR = self.component_dir
+        # These write to /etc/anvil (which a test should not touch)
+        self.old_funcs = (main.ensure_anvil_dirs, main.store_current_settings)
+        main.ensure_anvil_dirs = lambda root_dir: None
+        main.store_current_settings = lambda c_settings: None
+        self.old_dry_run = sh.IS_DRYRUN
+        sh.IS_DRYRUN = None
+        self.old_install_root = os.environ.pop('INSTALL_ROOT', None)
+
+    def tearDown(self):
+        (settings.DISTRO_DIR, settings.COMPONENT_CONF_DIR) = self.old_settings
+        (main.ensure_anvil_dirs, main.store_current_settings) = self.old_funcs
+        sh.IS_DRYRUN = self.old_dry_run
+        if self.old_install_root is not None:
+            os.environ['INSTALL_ROOT'] = self.old_install_root
+        shutil.rmtree(self.root_dir)
+
+    def _write(self, fn, contents):
+        with open(fn, 'w') as fh:
+            fh.write(contents)
+
+    def _args(self, action):
+        return {
+            'action': action,
+            'dir': self.root_dir,
+            'download_workers': 1,
+            'dryrun': True,
+            'keyring_encrypted': False,
+            'keyring_path': os.path.join(self.root_dir, 'passwords.cfg'),
+            'match_installed': False,
+            'only_configure': False,
+            'persona_fn': self.persona_fn,
+            'prompt_for_passwords': False,
+            'purge_packages': False,
+            'show_amount': 0,
+            'store_passwords': False,
+            'use_daemon': False,
+            'verbose': False,
+        }
+
+
+class TestMain(MainFixture):
+    def test_status(self):
+        main.run(self._args('status'))
+        self.assertTrue(os.path.isfile(os.path.join(self.root_dir, 'config-bundle.pickle')))
+        # Again (now using the saved bundle)
+        sh.IS_DRYRUN = None
+        main.run(self._args('status'))
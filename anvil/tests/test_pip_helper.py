@@ -0,0 +1,49 @@
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from anvil.packaging.helpers import pip_helper
+
+
+class TestPipHelper(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self._cache = pip_helper.Helper._installed_cache
+        pip_helper.Helper._installed_cache = {}
+
+    def tearDown(self):
+        pip_helper.Helper._installed_cache = self._cache
+        shutil.rmtree(self.base_dir)
+
+    def _write_script(self, contents):
+        fn = os.path.join(self.base_dir, 'pip')
+        with open(fn, 'w') as fh:
+            fh.write(contents)
+        os.chmod(fn, 0755)
+        return fn
+
+    def test_pip_python_module(self):
+        python = pip_helper._pip_python([sys.executable, '-m', 'pip'])
+        self.assertTrue(os.path.samefile(python, sys.executable))
+
+    def test_pip_python_script(self):
+        fn = self._write_script("#!%s\nimport pip\n" % (sys.executable))
+        self.assertEquals(pip_helper._pip_python([fn]), sys.executable)
+        fn = self._write_script("echo 'no interpreter here'\n")
+        self.assertEquals(pip_helper._pip_python([fn]), None)
+
+    def test_same_python_scans_site_paths(self):
+        helper = pip_helper.Helper([sys.executable, '-m', 'pip'])
+        index = helper._get_index()
+        self.assertTrue(isinstance(index, pip_helper.InstalledIndex))
+        self.assertEquals(index.paths, pip_helper._site_paths())
+
+    def test_unknown_python_uses_freeze(self):
+        fn = self._write_script("echo 'Routes==1.12'\necho 'lxml==2.3.5'\n")
+        helper = pip_helper.Helper(['sh', fn])
+        self.assertTrue(isinstance(helper._get_index(), pip_helper.FrozenIndex))
+        self.assertEquals(str(helper.get_installed('routes')), 'Routes==1.12')
+        self.assertFalse(helper.is_installed('nova'))
+        self.assertEquals(len(helper.whats_installed()), 2)
@@ -0,0 +1,92 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from StringIO import StringIO
+
+from anvil import shell as sh
+
+
+class TestPipeInOut(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.data = os.urandom(1024 * 1024) + "tail"
+        self.fn = os.path.join(self.base_dir, 'data')
+        with open(self.fn, 'wb') as fh:
+            fh.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_file_to_file(self):
+        out_fn = os.path.join(self.base_dir, 'out')
+        hasher = hashlib.md5()
+        with open(self.fn, 'rb') as in_fh:
+            with open(out_fn, 'wb') as out_fh:
+                piped = sh.pipe_in_out(in_fh, out_fh, chunk_size=1024, hasher=hasher)
+        self.assertEquals(piped, len(self.data))
+        with open(out_fn, 'rb') as fh:
+            self.assertEquals(fh.read(), self.data)
+        self.assertEquals(hasher.hexdigest(), hashlib.md5(self.data).hexdigest())
+
+    def test_file_to_text_file(self):
+        out_fn = os.path.join(self.base_dir, 'out')
+        with open(self.fn, 'rb') as in_fh:
+            with open(out_fn, 'w') as out_fh:
+                piped = sh.pipe_in_out(in_fh, out_fh, chunk_size=1024)
+        self.assertEquals(piped, len(self.data))
+        with open(out_fn, 'rb') as fh:
+            self.assertEquals(fh.read(), self.data)
+
+    def test_file_to_stringio(self):
+        out_fh = StringIO()
+        with open(self.fn, 'rb') as in_fh:
+            sh.pipe_in_out(in_fh, out_fh)
+        self.assertEquals(out_fh.getvalue(), self.data)
+
+    def test_progress(self):
+        progress = []
+        out_fh = StringIO()
+        sh.pipe_in_out(StringIO(self.data), out_fh, chunk_size=1024,
+                       chunk_cb=progress.append, cb_interval=3600)
+        self.assertEquals(out_fh.getvalue(), self.data)
+        # Rate limited, but the final amount is always reported
+        self.assertEquals(progress, [len(self.data)])
+
+
+class TestSparsePipeInOut(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.hole = "\0" * (4 * 1024 * 1024)
+        self.data = "head" + self.hole + "middle" + self.hole
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _allocated(self, fn):
+        return os.stat(fn).st_blocks * 512
+
+    def test_sparse_write(self):
+        out_fn = os.path.join(self.base_dir, 'out')
+        with open(out_fn, 'wb') as out_fh:
+            piped = sh.pipe_in_out(StringIO(self.data), out_fh, sparse=True)
+        self.assertEquals(piped, len(self.data))
+        self.assertEquals(os.path.getsize(out_fn), len(self.data))
+        with open(out_fn, 'rb') as fh:
+            self.assertEquals(fh.read(), self.data)
+        self.assertTrue(self._allocated(out_fn) < len(self.data) // 2)
+
+    def test_sparse_copy(self):
+        src_fn = os.path.join(self.base_dir, 'src')
+        with open(src_fn, 'wb') as out_fh:
+            sh.pipe_in_out(StringIO(self.data), out_fh, sparse=True)
+        out_fn = os.path.join(self.base_dir, 'out')
+        with open(src_fn, 'rb') as in_fh:
+            with open(out_fn, 'wb') as out_fh:
+                piped = sh.pipe_in_out(in_fh, out_fh, sparse=True)
+        self.assertEquals(piped, len(self.data))
+        with open(out_fn, 'rb') as fh:
+            self.assertEquals(fh.read(), self.data)
+        self.assertTrue(self._allocated(out_fn) < len(self.data) // 2)
@@ -0,0 +1,70 @@
+import unittest
+
+import pkg_resources
+
+from anvil.packaging.helpers import solver
+
+
+class TestSolver(unittest.TestCase):
+    def test_pip_conflict(self):
+        s = solver.Solver()
+        s.add_pip('nova', {'name': 'routes', 'version': '1.12'})
+        s.add_pip('glance', {'name': 'Routes', 'version': '1.13'})
+        s.add_pip('keystone', {'name': 'routes', 'version': '1.13'})
+        solution = s.solve()
+        self.assertEquals(len(solution.conflicts), 1)
+        self.assertEquals(solution.pips['routes'], '1.13')
+
+    def test_pip_upgrade_warns(self):
+        s = solver.Solver()
+        s.add_pip('nova', {'name': 'routes', 'version': '1.12'})
+        s.add_pip('glance', {'name': 'routes', 'version': '1.13', 'options': '-U'})
+        solution = s.solve()
+        self.assertEquals(len(solution.conflicts), 0)
+        self.assertEquals(len(solution.warnings), 1)
+
+    def test_installed_conflict(self):
+        s = solver.Solver()
+        s.add_pip('nova', {'name': 'routes', 'version': '1.12'})
+
+        def installed(name):
+            return pkg_resources.Requirement.parse('%s==1.11' % (name))
+
+        solution = s.solve(installed)
+        self.assertEquals(len(solution.conflicts), 1)
+
+    def test_requirement_not_satisfied(self):
+        s = solver.Solver()
+        s.add_pip('nova', {'name': 'routes', 'version': '1.12'})
+        s.add_requirement('nova', {
+            'requirement': pkg_resources.Requirement.parse('routes>=1.13'),
+            'package': {'name': 'routes', 'version': '1.12'},
+            'needed_by': 'nova',
+            'from_pip': True,
+        })
+        s.add_requirement('nova', {
+            'requirement': pkg_resources.Requirement.parse('lxml'),
+            'package': None,
+            'needed_by': 'nova',
+            'from_pip': False,
+        })
+        solution = s.solve()
+        self.assertEquals(len(solution.conflicts), 2)
+
+    def test_pin(self):
+        s = solver.Solver()
+        s.add_pip('nova', {'name': 'routes', 'version': '1.12', 'options': '-U'})
+        s.add_pip('glance', {'name': 'routes', 'version': '1.13', 'options': '-U'})
+        s.add_pip('keystone', {'name': 'lxml'})
+        s.add_pip('horizon', {'name': 'lxml', 'version': '2.3.5'})
+        s.add_package('nova', {'name': 'libvirt'})
+        s.add_package('glance', {'name': 'libvirt', 'version': '0.10.2'})
+        solution = s.solve()
+        self.assertEquals(len(solution.conflicts), 0)
+        wanted = {'name': 'Routes', 'version': '1.12', 'options': '-U'}
+        pinned = solution.pin_pip(wanted)
+        self.assertEquals(pinned, {'name': 'Routes', 'version': '1.13', 'options': '-U'})
+        self.assertEquals(wanted['version'], '1.12')
+        self.assertEquals(solution.pin_pip({'name': 'lxml'})['version'], '2.3.5')
+        self.assertEquals(solution.pin_pip({'name': 'nova'}), {'name': 'nova'})
+        self.assertEquals(solution.pin_package({'name': 'libvirt'})['version'], '0.10.2')
@@ -1,3 +1,5 @@
+import shutil
+import tempfile
 import unittest
 
 from anvil import utils
@@ -10,3 +12,32 @@ class TestUtils(unittest.TestCase):
             'v': 'blah',
         })
         self.assertEquals(text, "blah blah")
+
+    def test_expand_plain(self):
+        self.assertEquals(utils.expand_template("blah", {}), "blah")
+
+
+TEMPLATE = "#if $a\nyes\n#else\nno\n#end if\n"
+
+
+class TestTemplateCache(unittest.TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def test_compiled_once(self):
+        templates = utils.TemplateCache()
+        self.assertTrue(templates.get("$a-$b") is templates.get("$a-$b"))
+        self.assertEquals(templates.expand("$a-$b", {'a': 1, 'b': 2}), "1-2")
+        self.assertEquals(templates.expand("$a-$b", {'a': 3, 'b': 4}), "3-4")
+
+    def test_on_disk(self):
+        templates = utils.TemplateCache(self.cache_dir)
+        self.assertEquals(templates.expand(TEMPLATE, {'a': True}), "yes\n")
+        # Another (later) cache loads what the first one compiled
+        templates = utils.TemplateCache(self.cache_dir)
+        key = templates._key(TEMPLATE)
+        self.assertTrue(templates._load_code(key) is not None)
+        self.assertEquals(templates.expand(TEMPLATE, {'a': False}), "no\n")
@@ -0,0 +1,96 @@
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from anvil.packaging.helpers import pip_helper
+from anvil.packaging.helpers import wheelhouse
+
+
+class TestWheelhouse(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.house = wheelhouse.Wheelhouse(None, self.base_dir)
+        os.makedirs(self.house.wheel_dir)
+        for fn in ['lxml-2.3.5-cp26-cp26mu-linux_x86_64.whl',
+                   'Paste_Deploy-1.5.0-py2-none-any.whl',
+                   'not-a-wheel.tar.gz']:
+            with open(os.path.join(self.house.wheel_dir, fn), 'w') as fh:
+                fh.write("")
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def test_has_wheel(self):
+        self.assertTrue(self.house.has_wheel(pip_helper.Requirement('lxml', '2.3.5')))
+        self.assertTrue(self.house.has_wheel(pip_helper.Requirement('lxml')))
+        self.assertFalse(self.house.has_wheel(pip_helper.Requirement('lxml', '3.0')))
+        self.assertTrue(self.house.has_wheel(pip_helper.Requirement('Paste-Deploy', '1.5.0')))
+        self.assertFalse(self.house.has_wheel(pip_helper.Requirement('not')))
+
+    def test_abi_dir(self):
+        self.assertTrue(self.house.wheel_dir.startswith(self.base_dir))
+        self.assertEquals(os.path.basename(self.house.wheel_dir), wheelhouse.abi_tag())
+
+
+SETUP_PY = """
+from setuptools import setup
+setup(name=%r, version='1.0', py_modules=[%r], install_requires=%r)
+"""
+
+
+class FakeDistro(object):
+    def get_command_config(self, key):
+        return [sys.executable, '-m', 'pip']
+
+
+class TestWheelhouseBuild(unittest.TestCase):
+    def setUp(self):
+        self.base_dir = tempfile.mkdtemp()
+        self.sdist_dir = os.path.join(self.base_dir, 'sdists')
+        os.makedirs(self.sdist_dir)
+        self._make_sdist('anvil_test_dep', [])
+        self._make_sdist('anvil_test_pkg', ['anvil_test_dep'])
+        self.house = wheelhouse.Wheelhouse(FakeDistro(), os.path.join(self.base_dir, 'wheels'),
+                                           max_workers=2, find_links=self.sdist_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.base_dir)
+
+    def _run(self, cmd, cwd=None):
+        subprocess.check_call(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _make_sdist(self, name, requires):
+        src_dir = os.path.join(self.base_dir, 'src', name)
+        os.makedirs(src_dir)
+        with open(os.path.join(src_dir, 'setup.py'), 'w') as fh:
+            fh.write(SETUP_PY % (name, name, requires))
+        with open(os.path.join(src_dir, '%s.py' % (name)), 'w') as fh:
+            fh.write("NAME = %r\n" % (name))
+        self._run([sys.executable, 'setup.py', '-q', 'sdist', '--formats=gztar',
+                   '--dist-dir', self.sdist_dir], cwd=src_dir)
+
+    def test_build_install(self):
+        try:
+            __import__('wheel')
+        except ImportError:
+            self.skipTest("Building wheels needs the wheel package")
+        req = pip_helper.Requirement('anvil_test_pkg')
+        self.assertEquals(self.house.build([req]), [])
+        self.assertTrue(self.house.has_wheel(req))
+        self.assertTrue(self.house.has_wheel(pip_helper.Requirement('anvil_test_dep')))
+        # Installing from the wheelhouse needs nothing else (not even the
+        # sdists it was built from)
+        shutil.rmtree(self.sdist_dir)
+        target_dir = os.path.join(self.base_dir, 'target')
+        cmd = FakeDistro().get_command_config('pip')
+        cmd += ['install', '-q', '--target', target_dir]
+        cmd += self.house.install_options()
+        cmd.append(str(req))
+        self._run(cmd)
+        for name in ['anvil_test_pkg', 'anvil_test_dep']:
+            self.assertTrue(os.path.isfile(os.path.join(target_dir, '%s.py' % (name))))
+        # Nothing left to build the second time around
+        self.assertEquals(self.house.build([req]), [])
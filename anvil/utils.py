@@ -17,13 +17,19 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import Queue
 import contextlib
 import glob
+import hashlib
+import imp
+import marshal
 import os
 import random
 import re
 import socket
+import sys
 import tempfile
+import threading
 import urllib2
 
 try:
@@ -36,13 +42,9 @@ from datetime import datetime
 
 from urlparse import urlunparse
 
-import netifaces
-import progressbar
-import yaml
-
-from Cheetah.Template import Template
-
 from anvil import colorizer
+from anvil import env
+from anvil import importer
 from anvil import log as logging
 from anvil import pprint
 from anvil import settings
@@ -51,6 +53,13 @@ from anvil import version
 
 from anvil.pprint import center_text
 
+# These are slow to import (and many runs do not need them)
+cheetah = importer.lazy_import('Cheetah')
+cheetah_template = importer.lazy_import('Cheetah.Template')
+netifaces = importer.lazy_import('netifaces')
+progressbar = importer.lazy_import('progressbar')
+yaml = importer.lazy_import('yaml')
+
 MONTY_PYTHON_TEXT_RE = re.compile("([a-z0-9A-Z\?!.,'\"]+)")
 
 # Thx cowsay
@@ -95,10 +104,91 @@ class ExponentialBackoff(object):
         return "Backoff %s" % (vals)
 
 
+class TemplateCache(object):
+    """
+    Cheetah templates compiled (into a class) once per unique template
+    source (keyed by a hash of that source) so that expanding the same
+    template again only has to render it with the new search list. When
+    given a directory the compiled template code is also stored there so
+    that later runs can skip the parsing and compiling as well.
+    """
+
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self._classes = {}
+        self._lock = threading.Lock()
+
+    def _key(self, source):
+        hasher = hashlib.sha1()
+        # Different cheetah (or python) versions generate different code
+        hasher.update(cheetah.Version)
+        hasher.update(imp.get_magic())
+        hasher.update(source)
+        return hasher.hexdigest()
+
+    def _load_code(self, key):
+        if not self.cache_dir:
+            return None
+        try:
+            with open(sh.joinpths(self.cache_dir, "%s.tpl" % (key)), 'rb') as fh:
+                return marshal.load(fh)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+
+    def _save_code(self, key, code):
+        if not self.cache_dir:
+            return
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            # Written to the side and then moved (so that partially written
+            # code is never loaded)
+            (fd, tmp_fn) = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as fh:
+                marshal.dump(code, fh)
+            os.rename(tmp_fn, sh.joinpths(self.cache_dir, "%s.tpl" % (key)))
+        except (IOError, OSError) as e:
+            LOG.debug("Failed saving compiled template %s to %r: %s", key, self.cache_dir, e)
+
+    def _compile(self, key, source):
+        class_name = "template_%s" % (key)
+        code = self._load_code(key)
+        if code is None:
+            module_code = cheetah_template.Template.compile(source=source, returnAClass=False,
+                                                            className=class_name)
+            code = compile(module_code, "<template %s>" % (key), 'exec')
+            self._save_code(key, code)
+        module = imp.new_module(class_name)
+        exec code in module.__dict__
+        # Like cheetah does, this keeps the module (and its globals) alive
+        sys.modules[class_name] = module
+        return getattr(module, class_name)
+
+    def get(self, source):
+        key = self._key(source)
+        with self._lock:
+            template_cls = self._classes.get(key)
+            if template_cls is None:
+                template_cls = self._compile(key, source)
+                self._classes[key] = template_cls
+        return template_cls
+
+    def expand(self, source, params):
+        source = str(source)
+        if '$' not in source and '#' not in source:
+            # Nothing for cheetah to do (no placeholders or directives)
+            return source
+        return self.get(source)(searchList=[params]).respond()
+
+
+# Compiled templates (used by expand_template)
+TEMPLATES = TemplateCache(env.get_key('ANVIL_TEMPLATE_CACHE_DIR'))
+
+
 def expand_template(contents, params):
     if not params:
         params = {}
-    return Template(str(contents), searchList=[params]).respond()
+    return TEMPLATES.expand(contents, params)
 
 
 def expand_template_deep(root, params):
@@ -127,7 +217,9 @@ def load_yaml(path):
 
 
 def load_yaml_text(text):
-    return yaml.safe_load(text)
+    # The libyaml based loader is a lot faster (when it is available)
+    loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    return yaml.load(text, Loader=loader)
 
 
 def has_any(text, *look_for):
@@ -373,6 +465,55 @@ def tempdir(**kwargs):
         sh.deldir(tdir)
 
 
+def run_in_parallel(functor, items, max_workers=1):
+    """
+    Calls the functor with each item using at most max_workers threads.
+
+    Returns a list of (item, result, exc_info) tuples in the same order as
+    the items were given (exc_info is None if the functor did not fail). The
+    functors are expected to do most of their work in subprocesses or on
+    sockets, since python threads will not speed up anything else...
+    """
+    items = list(items)
+    results = [None] * len(items)
+
+    def run_one(index, item):
+        try:
+            results[index] = (item, functor(item), None)
+        except Exception:
+            results[index] = (item, None, sys.exc_info())
+
+    max_workers = min(max(1, int(max_workers)), len(items))
+    if max_workers <= 1:
+        for (i, item) in enumerate(items):
+            run_one(i, item)
+        return results
+
+    work = Queue.Queue()
+    for (i, item) in enumerate(items):
+        work.put((i, item))
+
+    def worker():
+        while True:
+            try:
+                (i, item) = work.get_nowait()
+            except Queue.Empty:
+                return
+            run_one(i, item)
+
+    workers = []
+    for _i in range(0, max_workers):
+        t = threading.Thread(target=worker)
+        t.daemon = True
+        t.start()
+        workers.append(t)
+    for t in workers:
+        # Join with a timeout so that interrupts still get delivered
+        while t.isAlive():
+            t.join(0.1)
+    return results
+
+
 def get_host_ip(default_ip='127.0.0.1'):
     """
     Returns the actual ip of the local machine.